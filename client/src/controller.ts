@@ -341,11 +341,10 @@ class WorkProvider implements exec_api.WorkProvider {
 
     private _getTasks(project: string): Promise<exec_api.TaskSet> {
         const req = new cbor.Writer();
-        req.map(3);
+        // Without maxtasks, the server sends as many tasks as this worker completes between polls.
+        req.map(2);
         req.string("pname");
         req.string(project);
-        req.string("maxtasks");
-        req.number(50); // TODO: set to something proper.
         req.string("token");
         req.string(this.token);
         req.end();
@@ -0,0 +1,267 @@
+## Asyncio front end
+# Usage: python3 asyncserver.py [--shard i]
+# Serves the endpoints of RootServer, with the same requests and responses, from a single event loop
+# in place of CherryPy's thread per connection. Request bodies are read and responses written by the
+# event loop, so a phone on a slow connection holds a socket rather than a thread. Only once a whole
+# body has arrived is the endpoint run, on a pool of SERVER_THREADS threads, so the database is never
+# called from the event loop. A streamed response is read from the blob store a chunk at a time on
+# the pool, and written to the client by the event loop.
+import asyncio, cherrypy, inspect, os, sys, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qsl
+from cherrypy.lib.httputil import HeaderMap
+
+import server
+from header import *
+
+CHUNK = 64*1024     # Bytes read at a time from request bodies and blob streams
+
+root = server.RootServer()
+pool = ThreadPoolExecutor(SERVER_THREADS)
+
+# Stand-ins for cherrypy.request and cherrypy.response, which are all that the endpoints use
+class Request:
+    def __init__(self, path, headers, body):
+        self.path_info = path
+        self.headers = headers
+        self.body = body
+
+class Response:
+    def __init__(self):
+        self.status = 200
+        self.headers = HeaderMap()
+        self.headers["Content-Type"] = "text/html;charset=utf-8"
+
+class BadRequest(Exception):
+    status = 400
+
+class TooLarge(BadRequest):
+    status = 413
+
+# Like CherryPy's max_request_body_size, which shards set to unlimited so that whole projects can be moved
+maxBody = None if server.shard is not None else MAX_BODY_SIZE
+
+# Reads the request head. Returns (method, target, version, headers), or None if the client closed
+# the connection
+async def readHead(reader):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT / 1000)
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise BadRequest("Incomplete request")
+        return None
+    except asyncio.LimitOverrunError:
+        raise BadRequest("Request head too long")
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        (method, target, version) = lines[0].split(" ")
+    except ValueError:
+        raise BadRequest("Invalid request line")
+
+    headers = HeaderMap()
+    for line in lines[1:]:
+        if line:
+            (k, sep, v) = line.partition(":")
+            if not sep:
+                raise BadRequest("Invalid header")
+            headers[k.strip()] = v.strip()
+
+    return (method, target, version, headers)
+
+async def readSome(reader, n):
+    data = await asyncio.wait_for(reader.read(n), IDLE_TIMEOUT / 1000)
+    if not data:
+        raise BadRequest("Incomplete body")
+    return data
+
+# Reads the request body as it arrives into a file, which stays in memory while under SPOOL_SIZE.
+# A body longer than maxBody is refused, before any of it is read if its length is given
+async def readBody(reader, writer, headers):
+    chunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
+    if not chunked:
+        try:
+            size = int(headers.get("Content-Length", 0))
+            if size < 0:
+                raise ValueError("Negative length")
+        except ValueError:
+            raise BadRequest("Invalid Content-Length")
+        if maxBody is not None and size > maxBody:
+            raise TooLarge("Request body too large")
+
+    body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    if headers.get("Expect", "").lower() == "100-continue":
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+    if chunked:
+        total = 0
+        while True:
+            line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT / 1000)
+            try:
+                size = int(line.split(b";")[0], 16)
+                if size < 0:
+                    raise ValueError("Negative size")
+            except ValueError:
+                raise BadRequest("Invalid chunk size")
+            total += size
+            if maxBody is not None and total > maxBody:
+                raise TooLarge("Request body too large")
+            if size == 0:
+                # Skip any trailers
+                while (await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT / 1000)).strip():
+                    pass
+                break
+            while size > 0:
+                data = await readSome(reader, min(size, CHUNK))
+                body.write(data)
+                size -= len(data)
+            await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT / 1000)
+    else:
+        while size > 0:
+            data = await readSome(reader, min(size, CHUNK))
+            body.write(data)
+            size -= len(data)
+
+    body.seek(0)
+    return body
+
+# Runs an endpoint on the current pool thread. Returns (status, headers, body), where the body is
+# bytes, a list of chunks of bytes, or an iterator of bytes for a streamed response
+def call(handler, params, request):
+    response = Response()
+    cherrypy.serving.load(request, response)
+    try:
+        body = handler(**params)
+    except cherrypy.HTTPError as e:
+        response.status = e.code
+        body = getattr(e, "_message", None) or ""
+    finally:
+        cherrypy.serving.clear()
+
+    if body is None:
+        body = b''
+    elif type(body) is str:
+        body = body.encode("utf-8")
+    return (int(str(response.status).split()[0]), response.headers, body)
+
+def statusLine(status):
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = ""
+    return ("HTTP/1.1 %d %s\r\n" % (status, reason)).encode("latin-1")
+
+async def respond(writer, status, headers, body, keepalive):
+    loop = asyncio.get_running_loop()
+    if type(body) is bytes:
+        headers["Content-Length"] = str(len(body))
+    elif type(body) is list:
+        headers["Content-Length"] = str(sum(len(data) for data in body))
+    elif "Content-Length" not in headers:
+        headers["Transfer-Encoding"] = "chunked"
+    if not keepalive:
+        headers["Connection"] = "close"
+
+    head = statusLine(status) + b"".join(("%s: %s\r\n" % (k, v)).encode("latin-1") for (k, v) in headers.items()) + b"\r\n"
+    if status == 304 or type(body) is bytes:
+        writer.write(head + (b'' if status == 304 else body))
+        await writer.drain()
+        return
+
+    # The chunks of an encoded body, such as a framed one, are written as they are, without joining them
+    if type(body) is list:
+        writer.write(head)
+        writer.writelines(body)
+        await writer.drain()
+        return
+
+    # Stream the body, reading each chunk on the pool and waiting for the client to take it
+    chunked = "Transfer-Encoding" in headers
+    writer.write(head)
+    body = iter(body)
+    while True:
+        data = await loop.run_in_executor(pool, next, body, None)
+        if data is None:
+            break
+        if not data:
+            continue
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+        await writer.drain()
+    if chunked:
+        writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+def errorResponse(status, message):
+    headers = HeaderMap()
+    headers["Content-Type"] = "text/plain"
+    return (status, headers, message.encode("utf-8"))
+
+# Serves one request. Returns True iff the connection may be kept open
+async def serveRequest(reader, writer):
+    loop = asyncio.get_running_loop()
+    head = await readHead(reader)
+    if head is None:
+        return False
+    (method, target, version, headers) = head
+    keepalive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+
+    body = await readBody(reader, writer, headers)
+    url = urlsplit(target)
+    name = url.path.strip("/")
+    params = dict(parse_qsl(url.query))
+    handler = getattr(root, name, None)
+
+    if name == "reboot":
+        # CherryPy reboots by re-executing the process, so do the same once the response is sent
+        if PRODUCTION:
+            await respond(writer, 200, HeaderMap(), b'', keepalive)
+            return keepalive
+        server.database.wipe()
+        await respond(writer, 200, HeaderMap(), server.success(), False)
+        writer.close()
+        if hasattr(server.database, "flush"):
+            server.database.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    if "/" in name or not getattr(handler, "exposed", False):
+        response = errorResponse(404, "Not found")
+    else:
+        try:
+            inspect.signature(handler).bind(**params)
+        except TypeError:
+            response = errorResponse(404, "Missing parameters")
+        else:
+            try:
+                response = await loop.run_in_executor(pool, call, handler, params, Request(url.path, headers, body))
+            except Exception as e:
+                server.log("Error in " + name + ": " + repr(e))
+                response = errorResponse(500, "Internal server error")
+
+    await respond(writer, *response, keepalive)
+    return keepalive
+
+async def serveConnection(reader, writer):
+    try:
+        while await serveRequest(reader, writer):
+            pass
+    except BadRequest as e:
+        writer.write(statusLine(e.status) + b"Connection: close\r\nContent-Length: %d\r\n\r\n%s" % (len(str(e)), str(e).encode()))
+    except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def main():
+    if server.shard is not None:
+        listener = await asyncio.start_server(serveConnection, NODE_HOST, SERVER_PORT + 1 + server.shard, limit=MAX_STREAM_HEADER, backlog=1024)
+    else:
+        listener = await asyncio.start_server(serveConnection, "0.0.0.0", SERVER_PORT, limit=MAX_STREAM_HEADER, backlog=1024)
+    async with listener:
+        await listener.serve_forever()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,67 @@
+# Adaptive sizing of the batches of tasks given to workers
+import threading, time
+
+from header import *
+
+RATE_WEIGHT = 0.3   # Weight of the latest batch in a worker's measured completion rate
+
+# Measures how fast each worker completes tasks, and suggests how many to give it at once so that it
+# polls for tasks about every BATCH_INTERVAL. A worker's batch is turned around when every task
+# issued in it has been reported, and its rate is the tasks completed in the batch over the time
+# since the batch was issued, averaged over recent batches. Times are taken from time.monotonic(),
+# as database times are only precise to the second.
+class BatchSizer:
+    def __init__(self):
+        self.workers = {}   # Maps a username to its outstanding tasks, batch start, tasks completed and rate
+        self.lock = threading.Lock()
+
+    # Counts n tasks issued to username
+    def issue(self, username, n):
+        if n == 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            w = self.workers.get(username)
+            if w is None:
+                w = self.workers[username] = {"outstanding": 0, "start": now, "completed": 0, "rate": None}
+
+            # Tasks whose leases ran out are never reported, so a batch that old is given up on
+            if w["outstanding"] == 0 or now - w["start"] > LEASE_TIME / 1000:
+                w["outstanding"] = 0
+                w["start"] = now
+                w["completed"] = 0
+            w["outstanding"] += n
+
+    # Counts a task reported by username, completed if ok is true
+    def report(self, username, ok):
+        now = time.monotonic()
+        with self.lock:
+            w = self.workers.get(username)
+            if w is None or w["outstanding"] == 0:
+                return
+
+            w["outstanding"] -= 1
+            if ok:
+                w["completed"] += 1
+            if w["outstanding"] > 0 or w["completed"] == 0:
+                return
+
+            # The batch is turned around. Its rate is in tasks per millisecond
+            rate = w["completed"] / (max(now - w["start"], 0.001) * 1000)
+            if w["rate"] is None:
+                w["rate"] = rate
+            else:
+                w["rate"] += RATE_WEIGHT * (rate - w["rate"])
+
+    # Returns the number of tasks to give username at once, or None if it has not yet turned a batch around
+    def suggest(self, username):
+        w = self.workers.get(username)
+        if w is None or w["rate"] is None:
+            return None
+        return min(max(int(w["rate"] * BATCH_INTERVAL), 1), MAX_BATCH_TASKS)
+
+    # True iff username has been measured to take less than limit milliseconds per task. A limit of
+    # None is never met
+    def isFaster(self, username, limit):
+        w = self.workers.get(username)
+        return limit is not None and w is not None and w["rate"] is not None and 1 / w["rate"] < limit
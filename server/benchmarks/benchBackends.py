@@ -0,0 +1,64 @@
+## Benchmark of the dict database backend against the SQLite backend
+# Usage: python3 benchBackends.py [blobs ...]
+# For each number of blobs, times filling a project with task blobs, random getBlob reads, and
+# getTasks/sendTasks cycles on both backends.
+import sys, os, time, random, tempfile, cbor
+
+# Keep the benchmark's blob stores away from any real ones
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+tmpdir = tempfile.mkdtemp()
+os.chdir(tmpdir)
+import database, sqldatabase
+
+READS = 10000       # Number of random getBlob calls timed
+CYCLES = 10000      # Number of getTasks/sendTasks cycles timed
+
+try:
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+except ValueError:
+    sys.exit("Usage: benchBackends.py [blobs ...]")
+
+sqldatabase.openDatabase(os.path.join(tmpdir, "bench.db"))
+backends = [("dict", database), ("sqlite", sqldatabase)]
+
+task = cbor.dumps({"program": {"id": "0", "size": 0}, "control": bytes(32), "blobs": []})
+result = bytes(1024)
+
+def timed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+print("%8s %8s %14s %14s %14s" % ("blobs", "backend", "create (us)", "getBlob (us)", "cycle (us)"))
+for n, size in enumerate(sizes):
+    for (name, db) in backends:
+        pname = "bench" + str(n)
+        db.createNewProject(pname, "Backend benchmark")
+        db.register("worker" + str(n), "", "worker")
+
+        def fill():
+            for i in range(size):
+                (succ, bID) = db.createNewBlob(pname, task, b'')
+                db.blobToTask(pname, bID)
+
+        def read():
+            for i in range(READS):
+                db.getBlob(pname, str(random.randrange(size)))
+
+        def cycle():
+            for i in range(CYCLES):
+                (succ, tasks, taskIDs) = db.getTasks(pname, "worker" + str(n), 1)
+                for t in taskIDs:
+                    db.sendTasks(pname, t, [result], [b''], "worker" + str(n), "ok")
+
+        create = timed(fill)
+        if name == "sqlite":
+            sqldatabase.flush()
+        get = timed(read)
+        cyc = timed(cycle)
+        if name == "sqlite":
+            sqldatabase.flush()
+
+        print("%8d %8s %14.2f %14.2f %14.2f" % (size, name, create / size * 1e6, get / READS * 1e6, cyc / CYCLES * 1e6))
+
+    del database.projects[pname]
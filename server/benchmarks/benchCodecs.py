@@ -0,0 +1,54 @@
+## Benchmark of the wire codecs against each endpoint's bodies
+# Usage: python3 benchCodecs.py [scale ...]
+# For each scale, builds a realistic body for each endpoint whose blobs are scale times their usual
+# size, and times encoding and decoding it with every codec in codec.py. Decoding framed bodies
+# keeps blobs as memoryviews, as the server does, so its cost should not grow with blob size. It
+# does walk the whole body though, so on bodies of many small values CBOR is cheaper.
+import sys, os, time, cbor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import codec
+
+TIME = 0.2          # Least seconds each encode or decode is repeated for
+
+try:
+    scales = [int(n) for n in sys.argv[1:]] or [1, 16, 256]
+except ValueError:
+    sys.exit("Usage: benchCodecs.py [scale ...]")
+
+def task(i):
+    return cbor.dumps({"program": {"id": "0", "size": 65536}, "control": i.to_bytes(8, "big"), "blobs": [{"id": str(i), "size": 4096}]})
+
+# Returns (endpoint, request or response, body) for each body timed, with blobs of scale * their usual size
+def bodies(scale):
+    blob = bytes(4096 * scale)
+    return [
+        ("createNewBlobs", "request", {"token": "a"*20, "pname": "project1", "blobs": [blob] * 100, "metadatas": [b'meta'] * 100, "tasks": False}),
+        ("getTasks", "response", {"success": True, "error": "", "pname": "project1", "tasks": [task(i) for i in range(10)],
+            "taskIDs": [str(i) for i in range(10)], "programs": {}, "blobs": {str(i): blob for i in range(10)}, "deferred": [],
+            "leaseTime": 600000, "batchSize": 10}),
+        ("sendTasks", "request", {"token": "a"*20, "tasks": {"project1": {str(i): {"results": [blob], "status": "ok"} for i in range(10)}}}),
+        ("getBlob", "response", {"success": True, "error": "", "blob": blob * 16, "metadata": b'meta'}),
+        ("getBlobMetadata", "response", {"success": True, "error": "", "metadata": {str(i): cbor.dumps({"n": i}) for i in range(1000)}, "next": 999}),
+        ("getGraphs", "response", {"success": True, "error": "", "description": "Description", "version": 1,
+            "graphs": {name: [{"x": t * 1000, "y": t % 97} for t in range(1000)] for name in ["tasksCompleted", "activeWorkers"]}}),
+    ]
+
+# Returns the mean seconds f takes, repeating it for at least TIME seconds
+def timed(f):
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < TIME:
+        f()
+        n += 1
+    return (time.perf_counter() - start) / n
+
+print("%6s %16s %9s %28s %12s %12s %12s" % ("scale", "endpoint", "body", "codec", "size (KB)", "encode (us)", "decode (us)"))
+for scale in scales:
+    for (endpoint, kind, body) in bodies(scale):
+        for t in codec.codecs:
+            encoded = codec.encode(t, body)
+            data = encoded if type(encoded) is bytes else b"".join(encoded)
+            encode = timed(lambda: codec.encode(t, body))
+            decode = timed(lambda: codec.decode(t, data, True))
+            print("%6d %16s %9s %28s %12.1f %12.1f %12.1f" % (scale, endpoint, kind, t, len(data) / 1024, encode * 1e6, decode * 1e6))
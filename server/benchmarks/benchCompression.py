@@ -0,0 +1,59 @@
+## Benchmark of compression levels against each compressed endpoint's responses
+# Usage: python3 benchCompression.py [level ...]
+# For each encoding in compressor.py and each level, times compressing a realistic response of each
+# endpoint in COMPRESS_LEVELS, and prints the share of its size left. Responses are compressed on
+# every request, so their levels trade that time against the bytes sent to phones; blobs are only
+# compressed once, so BLOB_COMPRESS_LEVELS can be as high as storing them allows.
+import sys, os, time, json, struct, cbor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import codec, compressor
+
+TIME = 0.2          # Least seconds each compression is repeated for
+
+try:
+    levels = [int(n) for n in sys.argv[1:]] or [1, 3, 6, 9]
+except ValueError:
+    sys.exit("Usage: benchCompression.py [level ...]")
+
+# The lengths of a stretch of Collatz sequences, as a result blob might hold
+def sequenceLengths(start, n):
+    lengths = []
+    for i in range(start, start + n):
+        (x, steps) = (i, 0)
+        while x != 1:
+            x = x // 2 if x % 2 == 0 else 3 * x + 1
+            steps += 1
+        lengths.append(steps)
+    return struct.pack(">%dI" % n, *lengths)
+
+# Returns (endpoint, encoded response) for each response timed
+def bodies():
+    blob = sequenceLengths(1, 16384)
+    return [
+        ("getBlob", codec.encode(codec.CBOR, {"success": True, "error": "", "metadata": cbor.dumps("1-16384"), "blob": blob})),
+        ("getBlobMetadata", codec.encode(codec.CBOR, {"success": True, "error": "", "metadata": {str(i): cbor.dumps({"start": i * 1000, "n": 1000}) for i in range(1000)}, "next": 999})),
+        ("waitForResults", codec.encode(codec.CBOR, {"success": True, "error": "", "metadata": {str(i): cbor.dumps(str(i)) for i in range(1000)}, "cursor": 999})),
+        ("getGraphs", codec.encode(codec.JSON, {"success": True, "error": "", "description": "Description", "version": 1,
+            "graphs": {name: [{"x": 1500000000000 + t * 1000, "y": t % 97} for t in range(1000)] for name in ["tasksCompleted", "activeWorkers"]}})),
+        ("getTasks", codec.encode(codec.CBOR, {"success": True, "error": "", "pname": "project1", "taskIDs": [str(i) for i in range(10)],
+            "tasks": [cbor.dumps({"program": {"id": "0"}, "control": struct.pack(">Q", i * 1000), "blobs": []}) for i in range(10)],
+            "programs": {}, "blobs": {}, "deferred": [], "leaseTime": 600000, "batchSize": 10})),
+    ]
+
+# Returns the mean seconds f takes, repeating it for at least TIME seconds
+def timed(f):
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < TIME:
+        f()
+        n += 1
+    return (time.perf_counter() - start) / n
+
+print("%16s %10s %6s %12s %8s %14s" % ("endpoint", "encoding", "level", "size (KB)", "ratio", "compress (us)"))
+for (endpoint, body) in bodies():
+    for encoding in compressor.ENCODINGS:
+        for level in levels:
+            data = compressor.compress(encoding, body, level)
+            seconds = timed(lambda: compressor.compress(encoding, body, level))
+            print("%16s %10s %6d %12.1f %8.3f %14.1f" % (endpoint, encoding, level, len(body) / 1024, len(data) / len(body), seconds * 1e6))
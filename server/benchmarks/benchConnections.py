@@ -0,0 +1,96 @@
+## Benchmark of concurrent connections against the CherryPy and asyncio front ends
+# Usage: python3 benchConnections.py [connections ...]
+# For each number of connections, starts each front end on SERVER_PORT, opens that many slow
+# clients, each of which has sent only half of a getTasks request, and then times ping requests
+# from a fresh client while they wait. Finally the slow clients send the rest of their requests,
+# and the number answered is counted. A front end with a thread per connection stalls once the
+# slow clients hold every thread.
+import sys, os, time, asyncio, resource, subprocess, tempfile, statistics, cbor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from header import *
+
+PINGS = 20          # Number of ping requests timed while the slow clients wait
+PING_TIMEOUT = 5    # Seconds before a ping counts as failed
+HOLD = 2            # Seconds the slow clients wait before finishing their requests
+
+try:
+    counts = [int(n) for n in sys.argv[1:]] or [100, 1000, 5000]
+except ValueError:
+    sys.exit("Usage: benchConnections.py [connections ...]")
+
+# Allow as many sockets as the benchmark needs
+(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+here = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+frontends = [("cherrypy", "server.py"), ("asyncio", "asyncserver.py")]
+
+body = cbor.dumps({"token": "x", "pname": "bench", "maxtasks": 1})
+request = (b"POST /getTasks HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" % len(body)) + body
+half = len(request) - len(body) // 2
+
+async def ping():
+    start = time.perf_counter()
+    try:
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", SERVER_PORT), PING_TIMEOUT)
+        writer.write(b"POST /ping HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await asyncio.wait_for(reader.read(), PING_TIMEOUT)
+        writer.close()
+    except (asyncio.TimeoutError, OSError):
+        return None
+    return time.perf_counter() - start
+
+async def slowClient(ready, release):
+    try:
+        (reader, writer) = await asyncio.open_connection("127.0.0.1", SERVER_PORT)
+        writer.write(request[:half])
+        await writer.drain()
+    except OSError:
+        ready.set_result(False)
+        return False
+    ready.set_result(True)
+
+    await release.wait()
+    try:
+        writer.write(request[half:])
+        await writer.drain()
+        data = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), PING_TIMEOUT)
+        writer.close()
+        return data.startswith(b"HTTP/1.1 200")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+        return False
+
+async def measure(count):
+    loop = asyncio.get_running_loop()
+    release = asyncio.Event()
+    readies = [loop.create_future() for c in range(count)]
+    clients = [asyncio.ensure_future(slowClient(r, release)) for r in readies]
+    connected = sum(await asyncio.gather(*readies))
+
+    times = [await ping() for p in range(PINGS)]
+    await asyncio.sleep(HOLD)
+    release.set()
+    answered = sum(await asyncio.gather(*clients))
+
+    ok = [t for t in times if t is not None]
+    latency = statistics.median(ok) * 1000 if ok else float("nan")
+    return (connected, len(ok), latency, answered)
+
+print("%8s %10s %10s %8s %16s %10s" % ("clients", "front end", "connected", "pings", "ping median (ms)", "answered"))
+for count in counts:
+    for (name, script) in frontends:
+        p = subprocess.Popen([sys.executable, os.path.join(here, script)], cwd=tempfile.mkdtemp(),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # Wait for the server to start
+            for attempt in range(50):
+                if asyncio.run(ping()) is not None:
+                    break
+                time.sleep(0.1)
+
+            (connected, pings, latency, answered) = asyncio.run(measure(count))
+            print("%8d %10s %10d %5d/%-2d %16.2f %10d" % (count, name, connected, pings, PINGS, latency, answered))
+        finally:
+            p.terminate()
+            p.wait()
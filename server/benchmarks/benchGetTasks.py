@@ -0,0 +1,54 @@
+## Benchmark of getTasks latency against queue depth
+# Usage: python3 benchGetTasks.py [depth ...]
+# Seeds a project with each queue depth, then times getTasks calls from a pool of workers
+# completing their tasks. Latency should stay flat as the queue grows.
+import sys, os, time, tempfile, cbor
+
+# Keep the benchmark's blob store away from any real one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(tempfile.mkdtemp())
+import database
+
+WORKERS = 1000      # Number of distinct workers polling
+CALLS = 20000       # Number of getTasks calls timed at each depth
+MAXTASKS = 4        # Tasks requested per call
+
+try:
+    depths = [int(d) for d in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+except ValueError:
+    sys.exit("Usage: benchGetTasks.py [depth ...]")
+
+task = cbor.dumps({"program": {"id": "0", "size": 0}, "control": b'', "blobs": []})
+
+for n, depth in enumerate(depths):
+    pname = "bench" + str(n)
+    database.createNewProject(pname, "getTasks benchmark")
+    for i in range(depth):
+        (succ, bID) = database.createNewBlob(pname, task, b'')
+        database.blobToTask(pname, bID)
+
+    workers = ["worker" + str(n) + "-" + str(w) for w in range(WORKERS)]
+    for w in workers:
+        database.register(w, "", "worker")
+
+    # Each call takes tasks, and completes them so that the workers keep a realistic history
+    elapsed = 0
+    for c in range(CALLS):
+        w = workers[c % WORKERS]
+        start = time.perf_counter()
+        (succ, tasks, taskIDs) = database.getTasks(pname, w, MAXTASKS)
+        elapsed += time.perf_counter() - start
+
+        if not succ:
+            sys.exit("getTasks failed: " + str(tasks))
+        for t in taskIDs:
+            database.sendTasks(pname, t, [], [], w, "ok")
+
+        # Keep the queue at the requested depth
+        for t in taskIDs:
+            (succ, bID) = database.createNewBlob(pname, task, b'')
+            database.blobToTask(pname, bID)
+
+    print("depth %8d: %6.2f us per getTasks" % (depth, elapsed / CALLS * 1e6))
+
+    del database.projects[pname]
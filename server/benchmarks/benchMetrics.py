@@ -0,0 +1,56 @@
+## Benchmark of the cost of counting and timing each request for the metrics endpoint
+# Usage: python3 benchMetrics.py [threads ...]
+# Times calls to an empty endpoint with and without metrics.instrument(), from each number of
+# threads at once, and prints the time the instrumentation adds to each call. Rendering the
+# metrics of every endpoint is timed too, as it runs on every scrape.
+import sys, os, time, threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import metrics
+
+CALLS = 200000      # Calls made by each thread
+
+try:
+    counts = [int(n) for n in sys.argv[1:]] or [1, 4, 16]
+except ValueError:
+    sys.exit("Usage: benchMetrics.py [threads ...]")
+
+class Root:
+    def ping(self):
+        return b''
+
+    def failing(self):
+        metrics.failed()
+        return b''
+
+# Returns the mean seconds per call of f, called CALLS times by each of n threads at once
+def timed(f, n):
+    def run():
+        for i in range(CALLS):
+            f()
+    threads = [threading.Thread(target=run) for i in range(n)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (time.perf_counter() - start) / (CALLS * n)
+
+root = Root()
+plain = root.ping
+instrumented = metrics.instrument("ping", Root.ping).__get__(root)
+failing = metrics.instrument("failing", Root.failing).__get__(root)
+
+print("%8s %12s %16s %12s %12s" % ("threads", "plain (us)", "instrumented (us)", "failing (us)", "added (us)"))
+for n in counts:
+    base = timed(plain, n)
+    counted = timed(instrumented, n)
+    print("%8d %12.3f %16.3f %12.3f %12.3f" % (n, base * 1e6, counted * 1e6, timed(failing, n) * 1e6, (counted - base) * 1e6))
+
+for name in ["endpoint" + str(i) for i in range(40)]:
+    metrics.instrument(name, Root.ping)
+gauges = {"sessions": 1000, "projects": {"project" + str(i): {"waiting": 0, "issued": 0, "spares": 0, "blobBytes": 0, "graphPoints": 0} for i in range(100)}}
+start = time.perf_counter()
+for i in range(100):
+    metrics.render(gauges)
+print("render, 42 endpoints and 100 projects: %.1f us" % ((time.perf_counter() - start) / 100 * 1e6))
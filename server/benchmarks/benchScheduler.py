@@ -0,0 +1,43 @@
+## Benchmark of the fair-share scheduler against the number of projects
+# Usage: python3 benchScheduler.py [projects ...]
+# For each number of projects, with weights from 1 to 4, times scheduling decisions for workers
+# asking for tasks from any project, and compares the share of tasks each weight was issued with
+# its share of the total weight. The time per decision should grow only with log(projects).
+import sys, os, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from scheduler import FairScheduler
+
+DECISIONS = 200000  # Least scheduling decisions timed for each number of projects
+BATCH = 4           # Tasks issued by each decision
+
+try:
+    counts = [int(n) for n in sys.argv[1:]] or [10, 100, 1000, 10000, 100000]
+except ValueError:
+    sys.exit("Usage: benchScheduler.py [projects ...]")
+
+print("%10s %16s %32s" % ("projects", "decision (us)", "issued / fair share, weights 1-4"))
+for count in counts:
+    random.seed(count)
+    scheduler = FairScheduler()
+    weights = {}
+    for n in range(count):
+        pname = "p" + str(n)
+        weights[pname] = random.randint(1, 4)
+        scheduler.setWeight(pname, weights[pname])
+        scheduler.wake(pname)
+
+    # Enough decisions for every project to have had many turns
+    decisions = max(DECISIONS, 20*count)
+    issued = {w: 0 for w in range(1, 5)}
+    start = time.perf_counter()
+    for d in range(decisions):
+        pname = scheduler.next(d)
+        scheduler.charge(pname, BATCH)
+        issued[weights[pname]] += BATCH
+    elapsed = time.perf_counter() - start
+
+    total = sum(weights.values())
+    shares = ["%.2f" % ((issued[w] / (decisions*BATCH)) / (w * sum(1 for v in weights.values() if v == w) / total))
+        for w in range(1, 5)]
+    print("%10d %16.2f %32s" % (count, elapsed / decisions * 1e6, " ".join(shares)))
@@ -0,0 +1,229 @@
+# Content-addressed blob storage on disk
+# Each distinct blob is stored once, in a file named by the SHA-256 hash of its contents, and
+# reference counted by the blob IDs which alias it. Reads are served from memory-mapped files, so
+# blob contents are held in the page cache rather than in Python memory.
+# Given levels, each new blob of at least COMPRESS_MIN bytes is also compressed in the background,
+# once, into a copy beside it for each of the encodings, so that it can be sent compressed without
+# being compressed again. A copy which saves too little is not kept.
+from collections import OrderedDict
+import hashlib, mmap, os, queue, threading, uuid
+
+import compressor
+from header import *
+
+CHUNK = 64*1024     # Bytes read or written at a time when streaming a blob
+
+# Number of blob files kept mapped. Each mapping holds a file descriptor of its own, so they take at
+# most a quarter of the descriptors the process may have open
+MMAP_CACHE = 256
+try:
+    import resource
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY:
+        MMAP_CACHE = max(min(MMAP_CACHE, soft // 4), 1)
+except ImportError:
+    pass
+
+class BlobStore:
+    def __init__(self, root, levels=None):
+        self.root = root
+        self.levels = levels or {}  # Maps an encoding to the level of blobs' compressed copies in it
+        self.refs = {}              # Maps a hash to the number of blob IDs referring to it
+        self.dead = set()           # Hashes whose count reached zero, waiting for collect()
+        self.maps = OrderedDict()   # Maps a hash to its mmap, least recently used first
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()    # Hashes of new blobs waiting for their compressed copies
+        os.makedirs(root, exist_ok=True)
+        if self.levels:
+            threading.Thread(target=self.compressLoop, daemon=True).start()
+
+    def path(self, h):
+        return os.path.join(self.root, h[:2], h)
+
+    # Stores data, or adds a reference to an identical blob already stored. Returns its hash
+    def put(self, data):
+        h = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if h in self.refs:
+                self.refs[h] += 1
+                return h
+
+        tmp = self.tempPath()
+        with open(tmp, "wb") as f:
+            f.write(data)
+        return self.publish(tmp, h)
+
+    # Stores a blob read in chunks of CHUNK bytes from read(n), until size bytes have been read (or
+    # until end of file if size is None). Memory use is bounded by CHUNK. Returns (hash, size)
+    def putStream(self, read, size=None):
+        tmp = self.tempPath()
+        hasher = hashlib.sha256()
+        n = 0
+        try:
+            with open(tmp, "wb") as f:
+                while size is None or n < size:
+                    chunk = read(CHUNK if size is None else min(CHUNK, size - n))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    n += len(chunk)
+
+            if size is not None and n < size:
+                raise IOError("Blob ended after " + str(n) + " of " + str(size) + " bytes")
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        return (self.publish(tmp, hasher.hexdigest()), n)
+
+    def tempPath(self):
+        return os.path.join(self.root, "tmp-" + uuid.uuid4().hex)
+
+    # Moves a fully written temporary file into place under hash h, or drops it if an identical blob
+    # was stored meanwhile. The file appears at the same time as its reference, so collect() can
+    # never delete it underneath us. Returns h
+    def publish(self, tmp, h):
+        p = self.path(h)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        size = os.path.getsize(tmp)
+        with self.lock:
+            if h in self.refs:
+                self.refs[h] += 1
+                os.remove(tmp)
+                return h
+
+            os.replace(tmp, p)
+            self.refs[h] = 1
+            self.dead.discard(h)
+
+        if self.levels and size >= COMPRESS_MIN:
+            self.pending.put(h)
+        return h
+
+    def compressLoop(self):
+        while True:
+            h = self.pending.get()
+            try:
+                self.compressCopies(h)
+            except OSError:
+                # The copies are only a saving, so the blob is left without them
+                pass
+
+    # Writes the compressed copies of the blob with hash h which are small enough to keep. A copy
+    # appears only while the blob is referred to, so collect() deletes it along with the blob
+    def compressCopies(self, h):
+        try:
+            m = self.open(h)
+        except OSError:
+            # Deleted meanwhile
+            return
+
+        for (encoding, level) in self.levels.items():
+            if encoding not in compressor.ENCODINGS:
+                continue
+
+            tmp = self.tempPath()
+            c = compressor.compressor(encoding, level)
+            with open(tmp, "wb") as f:
+                for i in range(0, len(m), CHUNK):
+                    f.write(c.compress(m[i:i+CHUNK]))
+                f.write(c.flush())
+                size = f.tell()
+
+            with self.lock:
+                keep = size <= len(m) * COMPRESS_RATIO and h in self.refs
+                if keep:
+                    os.replace(tmp, self.path(h) + compressor.SUFFIXES[encoding])
+            if not keep:
+                os.remove(tmp)
+
+    # Records n references to a blob already on disk, when loading a database
+    def restore(self, h, n):
+        with self.lock:
+            self.refs[h] = self.refs.get(h, 0) + n
+
+    # Drops a reference to a blob. Its file is deleted by the next collect() if nothing refers to it
+    def release(self, h):
+        with self.lock:
+            self.refs[h] -= 1
+            if self.refs[h] == 0:
+                del self.refs[h]
+                self.dead.add(h)
+
+    # Deletes the files of blobs which are no longer referred to
+    def collect(self):
+        with self.lock:
+            for h in self.dead:
+                if h in self.refs:
+                    continue
+                self.maps.pop(h, None)
+                for suffix in [""] + list(compressor.SUFFIXES.values()):
+                    try:
+                        os.remove(self.path(h) + suffix)
+                    except FileNotFoundError:
+                        pass
+            self.dead.clear()
+
+    # Deletes every file which is not referred to, such as blobs left over from a previous run, along
+    # with the compressed copies of such blobs
+    def sweep(self):
+        for d in os.listdir(self.root):
+            p = os.path.join(self.root, d)
+            if d.startswith("tmp-"):
+                os.remove(p)
+                continue
+
+            for h in os.listdir(p):
+                with self.lock:
+                    if h.split(".")[0] in self.refs:
+                        continue
+                os.remove(os.path.join(p, h))
+
+    def __contains__(self, h):
+        return h in self.refs
+
+    # Returns a read-only mapping of the blob with hash h
+    def open(self, h):
+        with self.lock:
+            try:
+                m = self.maps[h]
+                self.maps.move_to_end(h)
+                return m
+            except KeyError:
+                pass
+
+        with open(self.path(h), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with self.lock:
+            self.maps[h] = m
+            if len(self.maps) > MMAP_CACHE:
+                self.maps.popitem(last=False)
+        return m
+
+    # Returns the length of the blob with hash h
+    def size(self, h):
+        return len(self.open(h))
+
+    # Returns the contents of the blob with hash h
+    def read(self, h):
+        return self.open(h)[:]
+
+    # Returns an iterator over the contents of the blob with hash h, in chunks of CHUNK bytes. The
+    # blob is mapped straight away, so the iterator stays valid even if the blob is deleted
+    def stream(self, h):
+        m = self.open(h)
+        return (m[i:i+CHUNK] for i in range(0, len(m), CHUNK))
+
+    # Returns the size of the compressed copy in encoding of the blob with hash h, and an iterator over
+    # it in chunks of CHUNK bytes, or None if the blob has no such copy
+    def streamCompressed(self, h, encoding):
+        try:
+            with open(self.path(h) + compressor.SUFFIXES[encoding], "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (KeyError, OSError, ValueError):
+            return None
+        return (len(m), (m[i:i+CHUNK] for i in range(0, len(m), CHUNK)))
@@ -0,0 +1,33 @@
+# Blob change log for the dict database
+from array import array
+import threading
+
+# Records every creation and deletion of a blob in a single project, numbering them with a sequence
+# number that increases by one each time, starting at 1. A customer syncs by asking for the changes
+# after the last sequence number it has seen. Changes are stored in typed arrays indexed by
+# sequence number, so a page of changes costs only its length.
+class ChangeFeed:
+    def __init__(self):
+        self.blobIDs = array('q')   # The blob changed by each change, indexed by sequence number - 1
+        self.deleted = array('b')   # 1 iff that change deleted the blob
+        self.lock = threading.Lock()
+
+    # The latest sequence number, or 0 if nothing has changed
+    def __len__(self):
+        return len(self.blobIDs)
+
+    # Records that blobID was created, or deleted if deleted is true. Returns the sequence number
+    def record(self, blobID, deleted):
+        with self.lock:
+            self.blobIDs.append(int(blobID))
+            self.deleted.append(1 if deleted else 0)
+            return len(self.blobIDs)
+
+    # Returns up to limit (sequence number, blob ID, deleted) changes after sequence number seq
+    def since(self, seq, limit):
+        seq = max(seq, 0)
+        with self.lock:
+            blobIDs = self.blobIDs[seq:seq+limit]
+            deleted = self.deleted[seq:seq+limit]
+
+        return [(seq+i+1, str(b), bool(d)) for (i, (b, d)) in enumerate(zip(blobIDs, deleted))]
@@ -0,0 +1,149 @@
+# Encodings of request and response bodies
+# A request names its encoding in its Content-Type, and the encoding it wants back in its Accept
+# header. Either may be left out, in which case CBOR is used, as it always has been.
+#   application/cbor    A CBOR map
+#   application/json    A JSON object. Byte strings are sent as {"$bytes": base64}
+#   application/x-dphone-framed
+#       A CBOR header, prefixed by its length as a 4 byte big-endian integer, followed by frames
+#       holding the byte strings of at least FRAME_MIN bytes, each prefixed by its length likewise.
+#       The header holds CBOR tag FRAME_TAG with the frame's index in place of each such string.
+#       Frames may be decoded as memoryviews of the body, and are encoded as separate chunks of the
+#       response, so blobs are never copied into or out of an encoding.
+import base64, json, struct
+import cbor
+
+from header import *
+
+CBOR = "application/cbor"
+JSON = "application/json"
+FRAMED = "application/x-dphone-framed"
+FRAME_TAG = 26946   # Unassigned CBOR tag marking a frame index in the header of a framed body
+
+# True iff x holds bytes, as byte strings are decoded as bytes or as memoryviews of the body
+def isBytes(x):
+    return type(x) is bytes or type(x) is memoryview
+
+def loadsCbor(data, views=False):
+    return cbor.loads(bytes(data))
+
+def dumpsCbor(d):
+    return cbor.dumps(d)
+
+def loadsJson(data, views=False):
+    return json.loads(bytes(data), object_hook=unpackBytes)
+
+def dumpsJson(d):
+    return json.dumps(d, default=packBytes).encode("utf-8")
+
+def packBytes(o):
+    if isBytes(o):
+        return {"$bytes": base64.b64encode(o).decode("ascii")}
+    raise TypeError("Cannot encode " + type(o).__name__ + " as JSON")
+
+def unpackBytes(o):
+    if len(o) == 1 and type(o.get("$bytes")) is str:
+        return base64.b64decode(o["$bytes"])
+    return o
+
+# Decodes a framed body. Frames are memoryviews of data if views is true, and bytes otherwise
+def loadsFramed(data, views=False):
+    view = memoryview(data)
+    (n,) = struct.unpack_from(">I", view, 0)
+    head = cbor.loads(bytes(view[4:4+n]))
+    frames = []
+    i = 4 + n
+    while i < len(view):
+        (size,) = struct.unpack_from(">I", view, i)
+        if i + 4 + size > len(view):
+            raise ValueError("Frame runs past the end of the body")
+        frames.append(view[i+4:i+4+size] if views else bytes(view[i+4:i+4+size]))
+        i += 4 + size
+    return unframe(head, frames) if frames else head
+
+# Returns the framed body of d as a list of chunks
+def dumpsFramed(d):
+    frames = []
+    head = cbor.dumps(frame(d, frames))
+    chunks = [struct.pack(">I", len(head)), head]
+    for f in frames:
+        chunks.append(struct.pack(">I", len(f)))
+        chunks.append(f)
+    return chunks
+
+# Returns d with each long byte string in it moved to frames, and replaced by its index
+def frame(d, frames):
+    if isBytes(d):
+        if len(d) < FRAME_MIN:
+            return bytes(d)
+        frames.append(d)
+        return cbor.Tag(FRAME_TAG, len(frames) - 1)
+    if type(d) is dict:
+        return {k: frame(v, frames) for (k, v) in d.items()}
+    if type(d) is list or type(d) is tuple:
+        return [frame(v, frames) for v in d]
+    return d
+
+# Returns d with each frame index in it replaced by the frame
+def unframe(d, frames):
+    if type(d) is cbor.Tag and d.tag == FRAME_TAG:
+        return frames[d.value]
+    if type(d) is dict:
+        return {k: unframe(v, frames) for (k, v) in d.items()}
+    if type(d) is list:
+        return [unframe(v, frames) for v in d]
+    return d
+
+codecs = {CBOR: (loadsCbor, dumpsCbor), JSON: (loadsJson, dumpsJson), FRAMED: (loadsFramed, dumpsFramed)}
+
+# Returns the media type of a Content-Type header without its parameters, or None if it is missing
+def mediaType(header):
+    if not header:
+        return None
+    return header.split(";")[0].strip().lower()
+
+# Decodes a body sent with Content-Type contentType. Anything which is not JSON or framed is
+# taken to be CBOR, as clients have never had to name it. If views is true, byte strings may be
+# decoded as memoryviews of data, which must then stay unchanged while they are in use
+def decode(contentType, data, views=False):
+    (loads, dumps) = codecs.get(mediaType(contentType), codecs[CBOR])
+    return loads(data, views)
+
+# Returns the media type of the codec to answer a request with, given its headers: the first in
+# its Accept header which is known, or else the type it was sent in, or else default
+def negotiate(headers, default=CBOR):
+    for t in headers.get("Accept", "").split(","):
+        t = mediaType(t)
+        if t in codecs:
+            return t
+    t = mediaType(headers.get("Content-Type"))
+    return t if t in codecs else default
+
+# Encodes d as media type t. Returns bytes, or a list of chunks of bytes
+def encode(t, d):
+    (loads, dumps) = codecs[t]
+    return dumps(d)
+
+# Returns the encoding of d as media type t up to the byte string d[key], which is moved to the end,
+# so that the encoding of d is the result followed by d[key]. Returns None if t cannot end that way
+def encodeHead(t, d, key):
+    blob = d[key]
+    d = {k: v for (k, v) in d.items() if k != key}
+    if t == CBOR:
+        d[key] = b''
+        return cbor.dumps(d)[:-1] + bytesHead(len(blob))
+    if t == FRAMED and len(blob) >= FRAME_MIN:
+        d[key] = blob
+        return b"".join(dumpsFramed(d)[:-1])
+    return None
+
+# Returns the CBOR head of a byte string of n bytes
+def bytesHead(n):
+    if n < 24:
+        return bytes([0x40 + n])
+    if n < 0x100:
+        return struct.pack(">BB", 0x58, n)
+    if n < 0x10000:
+        return struct.pack(">BH", 0x59, n)
+    if n < 0x100000000:
+        return struct.pack(">BI", 0x5a, n)
+    return struct.pack(">BQ", 0x5b, n)
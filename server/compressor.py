@@ -0,0 +1,121 @@
+# Compression of request and response bodies, and of stored blobs
+# A client names the encodings it can decode in its Accept-Encoding header. A response is compressed
+# in one of them if its endpoint has levels in COMPRESS_LEVELS and it is at least COMPRESS_MIN bytes
+# long. A request may likewise be sent compressed, naming its encoding in its Content-Encoding
+# header. gzip is always available, and zstd when the zstandard module is installed.
+# A response may be a compressed head followed by a blob's stored compressed copy, so that the blob
+# need not be compressed again each time it is sent. zstd frames are simply concatenated. Some gzip
+# decoders stop after the first member, so the head and the copy's deflate stream are joined into one.
+import io, zlib, struct
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from header import *
+
+GZIP = "gzip"
+ZSTD = "zstd"
+ENCODINGS = [ZSTD, GZIP] if zstandard is not None else [GZIP]    # Available encodings, preferred first
+SUFFIXES = {GZIP: ".gz", ZSTD: ".zst"}  # Ends of the names of blob files' compressed copies
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"     # A gzip header with no name or time, from an unknown OS
+GZIP_HEADER_SIZE = len(GZIP_HEADER)
+GZIP_TRAILER_SIZE = 8   # CRC-32 and length of the contents
+
+# Returns an object whose compress(data) returns the next compressed part of data, and whose flush()
+# returns the last
+def compressor(encoding, level):
+    if encoding == GZIP:
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("Unknown encoding " + str(encoding))
+
+# Compresses data, which may be bytes or a list of chunks of bytes
+def compress(encoding, data, level):
+    c = compressor(encoding, level)
+    chunks = data if type(data) is list else [data]
+    return b"".join([c.compress(chunk) for chunk in chunks] + [c.flush()])
+
+# Returns a list of chunks holding head followed by blob, compressed in encoding, given copy, blob
+# compressed in encoding as made by compressor(). Only head is compressed here. A gzip copy's deflate
+# stream follows the head's, flushed to a byte boundary, in a single member
+def prepend(encoding, head, level, copy, blob):
+    if encoding != GZIP:
+        return [compress(encoding, head, level), copy]
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = zlib.crc32(blob, zlib.crc32(head))
+    return [GZIP_HEADER, c.compress(head) + c.flush(zlib.Z_SYNC_FLUSH), copy[GZIP_HEADER_SIZE:-GZIP_TRAILER_SIZE],
+        struct.pack("<II", crc, (len(head) + len(blob)) & 0xffffffff)]
+
+# Decompresses a body sent with Content-Encoding encoding, which may hold several members or frames.
+# Raises ValueError if it comes to more than limit bytes, unless limit is None
+def decompress(encoding, data, limit=None):
+    if not encoding or encoding.strip().lower() == "identity":
+        return data
+
+    def check(size):
+        if limit is not None and size > limit:
+            raise ValueError("Body longer than " + str(limit) + " bytes once decompressed")
+
+    encoding = encoding.strip().lower()
+    if encoding == GZIP:
+        (out, size) = ([], 0)
+        data = bytes(data)
+        while data:
+            # Asking for one byte past the limit tells a body that reaches it from one that passes it
+            d = zlib.decompressobj(31)
+            out.append(d.decompress(data) if limit is None else d.decompress(data, limit - size + 1))
+            size += len(out[-1])
+            check(size)
+            if not d.eof:
+                raise ValueError("Truncated gzip body")
+            data = d.unused_data
+        return b"".join(out)
+    if encoding == ZSTD and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+        if limit is None:
+            return reader.read()
+        (out, size) = ([], 0)
+        while True:
+            chunk = reader.read(limit - size + 1)
+            if not chunk:
+                return b"".join(out)
+            out.append(chunk)
+            size += len(chunk)
+            check(size)
+    raise ValueError("Unknown encoding " + encoding)
+
+# Returns the encoding to send a response in, of those in offered, given the request's
+# Accept-Encoding header: the one the client rates highest, or the first in ENCODINGS of those it
+# rates equally. Returns None if the client accepts none of them
+def negotiate(header, offered):
+    if not header:
+        return None
+
+    rates = {}
+    for item in header.split(","):
+        (name, sep, params) = item.partition(";")
+        q = 1
+        for param in params.split(";"):
+            (k, sep, v) = param.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0
+        rates[name.strip().lower()] = q
+
+    best = None
+    for encoding in ENCODINGS:
+        q = rates.get(encoding, rates.get("*", 0))
+        if encoding in offered and q > 0 and (best is None or q > rates.get(best, rates.get("*", 0))):
+            best = encoding
+    return best
+
+# Returns (encoding, level) to compress a response of size bytes from endpoint in, given the
+# request's Accept-Encoding header, or (None, 0) if it is to be sent as it is
+def choose(header, endpoint, size):
+    levels = COMPRESS_LEVELS.get(endpoint, {})
+    encoding = negotiate(header, levels) if size >= COMPRESS_MIN else None
+    return (encoding, levels.get(encoding, 0))
@@ -4,18 +4,24 @@
 # Test implementation
 from datetime import datetime
 from time import mktime
-from Crypto.Random import random
-import numpy as np
-import string
+import threading, time
 import cbor
 import re
 
 from header import *
+from dispatch import TaskQueue, ResultFeed, parseTask, isLarge, isConstrained
+from blobstore import BlobStore
+from sessions import SessionStore
+from timeseries import TimeSeries
+from changefeed import ChangeFeed
+from journal import Journal
+from scheduler import FairScheduler
+from batching import BatchSizer
+from verify import Verifier, agreement, judge
 
 def changeGraph(pID, graphname, diff):
-    graphs = projects[pID]["graphing"]["standardGraphs"]
-    lastActive = graphs[graphname][-1:][0]["y"]
-    graphs[graphname].append({"x": getTime(), "y": lastActive+diff})
+    with projects[pID]["lock"]:
+        mutate("graph", pID, graphname, diff, getTime())
 
 def getTime():
     return int(mktime(datetime.now().timetuple()))*1000
@@ -23,45 +29,43 @@ def getTime():
 def salthash(passwd, salt):
     return passwd
 
-def generateToken():
-    done = False
-    while not done:
-        tok = ''.join(random.choice(string.ascii_letters) for m in range(TOKENSIZE))
-        done = tok not in sessions
-
-    return tok
-
 users = {}	# Maps username to (password, accesslevel)
-sessions = {}   # Maps a username to a session
-                # Session comtains username, bool active, accesslevel. token, time
+sessions = SessionStore()   # Maps tokens to sessions, and usernames to their tokens
 projects = {}   # Maps project names to projects
+lock = threading.Lock()     # Guards adding users and projects. Each project has its own lock for its contents
+store = BlobStore(BLOBSTORE_PATH, BLOB_COMPRESS_LEVELS)   # Holds the contents of every blob, keyed by hash
+journal = Journal(JOURNAL_PATH)     # Logs every change, so that the database survives a restart
+userslsn = 0    # LSN of the last logged change to users and sessions
+scheduler = FairScheduler()     # Picks the project a worker asking for any tasks is given
+smallScheduler = FairScheduler()    # Likewise for workers only given small tasks, among projects with small tasks waiting
+batches = BatchSizer()  # Measures how fast each worker completes tasks
+verifier = Verifier()   # Picks the completed tasks whose results are checked
 
 ## AUTHENTICATION ##
-# Registers a new user in the database. Returns true iff successful
-def register(username, password, accesslevel):
-    if username in users:
-        return False
-    else:
-        users[username] = {"hashpass": salthash(password, username), "accesslevel": accesslevel, "issuedTasks": {}}
-        return True
+# Registers a new user in the database. A worker's preferences say whether it would rather save
+# mobile data and battery than be given large tasks. Returns true iff successful
+def register(username, password, accesslevel, prefwifidata=True, prefbattery=True):
+    with lock:
+        if username in users:
+            return False
+        else:
+            mutate("register", None, username, salthash(password, username), accesslevel, prefwifidata, prefbattery)
+            return True
 
-# Returns whether the username corresponds to the password of a user, of level accesslevel
-def login(username, password, accesslevel):
+# Returns whether the username corresponds to the password of a user, of level accesslevel. The
+# new session is given token if one is passed
+def login(username, password, accesslevel, token=None):
     if username in users:
     # Test for correct credentials
         if users[username]["hashpass"] == salthash(password, username) and users[username]["accesslevel"] == accesslevel:
             # Create a new session
-            token = generateToken()
-            sessions[token] = {}
-
-            s = sessions[token]
-            t = getTime()
-            s["username"] = username
-            s["starttime"] = t
-            s["accesslevel"] = accesslevel
+            with lock:
+                if token is None:
+                    token = sessions.generateToken()
+                mutate("session", None, token, username, accesslevel, getTime())
 
             # Graphing
-            for pname in users[username]["issuedTasks"]:
+            for pname in list(users[username]["issuedTasks"]):
                 changeGraph(pname, "activeWorkers", 1)
 
             return (True, token)
@@ -69,241 +73,754 @@ def login(username, password, accesslevel):
 
 def logoutGraphUpdate(username):
             # Graphing
-            for pname in users[username]["issuedTasks"]:
+            for pname in list(users[username]["issuedTasks"]):
                 # Remove active user for each project
                 changeGraph(pname, "activeWorkers", -1)
 
 
 ## Allows extraction of the user from currently active sessions. This should be cached in front of the database
 def querySession(token, query):
-    if query not in ["username", "starttime", "accesslevel", "issuedTasks"]:
+    if query not in ["username", "starttime", "accesslevel"]:
         return (False, 0)
     
     if token not in sessions:
         return (False, 0)
     
-    return (True, sessions[token][query])
+    return (True, sessions.sessions[token][query])
+
+# Returns the session of token if it is active. The session is a dict holding username, accesslevel
+# and starttime
+def getSession(token):
+    s = sessions.get(token, getTime())
+    if s is None:
+        return (False, "Session expired or invalid token")
+
+    return (True, s)
     
+# Records the device hints reported by the worker holding session token. They last as long as the session
+def setDevice(token, device):
+    s = sessions.get(token, getTime())
+    if s is not None:
+        s["device"] = device
+
+# True iff username may be given large tasks, given the device hints it reported and its preferences
+def takesLargeTasks(username, device):
+    user = users.get(username)
+    if user is None:
+        return True
+    return not isConstrained(device, user["prefwifidata"], user["prefbattery"])
+
 # Deletes the session
 def deleteSession(data, kind):
     if kind == "token":
-        if data not in sessions:
-            return False
-        else:
-            del sessions[data]
+        with lock:
+            if data not in sessions:
+                return False
+            mutate("endSession", None, data)
             return True
     elif kind == "username":
-        result = False
-        for i, (token, sesh) in enumerate(sessions.items()):
-            # If the user curently has an active session, destroy the session
-            if sesh["username"] == data:
-                result = True
-                del sessions[token]
-                # Update graphs that this user is no longer active
-                for pname in users[data]["issuedTasks"]:
-                    changeGraph(pname, "activeWorkers", -1)
-                break
-
-        return result
+        # If the user curently has an active session, destroy the session
+        with lock:
+            tokens = list(sessions.tokens.get(data, ()))
+            for token in tokens:
+                mutate("endSession", None, token)
+        if not tokens:
+            return False
+
+        # Update graphs that this user is no longer active
+        for pname in list(users[data]["issuedTasks"]):
+            changeGraph(pname, "activeWorkers", -1)
+        return True
     else:
         return False
 
+# Deletes expired sessions, oldest first, and updates graphs that their users are no longer active
+def reapSessions():
+    with lock:
+        expired = sessions.reap(getTime())
+        # Logged so that replay deletes them too
+        for s in expired:
+            mutate("endSession", None, s["token"])
+
+    for s in expired:
+        logoutGraphUpdate(s["username"])
+
+def sessionReaper():
+    while True:
+        time.sleep(SESSION_REAP_INTERVAL / 1000)
+        reapSessions()
+
 ## CUSTOMER METHODS ##
 # Creates a new project on behalf of customer username. The project is called pname, has
 # description pdescription, and is initialised in the database. It is given it a unique project
 # ID (pID) which is returned, along with whether the operation was successful
 
 def createNewProject(pname, pdescription):
-    if pname in projects:
-        return False
-    # No other project by this user has the given name
-    
-    projects[pname] = {"blobs": {}, "blobids": 0,  "unfinishedTasks": [], "description": pdescription, "graphing":{
+    with lock:
+        if pname in projects:
+            return False
+        # No other project by this user has the given name
+        mutate("project", pname, pdescription, getTime())
+        return True
+
+# Returns the state of a new project, created at time now. Its lock guards its blobs and task queue,
+# and lsn is the LSN of the last logged change to it
+def newProject(pdescription, now):
+    return {"blobs": {}, "blobids": 0, "blobbytes": 0, "lock": threading.RLock(), "lsn": 0, "weight": 1, "verify": VERIFY_RATE, "checks": {}, "tasks": TaskQueue(), "results": ResultFeed(), "changes": ChangeFeed(), "description": pdescription, "graphing":{
         "standardGraphs": {
-            "activeWorkers":    [{"x": getTime(), "y": 0}],
-            "totalWorkers":     [{"x": getTime(), "y": 0}],
-            "tasksCompleted":   [{"x": getTime(), "y": 0}],
-            "tasksFailed":      [{"x": getTime(), "y": 0}],
-            "tasksRefused":     [{"x": getTime(), "y": 0}],
-            "cpuTime":          [{"x": getTime(), "y": 0}]
+            "activeWorkers":    TimeSeries(now),
+            "totalWorkers":     TimeSeries(now),
+            "tasksCompleted":   TimeSeries(now),
+            "tasksFailed":      TimeSeries(now),
+            "tasksRefused":     TimeSeries(now),
+            "cpuTime":          TimeSeries(now)
         },
-        "customGraphs": {}
+        "customGraphs": {},
+        "versions": {"standardGraphs": 0, "customGraphs": 0}   # Bumped whenever a graph changes
     }}
-    return True
 
 # Creates a new blob, and stores it along with its metadata
 def createNewBlob(pID, blob, metadata):
     # Check that the project exists
     try:
-        test = projects[pID]
+        p = projects[pID]
     except Exception:
         return (False, 0)
 
-    # Create the new blob
-    p = projects[pID]
-    bID = str(p["blobids"])
-    p["blobids"] += 1
+    h = store.put(blob)
+    with p["lock"]:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            store.release(h)
+            return (False, 0)
+        return (True, addBlob(pID, h, len(blob), metadata))
 
-    p["blobs"][bID] = {"blob": blob, "metadata": metadata, "task": False, "finished": False}
+# Creates a new blob from size bytes read in chunks from read(n), without holding it all in memory
+def createNewBlobStream(pID, read, size, metadata):
+    # Check that the project exists
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Failed to find project")
 
-    return (True, bID)
+    try:
+        (h, size) = store.putStream(read, size)
+    except Exception as e:
+        return (False, "Failed to store blob: " + str(e))
+
+    with p["lock"]:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            store.release(h)
+            return (False, "Failed to find project")
+        return (True, addBlob(pID, h, size, metadata))
+
+# Gives the blob with hash h and its metadata a new blob ID in project pID, which is returned. Must
+# be called with the project's lock held
+def addBlob(pID, h, size, metadata):
+    bID = str(projects[pID]["blobids"])
+    mutate("blob", pID, bID, h, size, metadata)
+    return bID
 
 # Convert blob blobID in project pID into a task, which is stored in the list of unfinished tasks
 def blobToTask(pID, blobID):
     try:
-        test = projects[pID]["blobs"][blobID]
+        b = projects[pID]["blobs"][blobID]
     except Exception:
         return (False, "Failed to find blob")
 
-
     # Test whether the blob actually is a task
-    try:
-        task = cbor.loads(projects[pID]["blobs"][blobID]["blob"])
-        valid = True
-        valid = valid and type(task["program"]["id"]) is str
-        valid = valid and type(task["program"]["size"]) is int
-        valid = valid and type(task["control"]) is bytes
-        
-        for blob in task["blobs"]:
-            test = blob["id"]
-            valid = valid and type(blob["size"]) is int
-    except Exception:
-        return (False, "Blob is not a correctly formatted task")
+    (succ, task) = parseTask(store.read(b["hash"]))
+    if not succ:
+        return (False, task)
 
-    if not valid:
-        return (False, "Blob not a valid task")
+    with projects[pID]["lock"]:
+        # The blob still exists within the project
+        if projects[pID]["blobs"].get(blobID) is not b:
+            return (False, "Failed to find blob")
 
-    # The blob exists within the project
-    projects[pID]["blobs"][blobID]["task"] = True
-    
-
-    # Push a copy onto the queue of "to-do" tasks
-    projects[pID]["unfinishedTasks"].append(blobID)
+        # Push it onto the queue of "to-do" tasks
+        mutate("task", pID, blobID, isLarge(task))
 
     return (True, "")
 
-# Return a dict mapping blobs IDs to their metadata. Can optionally specity a list of blobs
-# whose metadata we'd like
-def getBlobMetadata(pID, blobIDs):
+## BATCH METHODS ##
+# Creates a blob for each of blobs, with the corresponding metadata. If totask is true, each blob
+# is also checked and converted into a task. Returns a list holding (True, blobID) or
+# (False, error message) for each blob
+def createNewBlobs(pID, blobs, metadatas, totask):
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Failed to find project")
+
+    # Check and store the blobs first, so that the project is only locked to add them
+    stored = []
+    for (blob, metadata) in zip(blobs, metadatas):
+        large = False
+        if totask:
+            (succ, task) = parseTask(blob)
+            if not succ:
+                stored.append(task)
+                continue
+            large = isLarge(task)
+        stored.append((store.put(blob), len(blob), metadata, large))
+
+    results = []
+    with p["lock"]:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            for s in stored:
+                if type(s) is not str:
+                    store.release(s[0])
+            return (False, "Failed to find project")
+
+        for s in stored:
+            if type(s) is str:
+                results.append((False, s))
+                continue
+
+            bID = addBlob(pID, *s[:3])
+            if totask:
+                mutate("task", pID, bID, s[3])
+            results.append((True, bID))
+
+    return (True, results)
+
+# Converts each of blobIDs into a task. Returns a list of (success, error message) for each blob
+def blobsToTasks(pID, blobIDs):
     try:
-        test = projects[pID]
+        p = projects[pID]
     except Exception:
         return (False, "Failed to find project")
 
+    # Check every blob first, so that the project is locked once, only to make the whole batch tasks
+    checked = []
+    for blobID in blobIDs:
+        b = p["blobs"].get(blobID)
+        if b is None:
+            checked.append("Failed to find blob")
+            continue
+        (succ, task) = parseTask(store.read(b["hash"]))
+        checked.append((b, isLarge(task)) if succ else task)
+
+    results = []
+    with p["lock"]:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            return (False, "Failed to find project")
+
+        for (blobID, c) in zip(blobIDs, checked):
+            if type(c) is str:
+                results.append((False, c))
+            elif p["blobs"].get(blobID) is not c[0]:
+                # Deleted meanwhile
+                results.append((False, "Failed to find blob"))
+            else:
+                mutate("task", pID, blobID, c[1])
+                results.append((True, ""))
+
+    return (True, results)
+
+# Return a dict mapping blobs IDs to their metadata. Can optionally specity a list of blobs
+# whose metadata we'd like. Otherwise returns a page of up to limit blobs after blob ID after, and
+# the blob ID to pass as after for the next page, or None if this is the last
+def getBlobMetadata(pID, blobIDs, after=-1, limit=PAGE_SIZE):
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Failed to find project", None)
+
+    blobs = p["blobs"]
+    if blobIDs != []:
+        metas = {}
+        for blobID in set(blobIDs):
+            b = blobs.get(blobID)
+            if b is not None:
+                metas[blobID] = b["metadata"]
+        return (True, metas, None)
+
+    # Page through the whole project in blob ID order, after blob ID after
     metas = {}
-    for blobID, blob in projects[pID]["blobs"].items():
-        if blobIDs == [] or blobID in blobIDs:
-            metas[blobID] = blob["metadata"]
+    for bID in range(max(after+1, 0), p["blobids"]):
+        b = blobs.get(str(bID))
+        if b is not None:
+            metas[str(bID)] = b["metadata"]
+            if len(metas) == limit:
+                return (True, metas, bID)
+
+    return (True, metas, None)
+
+# Returns up to limit changes to the blobs of project pID after sequence number seq, and the latest
+# sequence number. Each change is a dict holding seq, blobID, deleted, and the metadata of blobs
+# which still exist
+def getChanges(pID, seq, limit):
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Failed to find project", 0)
+
+    changes = []
+    for (s, blobID, deleted) in p["changes"].since(seq, limit):
+        b = p["blobs"].get(blobID)
+        changes.append({"seq": s, "blobID": blobID, "deleted": deleted,
+            "metadata": b["metadata"] if b is not None else None})
+
+    return (True, changes, len(p["changes"]))
+
+# Waits up to timeout milliseconds for result blobs created after blob ID cursor. Returns a list of
+# up to limit (blob ID, metadata) pairs, oldest first, which is empty if none arrived in time, and
+# the cursor to pass next
+def waitForResults(pID, cursor, timeout, limit):
+    try:
+        feed = projects[pID]["results"]
+    except Exception:
+        return (False, "Failed to find project", cursor)
+
+    blobs = projects[pID]["blobs"]
+    results = []
+    for blobID in feed.wait(cursor, limit, timeout):
+        cursor = int(blobID)
+        # Skip results the customer has already deleted
+        b = blobs.get(blobID)
+        if b is not None:
+            results.append((blobID, b["metadata"]))
 
-    return (True, metas)
+    return (True, results, cursor)
 
 # Return blob blobID from project pID, along with its metadata
 def getBlob(pID, blobID):
     try:
         b = projects[pID]["blobs"][blobID]
     except Exception:
-        return (False, str(projects[pID]["blobs"][blobID]), 0)
+        return (False, "Failed to find blob", 0)
     
-    return (True, b["blob"], b["metadata"])
+    return (True, store.read(b["hash"]), b["metadata"])
+
+# Return the size of blob blobID from project pID, an iterator over its contents in chunks, and its metadata
+def streamBlob(pID, blobID):
+    try:
+        b = projects[pID]["blobs"][blobID]
+    except Exception:
+        return (False, "Failed to find blob", 0, 0)
+
+    return (True, b["size"], store.stream(b["hash"]), b["metadata"])
+
+# Returns the size of the stored blob with hash h, and an iterator over its contents in chunks.
+# Whichever blob it belongs to, the contents named by a hash never change
+def streamHash(h):
+    if h not in store:
+        return (False, "Failed to find blob", 0)
+
+    try:
+        return (True, store.size(h), store.stream(h))
+    except OSError:
+        # Deleted since it was checked
+        return (False, "Failed to find blob", 0)
+
+# Returns the size of the stored copy of the blob with hash h compressed in encoding, and an
+# iterator over it in chunks, if the blob has one
+def streamCompressedHash(h, encoding):
+    copy = store.streamCompressed(h, encoding) if h in store else None
+    if copy is None:
+        return (False, "No compressed copy", 0)
+    return (True, copy[0], copy[1])
+
+# Returns the stored copy of blob blobID from project pID compressed in encoding, if it has one
+def getCompressedBlob(pID, blobID, encoding):
+    try:
+        h = projects[pID]["blobs"][blobID]["hash"]
+    except Exception:
+        return (False, "Failed to find blob")
+
+    copy = store.streamCompressed(h, encoding)
+    if copy is None:
+        return (False, "No compressed copy")
+    return (True, b"".join(copy[1]))
+
+# Returns a dict mapping the program blob ID of each of the task blobs tasks to its hash and size
+def getPrograms(pID, tasks):
+    try:
+        blobs = projects[pID]["blobs"]
+    except Exception:
+        return (False, "Failed to find project")
+
+    programs = {}
+    for t in tasks:
+        (succ, task) = parseTask(t)
+        if not succ:
+            continue
+        programID = task["program"]["id"]
+        b = blobs.get(programID)
+        if b is not None:
+            programs[programID] = {"hash": b["hash"], "size": b["size"]}
+
+    return (True, programs)
+
+# Returns the contents of the input blobs of the task blobs tasks, each blob once, for as long as
+# their total size fits within budget bytes, and a list of the IDs of the input blobs left over
+def getInputBlobs(pID, tasks, budget):
+    try:
+        blobs = projects[pID]["blobs"]
+    except Exception:
+        return (False, "Failed to find project", [])
+
+    inline = {}
+    deferred = []
+    for t in tasks:
+        (succ, task) = parseTask(t)
+        if not succ:
+            continue
+        for ref in task["blobs"]:
+            blobID = str(ref["id"])
+            if blobID in inline or blobID in deferred:
+                continue
+            b = blobs.get(blobID)
+            if b is None:
+                continue
+            if b["size"] <= budget:
+                inline[blobID] = store.read(b["hash"])
+                budget -= b["size"]
+            else:
+                deferred.append(blobID)
+
+    return (True, inline, deferred)
 
 # Deletes blob blobID from project pID, returns if successful
 def deleteBlob(pID, blobID):
     try:
-        b = projects[pID]["blobs"][blobID]
+        p = projects[pID]
     except Exception:
         return (False, "Could not fetch blobs")
 
-    del projects[pID]["blobs"][blobID]
+    with p["lock"]:
+        if blobID not in p["blobs"]:
+            return (False, "Could not fetch blobs")
+        mutate("delete", pID, blobID)
+
+    store.collect()
     return (True, "")
 
 
 ## WORKER METHODS ##
 
-# Returns a unique identifier for a task from the tasklist for the worker to get on with
-def getTasks(pID, username, maxtasks):
+# Returns a unique identifier for a task from the tasklist for the worker to get on with. Large
+# tasks are given first if large is true, and not at all otherwise
+def getTasks(pID, username, maxtasks, large=True):
     try:
         b = projects[pID]
     except Exception:
         return (False, "Project does not exist. Projects: " + str(projects), 0)
 
-    # Test if the unfinished tasks array has been constructed
+    with b["lock"]:
+        # Test if the issued tasks set has been constructed
+        if pID not in users[username]["issuedTasks"]:
+            # This is a first-time active user
+            changeGraph(pID, "totalWorkers", 1)
+            changeGraph(pID, "activeWorkers", 1)
+            mutate("worker", pID, username)
+
+        # Reissue tasks whose leases have run out, then take new tasks off the front of the ready
+        # queue. A worker faster than the straggler time may be given spare copies of stragglers
+        speculate = batches.isFaster(username, b["tasks"].stragglerTime())
+        taskIDs = mutate("issue", pID, username, maxtasks, getTime(), large, speculate)
+        hashes = [b["blobs"][t]["hash"] for t in taskIDs]
+    scheduler.charge(pID, len(taskIDs))
+    smallScheduler.charge(pID, len(taskIDs))
+    batches.issue(username, len(taskIDs))
+
+    # Read the associated blob of each task without holding the lock
     try:
-        users[username]["issuedTasks"][pID]
-    except Exception:
-        # This is a first-time active user
-        changeGraph(pID, "totalWorkers", 1)
-        users[username]["issuedTasks"][pID] = []
-        
-
-    if users[username]["issuedTasks"][pID] == []:
-        # This is a first time user on this task
-        changeGraph(pID, "activeWorkers", 1)
-
-    # Find new tasks to be done
-    taskIDs = list(map(str, np.setdiff1d(projects[pID]["unfinishedTasks"], users[username]["issuedTasks"][pID]) [:maxtasks]))
-
-    #unf = projects[pID]["unfinishedTasks"]
-    #taskID = unf.pop(0)
-    #unf.append(taskID)
-
-    # Find the associated blob with each task ID
-    tasks = []
-    for t in taskIDs:
-        (succ, b, m) = getBlob(pID, t)
-        if not succ:
-            return (False, "Task collection error: " + str(b), 0)
-        tasks.append(b)
-
-    users[username]["issuedTasks"][pID] = users[username]["issuedTasks"][pID] + taskIDs
+        tasks = [store.read(h) for h in hashes]
+    except OSError as e:
+        return (False, "Task collection error: " + str(e), 0)
 
     return (True, tasks, taskIDs)
 
-# Stores the list of blobs in the database, along with the metadata
+# Issues up to maxtasks tasks to username from whichever project the scheduler picks, taking large
+# tasks only if large is true. Returns the name of the project, or None if no project has tasks
+# waiting, along with the tasks and their IDs
+def scheduleTasks(username, maxtasks, large=True):
+    chooser = scheduler if large else smallScheduler
+    passed = set()
+    while maxtasks > 0:
+        pID = chooser.next(getTime())
+        if pID is None:
+            return (True, None, [], [])
+
+        (succ, tasks, taskIDs) = getTasks(pID, username, maxtasks, large)
+        if not succ:
+            if pID in projects:
+                return (False, tasks, None, 0)
+            # Dropped meanwhile
+            chooser.remove(pID)
+            continue
+        if taskIDs:
+            return (True, pID, tasks, taskIDs)
+
+        # Nothing is waiting, so look again once a lease it issued may have run out
+        p = projects.get(pID)
+        if p is not None:
+            with p["lock"]:
+                queue = p["tasks"]
+                if queue.waiting(True) == 0:
+                    scheduler.sleep(pID, queue.nextWake(getTime()))
+                if queue.waiting(False) == 0:
+                    smallScheduler.sleep(pID, queue.nextWake(getTime()))
+
+                # Only tasks username already ran are waiting, for other workers to check, so
+                # count a task against the project and look at the others
+                if queue.waiting(large) > 0:
+                    if pID in passed:
+                        break
+                    passed.add(pID)
+                    chooser.charge(pID, 1)
+
+    return (True, None, [], [])
+
+# Returns how many tasks username should ask for at once to poll about every BATCH_INTERVAL, or None
+# if it has not yet completed a batch
+def suggestBatch(username):
+    return batches.suggest(username)
+
+# Stores the list of blobs in the database, along with the metadata. A sample of completed tasks
+# is run again by another worker, and their results are only stored once two runs agree
 def sendTasks(pID, taskID, results, metadatas, username, status):
     try:
-        b = projects[pID]["blobs"][taskID]
+        p = projects[pID]
     except Exception:
         return (False, "Task does not exist")
-    
-    # Test that this phone completed tasks it was supposed to
 
-    if not taskID in users[username]["issuedTasks"][pID]:
-        return (False, "Task was not scheduled. Scheduled tasks: " + str(users[username]["issuedTasks"]))
+    if not status in ["ok", "error", "refused"]:
+        return (False, "Invalid error code")
+
+    queue = p["tasks"]
+    with p["lock"]:
+        b = p["blobs"].get(taskID)
+        if b is None:
+            return (False, "Task does not exist")
+
+        # Another copy of the task completed first, so this result is not needed
+        if queue.isSuperseded(taskID, username):
+            batches.report(username, status == "ok")
+            return (True, "")
+
+        # Test that this phone completed tasks it was supposed to
+        if not queue.isIssued(taskID, username):
+            return (False, "Task was not scheduled: " + str(taskID))
+
+        # Results of tasks being checked are held until they can be compared
+        check = status == "ok" and (taskID in p["checks"] or verifier.sample(username, p["verify"]))
+
+        # If status is ok, take the old task off the task list. Otherwise give the task back, to
+        # this worker or someone else
+        if not check:
+            mutate("finish", pID, taskID, status, username, getTime())
+    batches.report(username, status == "ok")
+
+    if check:
+        hashes = [store.put(blob) for blob in results]
+        with p["lock"]:
+            # The lease ran out while the results were stored
+            if not queue.isIssued(taskID, username):
+                for h in hashes:
+                    store.release(h)
+                store.collect()
+                return (False, "Task was not scheduled: " + str(taskID))
+
+            blobIDs = mutate("check", pID, taskID, username, hashes, [len(blob) for blob in results], metadatas, getTime())
+        if blobIDs is not None:
+            changeGraph(pID, "tasksCompleted", 1)
 
     # If status is ok, count the task as completed
-    if status == "ok":
-        # Take the old task off the task list
-        for i, bID in enumerate(projects[pID]["unfinishedTasks"]):
-            if bID == taskID:
-                del projects[pID]["unfinishedTasks"][i]
-                break
-
-        # Create all the new blobs
-        for (blob, meta) in zip(results, metadatas):
-            createNewBlob(pID, blob, meta)
-        
+    elif status == "ok":
+        # Create all the new blobs, and wake customers waiting for them
+        blobIDs = [createNewBlob(pID, blob, meta)[1] for (blob, meta) in zip(results, metadatas)]
+        with p["lock"]:
+            mutate("results", pID, blobIDs)
+
         # Update graphing info
         changeGraph(pID, "tasksCompleted", 1)
 
     # If status is error, we can give the task back later
     elif status == "error":
-        users[username]["issuedTasks"][pID].remove(taskID)
         changeGraph(pID, "tasksFailed", 1)
 
-    # If status is refused, we will eventually give the task to someone else
+    # If status is refused, give the task to someone else
     elif status == "refused":
         changeGraph(pID, "tasksRefused", 1)
-    else:
-        return (False, "Invalid error code")
-        
+
+    return (True, "")
+
+# Extends the leases username holds on each of taskIDs. Returns the list of task IDs renewed
+def renewLeases(pID, username, taskIDs):
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Project does not exist")
+
+    with p["lock"]:
+        renewed = mutate("renew", pID, username, taskIDs, getTime())
+
+    return (True, renewed)
+
+## PROJECT METHODS
+# Returns a dict mapping each project name to its public details: its description, its share of
+# workers asking for any project, the share of its tasks checked, and the number of its tasks waiting
+def getProjectsList():
+    with lock:
+        return {pname: {"description": p["description"], "weight": p["weight"], "verify": p["verify"], "waiting": len(p["tasks"])}
+            for pname, p in projects.items()}
+
+# Returns the gauges of the metrics endpoint: the number of live sessions, and for each project the
+# tasks waiting and issued, the total size of its blobs and the points held in its graphs
+def getMetrics():
+    with lock:
+        names = list(projects.items())
+    gauges = {}
+    for (pname, p) in names:
+        with p["lock"]:
+            gauges[pname] = {"waiting": len(p["tasks"]), "issued": len(p["tasks"].owners), "spares": len(p["tasks"].spares),
+                "blobBytes": p["blobbytes"],
+                "graphPoints": sum(series.size() for series in p["graphing"]["standardGraphs"].values())}
+    return {"sessions": len(sessions), "projects": gauges}
+
+def getDescription(pname):
+    if not pname in projects:
+        return (False, "Invalid project name")
+
+    return (True, projects[pname]["description"])
+
+# Sets the weight of project pname, which is its share of the workers asking for tasks from any
+# project relative to other projects
+def setProjectWeight(pname, weight):
+    try:
+        p = projects[pname]
+    except Exception:
+        return (False, "Invalid project name")
+
+    with p["lock"]:
+        mutate("weight", pname, weight)
+    return (True, "")
+
+# Sets the share of the completed tasks of project pname which are run again by another worker to
+# check their results. Workers whose results have disagreed have more of their tasks checked
+def setVerifyRate(pname, rate):
+    try:
+        p = projects[pname]
+    except Exception:
+        return (False, "Invalid project name")
+
+    with p["lock"]:
+        mutate("verify", pname, rate)
+    return (True, "")
+
+## MIGRATION METHODS
+# Used by router.py to move projects and users between servers
+
+# Returns everything in project pname as plain values: its blobs, the contents of each distinct
+# blob once, its task queue, results, changes and graphs, and the workers who have worked on it
+def exportProject(pname):
+    try:
+        p = projects[pname]
+    except Exception:
+        return (False, "Invalid project name")
+
+    with p["lock"]:
+        dump = dumpProject(pname, p)
+
+    # Results held for checking are not moved. The tasks are run and checked again instead
+    dump.pop("checks")
+    try:
+        dump["contents"] = {b[1]: store.read(b[1]) for b in dump["blobs"]}
+    except OSError as e:
+        return (False, "Failed to read blob: " + str(e))
+
+    return (True, dump)
+
+# Creates project pname from an exportProject() dump
+def importProject(pname, dump):
+    if pname in projects:
+        return (False, "Project already exists")
+
+    try:
+        contents = dump.pop("contents")
+        for (bID, h, size, metadata, task, finished) in dump["blobs"]:
+            test = contents[h]
+    except Exception:
+        return (False, "Invalid project dump")
+
+    # Store each distinct blob once, with a reference for every blob ID
+    stored = set()
+    for b in dump["blobs"]:
+        if b[1] in stored:
+            store.restore(b[1], 1)
+        else:
+            b[1] = store.put(contents[b[1]])
+            stored.add(b[1])
+
+    with lock:
+        if pname in projects:
+            # Created meanwhile
+            for b in dump["blobs"]:
+                store.release(b[1])
+            store.collect()
+            return (False, "Project already exists")
+
+        mutate("import", pname, dump)
+        return (True, "")
+
+# Deletes project pname, and every blob in it
+def dropProject(pname):
+    with lock:
+        p = projects.get(pname)
+        if p is None:
+            return (False, "Invalid project name")
+        with p["lock"]:
+            mutate("drop", pname)
+
+    store.collect()
+    return (True, "")
+
+# Returns every user and session as plain values
+def exportUsers():
+    with lock:
+        return (True, dumpUsers())
+
+# Adds the users and sessions of an exportUsers() dump which are not already held
+def importUsers(dump):
+    try:
+        with lock:
+            for (username, hashpass, accesslevel, *prefs) in dump["users"]:
+                if username not in users:
+                    mutate("register", None, username, hashpass, accesslevel, *prefs)
+            for (token, username, accesslevel, starttime) in dump["sessions"]:
+                if token not in sessions:
+                    mutate("session", None, token, username, accesslevel, starttime)
+    except Exception as e:
+        return (False, "Invalid users dump: " + str(e))
+
     return (True, "")
 
 ## GRAPHING METHODS
-def getGraphs(pname, kind):
+# Returns the graphs of kind. Standard graphs are read at a precision of prec milliseconds, from
+# the interval holding time since onwards
+def getGraphs(pname, kind, prec, since=0):
     if not pname in projects:
         return (False, "Invalid project name")
 
-    return (True, projects[pname]["graphing"][kind])
+    graphs = projects[pname]["graphing"][kind]
+    if kind == "standardGraphs":
+        graphs = {name: series.points(prec, since) for (name, series) in graphs.items()}
+    return (True, graphs)
+
+# Returns the version of the graphs of kind, which changes whenever they do. Read it before the
+# graphs themselves
+def getGraphsVersion(pname, kind):
+    if not pname in projects:
+        return (False, "Invalid project name")
+
+    return (True, projects[pname]["graphing"]["versions"][kind])
 
 # GraphsData is of the graphsCBOR type, as documented in api.txt
 def updateCustomGraphs(graphsData, pname):
@@ -345,7 +862,301 @@ def updateCustomGraphs(graphsData, pname):
     """
 
     # Save the new custom graph
-    projects[pname]["graphing"]["customGraphs"] = graphsData
+    with projects[pname]["lock"]:
+        mutate("customGraphs", pname, graphsData)
 
     return (True, "")
 
+
+## PERSISTENCE ##
+# Every change to users, sessions and projects is made by mutate(), which logs it to the journal
+# before applying it, so that recover() can make it again after a restart. Changes to users and
+# sessions are made holding the module lock, and changes to a project holding its lock, so that the
+# journal holds them in the order they were made. Each change is one of the operations below, which
+# must depend only on their arguments and the state, never on the time or on the blob store
+
+# Logs and makes a change, which is applied to project scope, or to users and sessions if scope is
+# None. Returns the result of the operation
+def mutate(op, scope, *args):
+    lsn = journal.append([op, scope] + list(args))
+    return apply(lsn, op, scope, args)
+
+def apply(lsn, op, scope, args):
+    global userslsn
+    if scope is None:
+        result = operations[op](*args)
+        userslsn = lsn
+    else:
+        result = operations[op](scope, *args)
+        if scope in projects:
+            projects[scope]["lsn"] = lsn
+    return result
+
+def opRegister(username, hashpass, accesslevel, prefwifidata=True, prefbattery=True):
+    users[username] = {"hashpass": hashpass, "accesslevel": accesslevel, "prefwifidata": prefwifidata,
+        "prefbattery": prefbattery, "issuedTasks": {}}
+
+def opSession(token, username, accesslevel, now):
+    sessions.create(username, accesslevel, now, token)
+
+def opEndSession(token):
+    return sessions.delete(token)
+
+def opProject(pname, pdescription, now):
+    projects[pname] = newProject(pdescription, now)
+
+def opBlob(pname, bID, h, size, metadata):
+    p = projects[pname]
+    p["blobids"] = max(p["blobids"], int(bID) + 1)
+    p["blobs"][bID] = {"hash": h, "size": size, "metadata": metadata, "task": False, "finished": False}
+    p["blobbytes"] += size
+    p["changes"].record(bID, False)
+
+def opTask(pname, bID, large=False):
+    p = projects[pname]
+    p["blobs"][bID]["task"] = True
+    p["tasks"].push(bID, large)
+    wake(pname, large)
+
+def opDelete(pname, bID):
+    p = projects[pname]
+    b = p["blobs"].pop(bID)
+    p["blobbytes"] -= b["size"]
+    p["tasks"].discard(bID)
+    p["changes"].record(bID, True)
+    store.release(b["hash"])
+    for run in p["checks"].pop(bID, []):
+        for h in run[1]:
+            store.release(h)
+
+def opWorker(pname, username):
+    users[username]["issuedTasks"][pname] = projects[pname]["tasks"].workerTasks(username)
+
+def opIssue(pname, username, maxtasks, now, large=True, speculate=False):
+    queue = projects[pname]["tasks"]
+    queue.reap(now)
+    return queue.pop(username, maxtasks, now, large, speculate)
+
+def opFinish(pname, taskID, status, username=None, now=None):
+    p = projects[pname]
+    if status == "ok":
+        p["tasks"].complete(taskID, username, now)
+        p["blobs"][taskID]["finished"] = True
+    else:
+        p["tasks"].release(taskID, username)
+        wake(pname, taskID in p["tasks"].large)
+
+# Holds the results username gave for a task being checked, with the time now. Once two runs agree,
+# or there have been VERIFY_RUNS, the task is finished and the results of the run which won are
+# published. Otherwise the task is given to another worker. Returns the IDs of the published result
+# blobs, or None if none were published
+def opCheck(pname, taskID, username, hashes, sizes, metadatas, now):
+    p = projects[pname]
+    queue = p["tasks"]
+    runs = p["checks"].setdefault(taskID, [])
+    runs.append([username, hashes, sizes, metadatas])
+    agreed = agreement(runs)
+    if agreed is None and len(runs) < VERIFY_RUNS:
+        queue.recheck(taskID, username, now)
+        wake(pname, taskID in queue.large)
+        return None
+
+    # Without agreement the first run wins
+    winner = 0 if agreed is None else agreed
+    del p["checks"][taskID]
+    queue.complete(taskID, username, now)
+    p["blobs"][taskID]["finished"] = True
+    blobIDs = []
+    for (h, size, metadata) in zip(*runs[winner][1:]):
+        bID = str(p["blobids"])
+        opBlob(pname, bID, h, size, metadata)
+        blobIDs.append(bID)
+    opResults(pname, blobIDs)
+
+    for (i, run) in enumerate(runs):
+        if i != winner:
+            for h in run[1]:
+                store.release(h)
+    judge(verifier, runs, agreed)
+    return blobIDs
+
+def opResults(pname, blobIDs):
+    projects[pname]["results"].append(blobIDs)
+
+def opRenew(pname, username, taskIDs, now):
+    queue = projects[pname]["tasks"]
+    queue.reap(now)
+    return [t for t in taskIDs if queue.renew(t, username, now)]
+
+def opGraph(pname, graphname, diff, now):
+    graphing = projects[pname]["graphing"]
+    graphing["standardGraphs"][graphname].add(now, diff)
+    # Bumped after the change, so that a client never holds a version newer than its data
+    graphing["versions"]["standardGraphs"] += 1
+
+def opCustomGraphs(pname, graphsData):
+    graphing = projects[pname]["graphing"]
+    graphing["customGraphs"] = graphsData
+    graphing["versions"]["customGraphs"] += 1
+
+def opWeight(pname, weight):
+    projects[pname]["weight"] = weight
+    scheduler.setWeight(pname, weight)
+    smallScheduler.setWeight(pname, weight)
+
+def opVerify(pname, rate):
+    projects[pname]["verify"] = rate
+
+def opImport(pname, dump):
+    projects[pname] = restoreProject(pname, dump)
+
+def opDrop(pname):
+    p = projects.pop(pname)
+    scheduler.remove(pname)
+    smallScheduler.remove(pname)
+    for user in users.values():
+        user["issuedTasks"].pop(pname, None)
+    for b in p["blobs"].values():
+        store.release(b["hash"])
+    for runs in p["checks"].values():
+        for run in runs:
+            for h in run[1]:
+                store.release(h)
+
+# Marks project pname as having a task waiting, for workers given small tasks too unless it is large
+def wake(pname, large):
+    scheduler.wake(pname)
+    if not large:
+        smallScheduler.wake(pname)
+
+operations = {"register": opRegister, "session": opSession, "endSession": opEndSession,
+    "project": opProject, "blob": opBlob, "task": opTask, "delete": opDelete, "worker": opWorker,
+    "issue": opIssue, "finish": opFinish, "check": opCheck, "results": opResults, "renew": opRenew, "graph": opGraph,
+    "customGraphs": opCustomGraphs, "weight": opWeight, "verify": opVerify, "import": opImport, "drop": opDrop}
+
+# Returns project pname as plain values, without the contents of its blobs or of the results held
+# for checking. Must be called with the project's lock held
+def dumpProject(pname, p):
+    return {"lsn": p["lsn"], "description": p["description"], "weight": p["weight"], "verify": p["verify"], "blobids": p["blobids"],
+        "blobs": [[bID, b["hash"], b["size"], b["metadata"], b["task"], b["finished"]] for (bID, b) in p["blobs"].items()],
+        "queue": p["tasks"].dump(),
+        "checks": [[taskID, runs] for (taskID, runs) in p["checks"].items()],
+        "results": p["results"].after(-1, p["blobids"]),
+        "changes": [[blobID, deleted] for (seq, blobID, deleted) in p["changes"].since(0, len(p["changes"]))],
+        "graphs": {name: series.dump() for (name, series) in p["graphing"]["standardGraphs"].items()},
+        "customGraphs": p["graphing"]["customGraphs"],
+        "workers": [u for (u, user) in list(users.items()) if pname in user["issuedTasks"]]}
+
+# Returns the project held by a dumpProject() dump, and gives its workers their issued tasks. The
+# blob store must already hold a reference for each of its blobs and held results
+def restoreProject(pname, dump):
+    p = newProject(dump["description"], getTime())
+    p["lsn"] = dump.get("lsn", 0)
+    p["weight"] = dump.get("weight", 1)
+    p["verify"] = dump.get("verify", VERIFY_RATE)
+    for (taskID, runs) in dump.get("checks", []):
+        p["checks"][taskID] = runs
+    scheduler.setWeight(pname, p["weight"])
+    smallScheduler.setWeight(pname, p["weight"])
+    for (bID, h, size, metadata, task, finished) in dump["blobs"]:
+        p["blobs"][bID] = {"hash": h, "size": size, "metadata": metadata, "task": task, "finished": finished}
+        p["blobbytes"] += size
+    p["blobids"] = dump["blobids"]
+    p["tasks"].load(dump["queue"])
+    wake(pname, False)
+    p["results"].append(dump["results"])
+    for (blobID, deleted) in dump["changes"]:
+        p["changes"].record(blobID, deleted)
+
+    for (name, series) in p["graphing"]["standardGraphs"].items():
+        if name in dump["graphs"]:
+            series.load(dump["graphs"][name])
+    p["graphing"]["customGraphs"] = dump["customGraphs"]
+
+    for username in dump["workers"]:
+        if username in users:
+            users[username]["issuedTasks"][pname] = p["tasks"].workerTasks(username)
+    return p
+
+# Returns every user and session as plain values. Must be called with the module lock held
+def dumpUsers():
+    return {"users": [[u, user["hashpass"], user["accesslevel"], user["prefwifidata"], user["prefbattery"]] for (u, user) in users.items()],
+        "sessions": [[token, s["username"], s["accesslevel"], s["starttime"]] for (token, s) in sessions.items()]}
+
+# Writes a snapshot of the whole database, so that the journal before it can be deleted. Each
+# project is copied under its own lock in turn, so the database keeps running meanwhile, and the
+# snapshot may hold some of the changes logged after it began. Recovery skips those, as each part
+# of the snapshot records the LSN of the last change it holds
+def snapshot():
+    n = journal.rotate()
+    state = {"projects": {}}
+    with lock:
+        names = list(projects)
+    for pname in names:
+        p = projects.get(pname)
+        if p is None:
+            continue
+        with p["lock"]:
+            state["projects"][pname] = dumpProject(pname, p)
+
+    # Users are copied last, so that every worker of a project copied above is among them
+    with lock:
+        state.update(dumpUsers())
+        state["userslsn"] = userslsn
+    journal.writeSnapshot(n, state)
+
+# Loads the latest snapshot, then makes each change logged since which it does not already hold
+def recover():
+    global userslsn
+    (state, records) = journal.recover()
+    if state is not None:
+        for (username, hashpass, accesslevel, *prefs) in state["users"]:
+            opRegister(username, hashpass, accesslevel, *prefs)
+        for (token, username, accesslevel, starttime) in state["sessions"]:
+            opSession(token, username, accesslevel, starttime)
+        userslsn = state["userslsn"]
+        for (pname, dump) in state["projects"].items():
+            for b in dump["blobs"]:
+                store.restore(b[1], 1)
+            for (taskID, runs) in dump.get("checks", []):
+                for run in runs:
+                    for h in run[1]:
+                        store.restore(h, 1)
+            projects[pname] = restoreProject(pname, dump)
+
+    for (lsn, (op, scope, *args)) in records:
+        if scope is None:
+            if lsn <= userslsn:
+                continue
+        elif scope in projects:
+            if lsn <= projects[scope]["lsn"]:
+                continue
+        elif op not in ["project", "import"]:
+            # The project was dropped later
+            continue
+
+        # A blob's contents were stored before its change was logged
+        if op == "blob":
+            store.restore(args[1], 1)
+        elif op == "check":
+            for h in args[2]:
+                store.restore(h, 1)
+        elif op == "import":
+            for b in args[0]["blobs"]:
+                store.restore(b[1], 1)
+        apply(lsn, op, scope, args)
+
+# Deletes the journal, so that the database starts empty when the server next starts. Blobs left
+# in the store are swept then. Only for rebooting a test server
+def wipe():
+    journal.clear()
+
+# fsyncs every change logged so far
+def flush():
+    journal.sync()
+
+recover()
+store.collect()
+store.sweep()   # Nothing refers to blobs left over from deleted or unlogged blobs
+journal.start(snapshot)
+threading.Thread(target=sessionReaper, daemon=True).start()
@@ -0,0 +1,444 @@
+# Task dispatch structures for the database
+from collections import deque
+from array import array
+from bisect import bisect_right, insort
+import heapq, threading
+import cbor
+
+from header import *
+
+# Decodes a task descriptor blob. Returns (True, task) if it is a correctly formatted task, or
+# (False, error message) if not
+def parseTask(blob):
+    try:
+        task = cbor.loads(bytes(blob))
+        valid = True
+        valid = valid and type(task["program"]["id"]) is str
+        valid = valid and type(task["program"]["size"]) is int
+        valid = valid and type(task["control"]) is bytes
+        valid = valid and type(task.get("long", False)) is bool
+
+        for b in task["blobs"]:
+            test = b["id"]
+            valid = valid and type(b["size"]) is int
+    except Exception:
+        return (False, "Blob is not a correctly formatted task")
+
+    if not valid:
+        return (False, "Blob not a valid task")
+
+    return (True, task)
+
+# True iff a task is large: marked as long running, or with a program and inputs of more than
+# LARGE_TASK_SIZE bytes between them. Large tasks are only given to capable workers
+def isLarge(task):
+    return task.get("long", False) or task["program"]["size"] + sum(b["size"] for b in task["blobs"]) > LARGE_TASK_SIZE
+
+# Checks the device hints a worker reports: whether it is charging and on Wi-Fi, its CPU class and its
+# memory in megabytes, each optional. Returns (True, hints) if they are correctly formatted, or
+# (False, error message) if not
+def parseDevice(device):
+    if type(device) is not dict:
+        return (False, "Device hints are not a map")
+
+    types = {"charging": bool, "wifi": bool, "cpu": int, "memory": int}
+    hints = {}
+    for (key, value) in device.items():
+        if key in types:
+            if type(value) is not types[key]:
+                return (False, "Invalid device hint " + str(key))
+            hints[key] = value
+
+    return (True, hints)
+
+# True iff a worker reporting device hints should only be given small tasks: it is on battery and
+# prefers to save it, it is on mobile data and prefers to save that, or it has a slow CPU or little
+# memory. Hints which are not reported count as capable, so workers which report none are given any task
+def isConstrained(device, prefwifidata, prefbattery):
+    if not device:
+        return False
+    if prefbattery and device.get("charging", True) is False:
+        return True
+    if prefwifidata and device.get("wifi", True) is False:
+        return True
+    return device.get("cpu", LARGE_TASK_CPU) < LARGE_TASK_CPU or device.get("memory", LARGE_TASK_MEMORY) < LARGE_TASK_MEMORY
+
+# Holds the tasks of a single project: ready queues of tasks waiting to be handed out, and the
+# set of tasks currently issued to each worker. Every operation is O(1) (amortised), so the cost
+# of dispatch does not grow with the queue depth or with how many tasks a worker has been given.
+# Each issued task is leased to its worker until a deadline, after which it is put back on the
+# ready queue. Large tasks, which have large inputs or are marked as long running, wait in a
+# queue of their own, so that they are given only to workers able to take them, and those workers
+# take them first.
+# Once no task is waiting, a task whose worker has held it for STRAGGLER_FACTOR times the median
+# time tasks take to complete is a straggler, and a spare copy of it may be issued to an idle worker
+# too. The first copy completed wins. The other holder is told nothing, but its result is dropped
+# without being stored when it arrives. Times are in milliseconds, as returned by database.getTime().
+# A task whose result is being checked is run again by another worker, and never given to the same
+# worker twice.
+class TaskQueue:
+    def __init__(self):
+        self.ready = deque()    # Small task IDs waiting to be issued, oldest first. May hold stale IDs
+        self.readyLarge = deque()   # Large task IDs waiting to be issued, likewise
+        self.queued = set()     # Task IDs that are really waiting in ready or readyLarge
+        self.large = set()      # IDs of the large tasks, waiting or issued
+        self.waitingLarge = 0   # Number of large tasks in queued
+        self.issued = {}        # Maps a worker's username to the set of task IDs it holds
+        self.owners = {}        # Maps an issued task ID to the username holding it
+        self.leases = {}        # Maps an issued task ID to its lease deadline
+        self.started = {}       # Maps an issued task ID to the time it was issued, in the order issued
+        self.spares = {}        # Maps a straggler's task ID to [username, deadline, time issued] of its spare copy
+        self.superseded = {}    # Maps a task ID completed by one copy to [username, deadline] of the other
+        self.durations = deque(maxlen=STRAGGLER_SAMPLES)    # Times recent tasks took from issue to completion
+        self.ran = {}           # Maps the ID of a task being checked to the set of usernames which ran it
+        self.expiries = []      # Heap of (deadline, taskID). May hold stale entries
+
+    # Number of tasks waiting to be issued
+    def __len__(self):
+        return len(self.queued)
+
+    # Number of tasks waiting which a worker may be issued, if it takes large tasks or not
+    def waiting(self, large):
+        return len(self.queued) if large else len(self.queued) - self.waitingLarge
+
+    # Adds a new task to the back of its ready queue. Returns false if it is already queued or issued
+    def push(self, taskID, large=False):
+        if taskID in self.queued or taskID in self.owners:
+            return False
+
+        if large:
+            self.large.add(taskID)
+        self.enqueue(taskID).append(taskID)
+        return True
+
+    # Marks taskID as waiting. Returns the ready queue it belongs at
+    def enqueue(self, taskID):
+        self.queued.add(taskID)
+        if taskID in self.large:
+            self.waitingLarge += 1
+            return self.readyLarge
+        return self.ready
+
+    # Returns the set of tasks issued to username, creating it if necessary
+    def workerTasks(self, username):
+        try:
+            return self.issued[username]
+        except KeyError:
+            s = self.issued[username] = set()
+            return s
+
+    # Issues up to maxtasks tasks from the front of the ready queues to username, leased until now +
+    # LEASE_TIME. Large tasks are issued first if large is true, and not at all otherwise. If
+    # speculate is true and username holds no task, spare copies of stragglers make up the rest.
+    # Tasks being checked which username already ran are left at the front for other workers
+    def pop(self, username, maxtasks, now, large=True, speculate=False):
+        deadline = now + LEASE_TIME
+        taskIDs = []
+        mine = self.workerTasks(username)
+        idle = not mine
+        for ready in ([self.readyLarge, self.ready] if large else [self.ready]):
+            skipped = []
+            while len(taskIDs) < maxtasks and ready:
+                taskID = ready.popleft()
+
+                # Skip entries which were deleted or already issued since they were queued
+                if taskID not in self.queued:
+                    continue
+                if username in self.ran.get(taskID, ()):
+                    skipped.append(taskID)
+                    continue
+                self.dequeue(taskID)
+
+                mine.add(taskID)
+                self.owners[taskID] = username
+                self.leases[taskID] = deadline
+                self.started[taskID] = now
+                heapq.heappush(self.expiries, (deadline, taskID))
+                taskIDs.append(taskID)
+            ready.extendleft(reversed(skipped))
+
+        if speculate and idle and not self.queued:
+            for taskID in self.stragglers(username, now, maxtasks - len(taskIDs), large):
+                mine.add(taskID)
+                self.spares[taskID] = [username, deadline, now]
+                heapq.heappush(self.expiries, (deadline, taskID))
+                taskIDs.append(taskID)
+
+        return taskIDs
+
+    # Returns up to n of the oldest stragglers without a spare copy which username may be given,
+    # leaving out large tasks unless large is true
+    def stragglers(self, username, now, n, large):
+        limit = self.stragglerTime()
+        found = []
+        if limit is None:
+            return found
+
+        for (taskID, start) in self.started.items():
+            if len(found) >= n or now - start < limit:
+                break
+            if taskID not in self.spares and (large or taskID not in self.large) and username not in self.ran.get(taskID, ()):
+                found.append(taskID)
+        return found
+
+    # Returns the time after which an issued task is a straggler, or None until enough tasks have
+    # completed to tell
+    def stragglerTime(self):
+        if len(self.durations) < STRAGGLER_MIN_SAMPLES:
+            return None
+        return max(self.medianTime() * STRAGGLER_FACTOR, STRAGGLER_MIN_TIME)
+
+    # Returns the median time recent tasks took from issue to completion, or None if none has completed
+    def medianTime(self):
+        if not self.durations:
+            return None
+        return sorted(self.durations)[len(self.durations) // 2]
+
+    # Returns a time after now by which a task may be ready to issue, as a lease runs out or the
+    # oldest issued task becomes a straggler, or None if no task is issued
+    def nextWake(self, now):
+        until = self.nextExpiry()
+        limit = self.stragglerTime()
+        if limit is not None and self.started:
+            straggler = next(iter(self.started.values())) + limit
+            if straggler > now and (until is None or straggler < until):
+                until = straggler
+        return until
+
+    # Marks a waiting taskID as no longer waiting
+    def dequeue(self, taskID):
+        self.queued.remove(taskID)
+        if taskID in self.large:
+            self.waitingLarge -= 1
+
+    # Extends the lease username holds on taskID to now + LEASE_TIME. Returns false if it holds no lease
+    def renew(self, taskID, username, now):
+        deadline = now + LEASE_TIME
+        if self.owners.get(taskID) == username:
+            self.leases[taskID] = deadline
+        elif self.spares.get(taskID, [None])[0] == username:
+            self.spares[taskID][1] = deadline
+        else:
+            return False
+
+        heapq.heappush(self.expiries, (deadline, taskID))
+        return True
+
+    # Puts every task whose lease ran out before now back on the front of the ready queue, unless
+    # a spare copy of it is still out. Returns the list of expired task IDs
+    def reap(self, now):
+        expired = []
+        while self.expiries and self.expiries[0][0] <= now:
+            (deadline, taskID) = heapq.heappop(self.expiries)
+
+            if self.leases.get(taskID) == deadline:
+                self.unassign(taskID)
+                if not self.promote(taskID):
+                    self.enqueue(taskID).appendleft(taskID)
+                expired.append(taskID)
+            elif self.spares.get(taskID, [None, None])[1] == deadline:
+                self.dropSpare(taskID)
+            elif self.superseded.get(taskID, [None, None])[1] == deadline:
+                del self.superseded[taskID]
+            # Otherwise the lease was renewed, completed or released since
+
+        return expired
+
+    # Returns a time by which the next lease may run out, or None if no task is issued
+    def nextExpiry(self):
+        return self.expiries[0][0] if self.expiries else None
+
+    def isIssued(self, taskID, username):
+        return self.owners.get(taskID) == username or self.spares.get(taskID, [None])[0] == username
+
+    # True iff username held the copy of taskID which lost to another, in which case its result
+    # should be dropped. It is remembered until the copy's lease would have run out
+    def isSuperseded(self, taskID, username):
+        return self.superseded.get(taskID, [None])[0] == username
+
+    # Takes an issued task away from its worker. Returns the worker, or None if it was not issued
+    def unassign(self, taskID):
+        username = self.owners.pop(taskID, None)
+        if username is not None:
+            self.issued[username].discard(taskID)
+            del self.leases[taskID]
+            del self.started[taskID]
+        return username
+
+    # Takes the spare copy of taskID away from its worker. Returns [username, deadline, time issued]
+    # of the copy, or None if there was none
+    def dropSpare(self, taskID):
+        spare = self.spares.pop(taskID, None)
+        if spare is not None:
+            self.issued[spare[0]].discard(taskID)
+        return spare
+
+    # Makes the spare copy of an unassigned task its only copy. Returns false if it has none
+    def promote(self, taskID):
+        spare = self.spares.pop(taskID, None)
+        if spare is None:
+            return False
+
+        (username, deadline, start) = spare
+        self.owners[taskID] = username
+        self.leases[taskID] = deadline
+        self.place(taskID, start)
+        return True
+
+    # Adds taskID, issued at start, to started in the order issued, moving only the tasks issued
+    # after it. stragglers() and nextWake() rely on the order to stop at the first task which is not
+    # yet a straggler
+    def place(self, taskID, start):
+        later = []
+        for (t, s) in reversed(self.started.items()):
+            if s <= start:
+                break
+            later.append((t, s))
+        for (t, s) in later:
+            del self.started[t]
+        self.started[taskID] = start
+        self.started.update(reversed(later))
+
+    # Marks an issued task as finished by username, or by whichever worker holds it if username is
+    # None; it will never be handed out again. If now is given, the time it took counts towards the
+    # straggler time. The other copy of a straggler is superseded
+    def complete(self, taskID, username=None, now=None):
+        spare = self.spares.get(taskID)
+        if spare is not None and spare[0] == username:
+            self.dropSpare(taskID)
+            start = spare[2]
+            deadline = self.leases.get(taskID)
+            loser = self.unassign(taskID)
+        else:
+            if username is not None and self.owners.get(taskID) != username:
+                return False
+            start = self.started.get(taskID)
+            loser = None
+            if spare is not None:
+                (loser, deadline, t) = self.dropSpare(taskID)
+            if self.unassign(taskID) is None:
+                return False
+
+        if loser is not None:
+            self.superseded[taskID] = [loser, deadline]
+        if now is not None:
+            self.durations.append(now - start)
+        self.large.discard(taskID)
+        self.ran.pop(taskID, None)
+        return True
+
+    # Takes an issued task back from username, which ran it, so that its result can be checked by
+    # another worker. If another worker holds a copy of the task already, that copy is the check.
+    # Otherwise the task goes back on the front of its ready queue. If now is given, the time it took
+    # counts towards the straggler time
+    def recheck(self, taskID, username, now=None):
+        spare = self.spares.get(taskID)
+        if spare is not None and spare[0] == username:
+            self.dropSpare(taskID)
+            start = spare[2]
+        else:
+            if self.owners.get(taskID) != username:
+                return False
+            start = self.started[taskID]
+            self.unassign(taskID)
+            if not self.promote(taskID):
+                self.enqueue(taskID).appendleft(taskID)
+
+        self.ran.setdefault(taskID, set()).add(username)
+        if now is not None:
+            self.durations.append(now - start)
+        return True
+
+    # Puts an issued task back on the ready queue so that it is handed out again, unless a spare
+    # copy of it is still out. If username holds the spare copy, only that copy is given up
+    def release(self, taskID, username=None):
+        spare = self.spares.get(taskID)
+        if spare is not None and spare[0] == username:
+            self.dropSpare(taskID)
+            return True
+        if username is not None and self.owners.get(taskID) != username:
+            return False
+
+        if self.unassign(taskID) is None:
+            return False
+        return self.promote(taskID) or self.push(taskID)
+
+    # Returns the queue as plain values: the waiting task IDs in order, the IDs of the large tasks,
+    # each lease as [taskID, username, deadline, time issued] oldest first, each spare copy as
+    # [taskID, username, deadline, time issued], the recent task durations, and the workers which
+    # ran each task being checked as [taskID, usernames]
+    def dump(self):
+        ready = []
+        seen = set()
+        for taskID in list(self.ready) + list(self.readyLarge):
+            # Only the first entry of a task in ready is handed out
+            if taskID in self.queued and taskID not in seen:
+                ready.append(taskID)
+                seen.add(taskID)
+        return {"ready": ready, "large": list(self.large),
+            "leases": [[t, self.owners[t], self.leases[t], start] for (t, start) in self.started.items()],
+            "spares": [[t] + spare for (t, spare) in self.spares.items()],
+            "durations": list(self.durations),
+            "ran": [[t, list(usernames)] for (t, usernames) in self.ran.items()]}
+
+    # Fills an empty queue from a dump()
+    def load(self, d):
+        self.large.update(d.get("large", []))
+        for taskID in d["ready"]:
+            self.push(taskID)
+        for (taskID, username, deadline, *start) in d["leases"]:
+            self.workerTasks(username).add(taskID)
+            self.owners[taskID] = username
+            self.leases[taskID] = deadline
+            self.started[taskID] = start[0] if start else deadline - LEASE_TIME
+            heapq.heappush(self.expiries, (deadline, taskID))
+        for (taskID, username, deadline, start) in d.get("spares", []):
+            self.workerTasks(username).add(taskID)
+            self.spares[taskID] = [username, deadline, start]
+            heapq.heappush(self.expiries, (deadline, taskID))
+        self.durations.extend(d.get("durations", []))
+        for (taskID, usernames) in d.get("ran", []):
+            self.ran[taskID] = set(usernames)
+
+    # Removes a task from the queue entirely, whether it is waiting or issued
+    def discard(self, taskID):
+        if taskID in self.queued:
+            self.dequeue(taskID)
+        self.large.discard(taskID)
+        self.superseded.pop(taskID, None)
+        self.ran.pop(taskID, None)
+        self.dropSpare(taskID)
+        self.unassign(taskID)
+
+# The IDs of the result blobs of a single project, in increasing order, which customers wait on
+# for new results. A customer's cursor is the highest result blob ID it has seen, starting at -1.
+class ResultFeed:
+    def __init__(self):
+        self.blobIDs = array('q')
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.blobIDs)
+
+    # Adds new result blobs, and wakes every customer waiting on them
+    def append(self, blobIDs):
+        with self.cond:
+            for b in blobIDs:
+                b = int(b)
+                if self.blobIDs and self.blobIDs[-1] > b:
+                    insort(self.blobIDs, b)
+                else:
+                    self.blobIDs.append(b)
+            self.cond.notify_all()
+
+    # Returns up to limit result blob IDs after cursor, oldest first
+    def after(self, cursor, limit):
+        with self.cond:
+            i = bisect_right(self.blobIDs, cursor)
+            return [str(b) for b in self.blobIDs[i:i+limit]]
+
+    # As after, but first waits up to timeout milliseconds for a result after cursor
+    def wait(self, cursor, limit, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.blobIDs and self.blobIDs[-1] > cursor, timeout / 1000)
+            return self.after(cursor, limit)
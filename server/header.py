@@ -1,3 +1,57 @@
 TOKENSIZE = 20
 SESSION_EXPIRE = 30*24*60*60*1000    # Token expiry one month
+SESSION_REAP_INTERVAL = 60*1000     # Time between evictions of expired sessions
 PRODUCTION = False
+LEASE_TIME = 10*60*1000     # Time a worker may hold a task before it is reissued
+STRAGGLER_FACTOR = 3        # Multiple of the median task time after which a spare copy of a task may be issued
+STRAGGLER_SAMPLES = 101     # Recent task times each project keeps to find the median
+STRAGGLER_MIN_SAMPLES = 5   # Task times a project needs before it issues spare copies
+STRAGGLER_MIN_TIME = 10*1000    # Least time a task is held before a spare copy of it may be issued
+VERIFY_RATE = 0             # Default share of completed tasks run again by another worker to check their results
+VERIFY_RAISE = 4            # Factor by which a worker's tasks are checked more often each time its result disagrees
+VERIFY_MAX_FACTOR = 256     # Most a worker's tasks are checked more often than its project's rate
+VERIFY_RUNS = 3             # Most runs of a checked task. If no two results agree by then, the first is kept
+DATABASE_BACKEND = "memory"  # "memory" keeps everything in dicts, logged to JOURNAL_PATH, "sqlite" stores it in DATABASE_PATH
+DATABASE_PATH = "distributedphone.db"
+GROUP_COMMIT_SIZE = 256     # Mutations batched into one SQLite transaction
+GROUP_COMMIT_INTERVAL = 50  # Milliseconds before mutations which no request waits for are committed anyway
+BLOBSTORE_PATH = "blobs"    # Directory holding blob contents for the dict database
+JOURNAL_PATH = "journal"    # Directory holding the log and snapshots of the dict database
+JOURNAL_SYNC_INTERVAL = 50  # Milliseconds between fsyncs of the log. A power cut loses at most this much
+SNAPSHOT_SIZE = 64*1024*1024    # Bytes of log after which the dict database writes a snapshot
+MAX_STREAM_HEADER = 64*1024 # Longest header accepted before a streamed blob
+FRAME_MIN = 1024            # Shortest byte string sent as a frame of its own in a framed body, rather than in its header
+COMPRESS_MIN = 1024         # Shortest response body, or blob, which is compressed
+COMPRESS_RATIO = 0.9        # A blob's compressed copy is only kept if it is at most this share of the blob's size
+COMPRESS_LEVELS = {         # Levels at which each endpoint's responses are compressed, by encoding. Others are sent as they are
+    "getBlob": {"zstd": 3, "gzip": 6},
+    "getBlobMetadata": {"zstd": 3, "gzip": 1},
+    "getGraphs": {"zstd": 9, "gzip": 6},
+    "getChanges": {"zstd": 3, "gzip": 6},
+    "waitForResults": {"zstd": 3, "gzip": 6},
+    "getProjectsList": {"zstd": 3, "gzip": 6},
+    "getTasks": {"zstd": 1, "gzip": 1},
+}
+BLOB_COMPRESS_LEVELS = {"zstd": 19, "gzip": 9}  # Levels of the compressed copies of blobs, made once as they are stored
+MAX_BATCH = 10000           # Most blobs accepted by one createNewBlobs or blobsToTasks request
+GRAPH_RESOLUTIONS = [1000, 60*1000, 60*60*1000, 24*60*60*1000]  # Intervals of the graph rollups, finest first
+GRAPH_RETENTION = 100000    # Points kept in each graph rollup
+PRECISIONS = {"s": 1000, "m": 60*1000, "h": 60*60*1000, "d": 24*60*60*1000, "w": 7*24*60*60*1000}  # Graph precisions by name
+RESULT_WAIT_MAX = 60*1000   # Longest a waitForResults request blocks
+PAGE_SIZE = 1000            # Most entries returned by one page of waitForResults, getChanges or getBlobMetadata
+SERVER_THREADS = 64         # Request threads, enough that customers waiting for results do not starve workers
+PREFETCH_MAX = 4*1024*1024  # Most bytes of input blobs sent inline with one getTasks response
+BATCH_INTERVAL = 30*1000    # Time between getTasks polls which the suggested batch size of a worker aims for
+MAX_BATCH_TASKS = 1000      # Most tasks in a suggested batch
+MAX_WEIGHT = 1000           # Largest weight a project may be given for fair-share scheduling
+LARGE_TASK_SIZE = 16*1024*1024  # Bytes of program and inputs above which a task is large, and only given to capable workers
+LARGE_TASK_CPU = 2          # Least CPU class, from 1 (slow) to 3 (fast), of a worker given large tasks
+LARGE_TASK_MEMORY = 2048    # Least megabytes of memory of a worker given large tasks
+METRICS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # Upper bounds in seconds of the buckets of the request latency histograms
+SERVER_PORT = 8081
+SHARDS = 4                  # Server processes started by router.py when it is given no nodes
+NODE_HOST = "127.0.0.1"     # Address a server started with --shard listens on. "0.0.0.0" lets routers on other machines reach it
+VNODES = 64                 # Points each node has on router.py's hash ring
+MAX_BODY_SIZE = 100*1024*1024   # Longest request body accepted, as CherryPy's default, before or after decompression. Shards accept any length sent uncompressed
+SPOOL_SIZE = 1024*1024      # asyncserver.py holds request bodies up to this size in memory, and larger ones on disk
+IDLE_TIMEOUT = 60*1000      # asyncserver.py closes connections which send nothing for this long
@@ -0,0 +1,157 @@
+# Write-ahead log and snapshots for the dict database
+import cbor, os, struct, threading, time
+
+from header import *
+
+# Appends each mutation of the database to a log on disk before it is made, so that the database
+# survives a restart. Each record is a CBOR list prefixed by its length as a 4 byte big-endian
+# integer, and is numbered by a log sequence number (LSN) counting up from 1. Records are written
+# as they are appended, so they survive the process, and fsynced together every
+# JOURNAL_SYNC_INTERVAL milliseconds, so a power cut loses at most that much.
+# The log is split into numbered segments. Snapshot n holds the state made by every record in the
+# segments before n, and possibly by some in segment n onwards, so once it is written those
+# segments are deleted and recovery loads the snapshot and replays only the segments from n on.
+# Each part of the state records the LSN of the last record applied to it, so that replay skips
+# the records a snapshot already holds.
+class Journal:
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.lsn = 0        # LSN of the last record appended
+        self.segment = 0    # Number of the segment being appended to
+        self.fd = None
+        self.size = 0       # Bytes of log which the latest snapshot does not cover
+        self.dirty = False  # True iff records were written since the last fsync
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, kind, n):
+        return os.path.join(self.root, "%s.%010d" % (kind, n))
+
+    # Returns the numbers of the complete files of kind, "log" or "snapshot", in order
+    def numbers(self, kind):
+        return sorted(int(name.split(".")[1]) for name in os.listdir(self.root)
+            if name.startswith(kind + ".") and not name.endswith(".tmp"))
+
+    # Returns the latest snapshot, or None if there is none, and a generator over the [lsn, record]
+    # of every record logged since, oldest first. The generator must be used up before appending
+    def recover(self):
+        # Drop any snapshot left half written
+        for name in os.listdir(self.root):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.root, name))
+
+        snapshots = self.numbers("snapshot")
+        n = snapshots[-1] if snapshots else 0
+        snapshot = None
+        if snapshots:
+            with open(self.path("snapshot", n), "rb") as f:
+                snapshot = cbor.loads(f.read())
+            self.lsn = snapshot["lsn"]
+
+        segments = [s for s in self.numbers("log") if s >= n]
+        self.segment = max(segments + [n])
+        return (snapshot, self.replay(segments))
+
+    def replay(self, segments):
+        for s in segments:
+            with open(self.path("log", s), "rb") as f:
+                data = f.read()
+            self.size += len(data)
+
+            i = 0
+            while i + 4 <= len(data):
+                (n,) = struct.unpack_from(">I", data, i)
+                # A record cut short by a crash ends the log
+                if i + 4 + n > len(data):
+                    break
+                (lsn, record) = cbor.loads(data[i+4:i+4+n])
+                self.lsn = max(self.lsn, lsn)
+                yield (lsn, record)
+                i += 4 + n
+
+    # Starts a new segment, and the thread which fsyncs the log. Once the log grows past
+    # SNAPSHOT_SIZE bytes, that thread calls snapshot() to write a snapshot
+    def start(self, snapshot):
+        # The segments just replayed still count towards the next snapshot
+        size = self.size
+        self.rotate()
+        self.size = size
+        threading.Thread(target=self.syncLoop, args=(snapshot,), daemon=True).start()
+
+    # Deletes every segment and snapshot, so that the next recovery finds nothing. Records appended
+    # afterwards are lost too
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.root):
+                os.remove(os.path.join(self.root, name))
+
+    # Logs record. Returns its LSN
+    def append(self, record):
+        with self.lock:
+            self.lsn += 1
+            data = cbor.dumps([self.lsn, record])
+            os.write(self.fd, struct.pack(">I", len(data)) + data)
+            self.size += 4 + len(data)
+            self.dirty = True
+            return self.lsn
+
+    # fsyncs every record written so far
+    def sync(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            # A copy of the descriptor stays valid if the segment is closed meanwhile
+            fd = os.dup(self.fd)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def syncLoop(self, snapshot):
+        while True:
+            time.sleep(JOURNAL_SYNC_INTERVAL / 1000)
+            self.sync()
+            if self.size > SNAPSHOT_SIZE:
+                try:
+                    snapshot()
+                except Exception as e:
+                    print("Failed to write snapshot: " + repr(e))
+
+    # Closes the segment being appended to, and starts the next. Returns the number of the new
+    # segment, which is the number of the snapshot made next
+    def rotate(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+            self.segment += 1
+            self.fd = os.open(self.path("log", self.segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.size = 0
+            self.syncDirectory()
+            return self.segment
+
+    # Writes snapshot n, holding state, then deletes the segments and snapshots it replaces
+    def writeSnapshot(self, n, state):
+        state["lsn"] = self.lsn
+        tmp = self.path("snapshot", n) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(cbor.dumps(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path("snapshot", n))
+        self.syncDirectory()
+
+        for s in self.numbers("log"):
+            if s < n:
+                os.remove(self.path("log", s))
+        for s in self.numbers("snapshot"):
+            if s < n:
+                os.remove(self.path("snapshot", s))
+
+    def syncDirectory(self):
+        fd = os.open(self.root, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,102 @@
+# Counts and times the requests to each endpoint, for the metrics endpoint
+# Each exposed endpoint of RootServer is wrapped by instrument(), which counts its requests, and
+# those which fail, and adds the time each took to a histogram with buckets METRICS_BUCKETS. A
+# request fails if it raises an exception or responds with errormsg(). A streamed response is timed
+# until its body starts. Counting costs a lock and a bisection, so that it stays within a few
+# microseconds per request. render() writes the counts out in the Prometheus text format.
+from bisect import bisect_left
+import functools, inspect, threading, time
+
+from header import *
+
+local = threading.local()   # Holds failed, set while a request is served if it fails
+
+class Stats:
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)   # Requests in each bucket, the last being +Inf
+        self.seconds = 0.0      # Total time taken by requests
+        self.errors = 0         # Requests which failed
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, failed):
+        i = bisect_left(METRICS_BUCKETS, seconds)
+        with self.lock:
+            self.buckets[i] += 1
+            self.seconds += seconds
+            self.errors += failed
+
+    # Returns (cumulative bucket counts, total seconds, errors)
+    def read(self):
+        with self.lock:
+            (buckets, seconds, errors) = (list(self.buckets), self.seconds, self.errors)
+        for i in range(1, len(buckets)):
+            buckets[i] += buckets[i - 1]
+        return (buckets, seconds, errors)
+
+endpoints = {}  # Maps an endpoint's name to its Stats
+
+# Marks the request being served as failed
+def failed():
+    local.failed = True
+
+# Returns f, the handler of endpoint name, wrapped to count and time its requests. The wrapper keeps
+# f's signature, so that requests with missing parameters are still turned away
+def instrument(name, f):
+    stats = endpoints.setdefault(name, Stats())
+
+    @functools.wraps(f)
+    def handler(*args, **kwargs):
+        local.failed = False
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        except BaseException:
+            local.failed = True
+            raise
+        finally:
+            stats.observe(time.perf_counter() - start, local.failed)
+
+    handler.__signature__ = inspect.signature(f)
+    return handler
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Returns the lines of a metric family, given its name, type, help and samples as (suffix, labels,
+# value), where the suffix is added to the name and labels is a list of (name, value)
+def family(name, kind, text, samples):
+    lines = ["# HELP " + name + " " + text, "# TYPE " + name + " " + kind]
+    for (suffix, labels, value) in samples:
+        labels = ",".join('%s="%s"' % (k, escape(v)) for (k, v) in labels)
+        lines.append(name + suffix + ("{" + labels + "}" if labels else "") + " " + repr(value))
+    return lines
+
+# Returns the request counts and latencies of every endpoint, followed by gauges, as returned by
+# the database's getMetrics(), in the Prometheus text format
+def render(gauges):
+    stats = sorted((name, s.read()) for (name, s) in list(endpoints.items()))
+    histogram = []
+    for (name, (buckets, seconds, errors)) in stats:
+        for (le, n) in zip(METRICS_BUCKETS + ["+Inf"], buckets):
+            histogram.append(("_bucket", [("endpoint", name), ("le", le)], n))
+        histogram.append(("_sum", [("endpoint", name)], seconds))
+        histogram.append(("_count", [("endpoint", name)], buckets[-1]))
+    projects = sorted(gauges["projects"].items())
+
+    lines = (family("dphone_requests_total", "counter", "Requests served, by endpoint",
+            [("", [("endpoint", name)], buckets[-1]) for (name, (buckets, seconds, errors)) in stats])
+        + family("dphone_request_errors_total", "counter", "Requests which failed, by endpoint",
+            [("", [("endpoint", name)], errors) for (name, (buckets, seconds, errors)) in stats])
+        + family("dphone_request_seconds", "histogram", "Time taken to respond to requests, by endpoint", histogram)
+        + family("dphone_sessions", "gauge", "Live sessions", [("", [], gauges["sessions"])])
+        + family("dphone_tasks_waiting", "gauge", "Tasks waiting to be issued, by project",
+            [("", [("project", pname)], p["waiting"]) for (pname, p) in projects])
+        + family("dphone_tasks_issued", "gauge", "Tasks issued to workers and not yet returned, by project",
+            [("", [("project", pname)], p["issued"]) for (pname, p) in projects])
+        + family("dphone_tasks_spare", "gauge", "Spare copies of straggling tasks issued to a second worker and not yet returned, by project",
+            [("", [("project", pname)], p["spares"]) for (pname, p) in projects])
+        + family("dphone_blob_bytes", "gauge", "Total size of the blobs of each project",
+            [("", [("project", pname)], p["blobBytes"]) for (pname, p) in projects])
+        + family("dphone_graph_points", "gauge", "Points held in the standard graphs of each project",
+            [("", [("project", pname)], p["graphPoints"]) for (pname, p) in projects]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,550 @@
+## Multi-node server
+# Usage: python3 router.py [host:port ...]
+#        python3 router.py --join host:port
+# Listens on SERVER_PORT and forwards each request to the server node holding its project, so that
+# projects are spread over several processes or machines. Projects are placed by consistent hashing
+# of their names: each node has VNODES points on a hash ring and holds the projects hashing to just
+# before them, so when a node joins only the projects which now hash to it are moved. With no nodes
+# given, SHARDS local server.py processes are started with --shard.
+# Nodes must share the router's SHARD_SECRET environment variable, which proves that requests to
+# move projects or to pick login tokens come from the router. Users and sessions are held by every
+# node: register, login and logout go to all of them, and a joining node is sent a copy first.
+# --join asks the router on SERVER_PORT of this machine to add a node and move projects to it.
+import cherrypy, os, sys, cbor, struct, subprocess, threading, atexit, hashlib
+import http.client, string, itertools
+from bisect import bisect
+from Crypto.Random import random
+
+from header import *
+import codec, compressor
+
+CHUNK = 64*1024     # Bytes read at a time when streaming a body through
+
+secret = os.environ.get("SHARD_SECRET") or ''.join(random.choice(string.ascii_letters) for m in range(32))
+shards = []         # The local node processes
+
+# Requests and responses are passed on in the codec and compression the client chose, as in server.py
+def readBody(data):
+    data = compressor.decompress(cherrypy.request.headers.get("Content-Encoding"), data, MAX_BODY_SIZE)
+    return codec.decode(cherrypy.request.headers.get("Content-Type"), data)
+
+# Decodes a node's response body, given the headers it was sent with
+def readResponse(headers, data):
+    return codec.decode(headers.get("Content-Type"), compressor.decompress(headers.get("Content-Encoding"), data))
+
+def respond(d):
+    t = codec.negotiate(cherrypy.request.headers)
+    cherrypy.response.headers["Content-Type"] = t
+    data = codec.encode(t, d)
+    data = data if type(data) is bytes else b"".join(data)
+
+    endpoint = cherrypy.request.path_info.strip("/")
+    if endpoint in COMPRESS_LEVELS:
+        cherrypy.response.headers["Vary"] = "Accept-Encoding"
+    (encoding, level) = compressor.choose(cherrypy.request.headers.get("Accept-Encoding"), endpoint, len(data))
+    if encoding is None:
+        # Not that of a node's response passed on earlier
+        cherrypy.response.headers.pop("Content-Encoding", None)
+        return data
+    cherrypy.response.headers["Content-Encoding"] = encoding
+    return compressor.compress(encoding, data, level)
+
+# Returns d encoded in the codec of the client's request, to pass on to a node
+def reencode(d):
+    t = codec.mediaType(cherrypy.request.headers.get("Content-Type"))
+    data = codec.encode(t if t in codec.codecs else codec.CBOR, d)
+    return data if type(data) is bytes else b"".join(data)
+
+# Returns the headers naming the codecs and compression of the client's request, to pass on to a
+# node. A body made by reencode() is not compressed, so pass compressed=False with it
+def codecHeaders(compressed=True):
+    names = ["Content-Type", "Accept", "Accept-Encoding"] + (["Content-Encoding"] if compressed else [])
+    return {h: cherrypy.request.headers[h] for h in names if h in cherrypy.request.headers}
+
+def errormsg(m):
+    return respond({'success': False, 'error': m})
+
+def success():
+    return respond({'success': True, 'error': ''})
+
+def log(msg):
+    print(msg)
+
+# The position of key on the hash ring. Python's hash() differs between processes, so a digest
+# is used instead
+def pointOf(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+# Places project names on nodes. Each node has VNODES points on the ring, and holds the names
+# whose point falls just before one of its own
+class HashRing:
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        ring = sorted((pointOf(node + "#" + str(v)), node) for node in self.nodes for v in range(VNODES))
+        self.points = [p for (p, node) in ring]
+        self.owners = [node for (p, node) in ring]
+
+    def owner(self, pname):
+        return self.owners[bisect(self.points, pointOf(pname)) % len(self.points)]
+
+# Routing state, guarded by state. While a node joins, requests which create projects or copy to
+# every node are held back until the ring has changed, and requests for a project being moved
+# wait until it arrives
+state = threading.Condition()
+ring = None         # The HashRing of the nodes
+pinned = {}         # Maps projects which failed to move to the node still holding them
+moving = set()      # Projects being moved to another node
+inflight = {}       # Maps a project name to the number of requests for it being forwarded
+paused = False      # True while a node joins
+held = 0            # Requests being forwarded which a joining node waits for
+rotation = itertools.count()    # Picks the node a worker asking for tasks from any project tries first
+joinLock = threading.Lock()
+
+def ownerOf(pname):
+    return pinned.get(pname) or ring.owner(pname)
+
+# Waits until project pname may be used, and returns the node holding it. Must be followed by done()
+def acquire(pname, hold=False):
+    global held
+    with state:
+        state.wait_for(lambda: pname not in moving and not (hold and paused))
+        inflight[pname] = inflight.get(pname, 0) + 1
+        if hold:
+            held += 1
+        return ownerOf(pname)
+
+# Waits until no project is being moved, for a request which may use any project on its node. It is
+# counted as in flight under the name None, and must be followed by done(None)
+def acquireAny():
+    with state:
+        state.wait_for(lambda: not moving)
+        inflight[None] = inflight.get(None, 0) + 1
+
+def done(pname, hold=False):
+    global held
+    with state:
+        inflight[pname] -= 1
+        if inflight[pname] == 0:
+            del inflight[pname]
+        if hold:
+            held -= 1
+        state.notify_all()
+
+# Each router thread keeps a connection open to every node
+local = threading.local()
+
+def connection(node):
+    if not hasattr(local, "conns"):
+        local.conns = {}
+    if node not in local.conns:
+        (host, port) = node.rsplit(":", 1)
+        local.conns[node] = http.client.HTTPConnection(host, int(port))
+    return local.conns[node]
+
+# Sends a request to node, and returns its response. The body may be bytes or an iterator of
+# bytes. A connection which the node has closed is reopened once
+def forward(node, path, body=b'', headers={}):
+    for attempt in range(2):
+        conn = connection(node)
+        try:
+            conn.request("POST", path, body, headers, encode_chunked=not "Content-Length" in headers and type(body) is not bytes)
+            return conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            del local.conns[node]
+            if attempt == 1 or type(body) is not bytes:
+                raise
+
+# Sends a CBOR request to node, and returns its decoded response
+def call(node, path, body):
+    return cbor.loads(forward(node, path, cbor.dumps(body)).read())
+
+# Copies the status and headers of a node's response r to the client
+def passOn(r):
+    cherrypy.response.status = r.status
+    for h in ["Content-Type", "Content-Encoding", "Vary", "ETag", "Cache-Control"]:
+        if r.getheader(h) is not None:
+            cherrypy.response.headers[h] = r.getheader(h)
+
+# Forwards a request for project pname to the node holding it, and returns its response to the client
+def relay(pname, path, body, headers={}, hold=False):
+    node = acquire(pname, hold)
+    try:
+        r = forward(node, path, body, headers)
+        data = r.read()
+    except Exception as e:
+        return errormsg("Node unavailable: " + str(e))
+    finally:
+        done(pname, hold)
+
+    passOn(r)
+    return data
+
+# Forwards the request to every node. Returns the response of the first if every node answered
+# alike, and otherwise a failure naming the nodes which did not succeed. The request undo, if given,
+# is then sent to the nodes which did, so that no node is left holding what the others refused
+def broadcast(path, body, headers={}, undo=None):
+    acquire("", True)
+    try:
+        (first, succeeded, failed) = (None, [], [])
+        for node in ring.nodes:
+            try:
+                r = forward(node, path, body, headers)
+                data = r.read()
+                d = readResponse(r.headers, data)
+            except Exception as e:
+                failed.append(node + " (unavailable: " + str(e) + ")")
+                continue
+            if first is None:
+                first = (r, data)
+            if d["success"]:
+                succeeded.append(node)
+            else:
+                failed.append(node + " (" + str(d["error"]) + ")")
+
+        if first is not None and (not succeeded or not failed):
+            passOn(first[0])
+            return first[1]
+
+        if undo is not None:
+            for node in succeeded:
+                try:
+                    forward(node, undo[0], undo[1], undo[2]).read()
+                except Exception as e:
+                    log("Failed to undo " + path + " on " + node + ": " + str(e))
+        return errormsg("Failed on nodes: " + ", ".join(failed))
+    finally:
+        done("", True)
+
+# Moves project pname from node src to node dst. Returns (success, error message)
+def moveProject(pname, src, dst):
+    data = call(src, "/exportProject", {"secret": secret, "pname": pname})
+    if not data["success"]:
+        return (False, data["error"])
+
+    data = call(dst, "/importProject", {"secret": secret, "pname": pname, "project": data["project"]})
+    if not data["success"]:
+        return (False, data["error"])
+
+    data = call(src, "/dropProject", {"secret": secret, "pname": pname})
+    if not data["success"]:
+        log("Failed to drop moved project " + pname + " from " + src + ": " + data["error"])
+    return (True, "")
+
+# Adds node to the ring, and moves the projects which now hash to it. Returns (success, error message)
+def addNode(node):
+    global ring, paused
+    with joinLock:
+        # Hold back new projects and users while the ring changes
+        with state:
+            if node in ring.nodes:
+                return (False, "Node already joined")
+            paused = True
+            state.wait_for(lambda: held == 0)
+
+        try:
+            old = ring
+            new = HashRing(old.nodes + [node])
+            moves = []
+            for src in old.nodes:
+                for pname in call(src, "/getProjectsList", {})["projects"]:
+                    if pname not in pinned and new.owner(pname) != src:
+                        moves.append((pname, src))
+
+            # Users and sessions are copied first, so that the node accepts their tokens
+            data = call(old.nodes[0], "/exportUsers", {"secret": secret})
+            if data["success"]:
+                data = call(node, "/importUsers", {"secret": secret, "users": data["users"]})
+            if not data["success"]:
+                return (False, "Failed to copy users: " + data["error"])
+
+            with state:
+                moving.update(pname for (pname, src) in moves)
+                ring = new
+        except Exception as e:
+            return (False, "Node unavailable: " + str(e))
+        finally:
+            with state:
+                paused = False
+                state.notify_all()
+
+        # Move each project once the requests already forwarded to it are answered
+        for (pname, src) in moves:
+            with state:
+                state.wait_for(lambda: pname not in inflight and None not in inflight)
+            try:
+                (succ, msg) = moveProject(pname, src, node)
+            except Exception as e:
+                (succ, msg) = (False, str(e))
+
+            with state:
+                if not succ:
+                    log("Failed to move project " + pname + " to " + node + ": " + msg)
+                    pinned[pname] = src
+                moving.discard(pname)
+                state.notify_all()
+
+        log("Node " + node + " joined, and " + str(len(moves)) + " projects moved to it")
+        return (True, "")
+
+class RouterServer:
+    @cherrypy.expose
+    def ping(self):
+        return success()
+
+    @cherrypy.expose
+    def register(self):
+        return broadcast("/register", cherrypy.request.body.read(), codecHeaders())
+
+    @cherrypy.expose
+    def logout(self):
+        return broadcast("/logout", cherrypy.request.body.read(), codecHeaders())
+
+    @cherrypy.expose
+    def reboot(self):
+        if not PRODUCTION:
+            return broadcast("/reboot", b'')
+
+    # Every node must give out the same token, so the router picks it
+    @cherrypy.expose
+    def login(self):
+        try:
+            body = readBody(cherrypy.request.body.read())
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        body["token"] = ''.join(random.choice(string.ascii_letters) for m in range(TOKENSIZE))
+        body["secret"] = secret
+        undo = ("/logout", reencode({"token": body["token"]}), codecHeaders(False))
+        return broadcast("/login", reencode(body), codecHeaders(False), undo)
+
+    # secret, address
+    @cherrypy.expose
+    def addNode(self):
+        try:
+            body = readBody(cherrypy.request.body.read())
+            node = str(body["address"])
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        if body.get("secret") != secret:
+            return errormsg("Invalid access level.")
+
+        (succ, msg) = addNode(node)
+        if not succ:
+            return errormsg(msg)
+        return success()
+
+    @cherrypy.expose
+    def createNewProject(self):
+        data = cherrypy.request.body.read()
+        try:
+            pname = str(readBody(data)["pname"])
+        except Exception:
+            return errormsg("Invalid inputs")
+        return relay(pname, "/createNewProject", data, codecHeaders(), hold=True)
+
+    @cherrypy.expose
+    def getProjectsList(self):
+        projects = {}
+        for node in ring.nodes:
+            try:
+                projects.update(call(node, "/getProjectsList", {})["projects"])
+            except Exception as e:
+                return errormsg("Node unavailable: " + str(e))
+        return respond({'success': True, 'error': '', "projects": projects})
+
+    # A worker asking for tasks from any project is sent to each node in turn, starting from the next
+    # in rotation, until one has tasks for it. Each node shares its own projects out by weight
+    @cherrypy.expose
+    def getTasks(self):
+        data = cherrypy.request.body.read()
+        try:
+            pname = readBody(data).get("pname")
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+        if pname is not None:
+            return relay(str(pname), "/getTasks", data, codecHeaders())
+
+        acquireAny()
+        try:
+            nodes = ring.nodes
+            first = next(rotation)
+            for i in range(len(nodes)):
+                r = forward(nodes[(first + i) % len(nodes)], "/getTasks", data, codecHeaders())
+                response = r.read()
+                body = readResponse(r.headers, response)
+                if not body["success"] or body["taskIDs"]:
+                    break
+        except Exception as e:
+            return errormsg("Node unavailable: " + str(e))
+        finally:
+            done(None)
+
+        passOn(r)
+        return response
+
+    # Each task is returned to the node holding its project
+    @cherrypy.expose
+    def sendTasks(self):
+        try:
+            body = readBody(cherrypy.request.body.read())
+            token = body["token"]
+            tasks = body["tasks"]
+            pnames = [str(pname) for pname in tasks]
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        for pname in pnames:
+            data = relay(pname, "/sendTasks", reencode({"token": token, "tasks": {pname: tasks[pname]}}), codecHeaders(False))
+            if not readResponse(cherrypy.response.headers, data)["success"]:
+                return data
+        return success()
+
+    # The metrics of every node, with each sample labelled by the node it came from
+    @cherrypy.expose
+    def metrics(self):
+        families = {}   # Maps a metric family's name to [its HELP and TYPE lines, its samples]
+        for node in ring.nodes:
+            try:
+                text = forward(node, "/metrics").read().decode("utf-8")
+            except Exception:
+                continue
+
+            label = 'node="' + node + '"'
+            for line in text.splitlines():
+                if line.startswith("# "):
+                    family = families.setdefault(line.split(" ")[2], [[], []])
+                    if line not in family[0]:
+                        family[0].append(line)
+                elif line:
+                    (sample, sep, value) = line.rpartition(" ")
+                    if sample.endswith("}"):
+                        sample = sample[:-1] + "," + label + "}"
+                    else:
+                        sample = sample + "{" + label + "}"
+                    family[1].append(sample + " " + value)
+
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return "".join(line + "\n" for (head, samples) in families.values() for line in head + samples).encode("utf-8")
+
+    # Programs are named only by hash, so ask each node in turn
+    @cherrypy.expose
+    def getProgram(self, hash):
+        headers = {h: cherrypy.request.headers[h] for h in ["If-None-Match", "Accept-Encoding"] if h in cherrypy.request.headers}
+
+        for node in ring.nodes:
+            try:
+                r = forward(node, "/getProgram?hash=" + str(hash), b'', headers)
+                data = r.read()
+            except Exception:
+                continue
+            if r.status in [200, 304]:
+                passOn(r)
+                return data
+        raise cherrypy.HTTPError(404, "Failed to find blob")
+
+    @cherrypy.expose
+    def getGraphs(self, pname, **params):
+        headers = {h: cherrypy.request.headers[h] for h in ["If-None-Match", "Accept-Encoding"] if h in cherrypy.request.headers}
+        return relay(str(pname), cherrypy.request.request_line.split()[1], b'', headers)
+
+    # The project is named in the stream header. The blob is passed on as it arrives
+    @cherrypy.expose
+    def createNewBlobStream(self):
+        body = cherrypy.request.body
+        try:
+            prefix = body.read(4)
+            (n,) = struct.unpack(">I", prefix)
+            if n > MAX_STREAM_HEADER:
+                raise ValueError("Stream header too long")
+            head = body.read(n)
+            pname = str(cbor.loads(head)["pname"])
+        except Exception:
+            return errormsg("Incorrectly encoded stream header")
+
+        def stream():
+            yield prefix + head
+            while True:
+                data = body.read(CHUNK)
+                if not data:
+                    return
+                yield data
+
+        headers = {}
+        if "Content-Length" in cherrypy.request.headers:
+            headers["Content-Length"] = cherrypy.request.headers["Content-Length"]
+        return relay(pname, "/createNewBlobStream", stream(), headers)
+
+    @cherrypy.expose
+    @cherrypy.config(**{'response.stream': True})
+    def getBlobStream(self):
+        data = cherrypy.request.body.read()
+        try:
+            pname = str(readBody(data)["pname"])
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        node = acquire(pname)
+        try:
+            r = forward(node, "/getBlobStream", data, codecHeaders())
+        except Exception as e:
+            done(pname)
+            return errormsg("Node unavailable: " + str(e))
+
+        cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+        if r.getheader("Content-Length") is not None:
+            cherrypy.response.headers["Content-Length"] = r.getheader("Content-Length")
+
+        def stream():
+            try:
+                while True:
+                    chunk = r.read(CHUNK)
+                    if not chunk:
+                        return
+                    yield chunk
+            finally:
+                done(pname)
+        return stream()
+
+    # Every other request names its project in its body
+    @cherrypy.expose
+    def default(self, name, **params):
+        data = cherrypy.request.body.read()
+        try:
+            pname = str(readBody(data)["pname"])
+        except Exception:
+            return errormsg("Invalid inputs")
+        return relay(pname, "/" + name, data, codecHeaders())
+
+def startShards():
+    env = dict(os.environ, SHARD_SECRET=secret)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for n in range(SHARDS):
+        shards.append(subprocess.Popen([sys.executable, os.path.join(here, "server.py"), "--shard", str(n)], env=env))
+
+def stopShards():
+    for p in shards:
+        p.terminate()
+    for p in shards:
+        p.wait()
+
+if __name__ == '__main__':
+    if "--join" in sys.argv:
+        node = sys.argv[sys.argv.index("--join") + 1]
+        data = call("127.0.0.1:" + str(SERVER_PORT), "/addNode", {"secret": secret, "address": node})
+        sys.exit(0 if data["success"] else "Failed to add node: " + data["error"])
+
+    nodes = sys.argv[1:]
+    if not nodes:
+        startShards()
+        atexit.register(stopShards)
+        nodes = [NODE_HOST + ":" + str(SERVER_PORT + 1 + n) for n in range(SHARDS)]
+    ring = HashRing(nodes)
+
+    cherrypy.config.update({'server.socket_host': '0.0.0.0',
+                            'server.socket_port': SERVER_PORT,
+                            'server.thread_pool': SERVER_THREADS,
+                            'engine.autoreload.on': False
+                            })
+    cherrypy.quickstart(RouterServer())
@@ -0,0 +1,92 @@
+# Fair-share scheduling of workers across projects
+import heapq, threading
+
+# Chooses the project whose tasks a worker is given when it asks for tasks from any project, by
+# weighted fair queuing. Each project has a weight, 1 unless set, and a virtual time which advances
+# by 1/weight for every task it issues, so that over time projects are issued tasks in proportion
+# to their weights. The next project is the active one with the lowest virtual time, which a heap
+# finds in O(log projects). A project is active while it may have tasks waiting. One found to have
+# none sleeps until a time when leases it issued may run out, or until it is woken by new tasks. A
+# project starts from the current virtual time when it wakes, so that time spent idle does not earn
+# it a burst of tasks afterwards.
+class FairScheduler:
+    def __init__(self):
+        self.weights = {}   # Maps a project name to its weight, if not 1
+        self.tags = {}      # Maps a project name to its virtual time
+        self.active = set() # Names of the projects which may have tasks waiting
+        self.heap = []      # Heap of (virtual time, name) of active projects. May hold stale entries
+        self.wakes = {}     # Maps the name of a sleeping project to the time it wakes, if any
+        self.sleeping = []  # Heap of (wake time, name). May hold stale entries
+        self.vtime = 0      # Virtual time of the project chosen last
+        self.lock = threading.Lock()
+
+    def setWeight(self, pname, weight):
+        with self.lock:
+            self.weights[pname] = weight
+
+    def getWeight(self, pname):
+        return self.weights.get(pname, 1)
+
+    # Marks a project as having tasks waiting
+    def wake(self, pname):
+        with self.lock:
+            self.activate(pname)
+
+    # Marks a project as having no tasks waiting until time until, or until it is woken if until is None
+    def sleep(self, pname, until):
+        with self.lock:
+            self.active.discard(pname)
+            if until is not None:
+                self.wakes[pname] = until
+                heapq.heappush(self.sleeping, (until, pname))
+
+    # Forgets a project which has been deleted
+    def remove(self, pname):
+        with self.lock:
+            self.active.discard(pname)
+            self.tags.pop(pname, None)
+            self.weights.pop(pname, None)
+            self.wakes.pop(pname, None)
+
+    # Counts n tasks issued by a project against its share
+    def charge(self, pname, n):
+        with self.lock:
+            tag = self.tags.get(pname, self.vtime) + n / self.getWeight(pname)
+            self.tags[pname] = tag
+            if pname in self.active:
+                heapq.heappush(self.heap, (tag, pname))
+
+            # Rebuild the heaps once they are mostly stale entries, so that memory stays bounded
+            if len(self.heap) > 2*len(self.active) + 1024:
+                self.heap = [(self.tags[p], p) for p in self.active]
+                heapq.heapify(self.heap)
+            if len(self.sleeping) > 2*len(self.wakes) + 1024:
+                self.sleeping = [(t, p) for (p, t) in self.wakes.items()]
+                heapq.heapify(self.sleeping)
+
+    # Returns the name of the project to take tasks from next, or None if none has tasks waiting.
+    # Projects due to wake by now are woken first
+    def next(self, now):
+        with self.lock:
+            while self.sleeping and self.sleeping[0][0] <= now:
+                (until, pname) = heapq.heappop(self.sleeping)
+                if self.wakes.get(pname) == until:
+                    self.activate(pname)
+
+            while self.heap:
+                (tag, pname) = self.heap[0]
+                if pname in self.active and self.tags[pname] == tag:
+                    self.vtime = tag
+                    return pname
+                heapq.heappop(self.heap)
+
+            return None
+
+    # Must be called with lock held
+    def activate(self, pname):
+        self.wakes.pop(pname, None)
+        if pname in self.active:
+            return
+        self.active.add(pname)
+        tag = self.tags[pname] = max(self.tags.get(pname, 0), self.vtime)
+        heapq.heappush(self.heap, (tag, pname))
@@ -1,12 +1,28 @@
-import cherrypy, os, cbor
+import cherrypy, os, sys, cbor, struct
 from urllib.parse import urlparse
-import database
+import header
 from header import *
+from dispatch import parseDevice
+import codec, compressor, metrics
+from codec import isBytes
+
+# Under router.py, each shard process is started with --shard and keeps its own data
+shard = None
+if "--shard" in sys.argv:
+    shard = int(sys.argv[sys.argv.index("--shard") + 1])
+    header.BLOBSTORE_PATH = BLOBSTORE_PATH = BLOBSTORE_PATH + "." + str(shard)
+    header.DATABASE_PATH = DATABASE_PATH = DATABASE_PATH + "." + str(shard)
+    header.JOURNAL_PATH = JOURNAL_PATH = JOURNAL_PATH + "." + str(shard)
+shardsecret = os.environ.get("SHARD_SECRET")   # Proves that a request comes from the router
+
+if DATABASE_BACKEND == "sqlite":
+    import sqldatabase as database
+    database.openDatabase(DATABASE_PATH)
+else:
+    import database
 from time import mktime
 from datetime import datetime
 
-import json
-
 global debug
 debug = True
 
@@ -18,25 +34,91 @@ def log(msg):
 def getTime():
     return mktime(datetime.now().timetuple())*1000
 
-
-# Checks whether the session is currently active
-def checkSessionActive(token):
-    if not database.querySession(token, "username")[0]:
-        return False
-
-    sessiontime = database.querySession(token, "starttime")[1]
-    if sessiontime + SESSION_EXPIRE < getTime():
-        return False
-
-    return True
-
+# Part of every graph ETag, so that versions from before a restart never match
+boottime = int(getTime())
+
+
+# Returns the session of token if it is currently active, or None. Each request resolves its
+# session once, and reads the username and access level from it
+def activeSession(token):
+    (succ, session) = database.getSession(token)
+    if not succ:
+        return None
+    return session
+
+# True iff body carries the shard secret, and so comes from router.py
+def fromRouter(body):
+    return shardsecret is not None and body.get("secret") == shardsecret
+
+
+# Decodes the request body in the codec named by its Content-Type, once it is decompressed as named
+# by its Content-Encoding, to at most MAX_BODY_SIZE bytes. If views is true, blobs in it may be
+# memoryviews of the body
+def readBody(views=False):
+    data = compressor.decompress(cherrypy.request.headers.get("Content-Encoding"), cherrypy.request.body.read(), MAX_BODY_SIZE)
+    return codec.decode(cherrypy.request.headers.get("Content-Type"), data, views)
+
+# Encodes a response in the codec the client accepts, or else the one its request was sent in, or
+# else default. It is compressed if the endpoint has levels in COMPRESS_LEVELS
+def respond(d, default=codec.CBOR):
+    t = codec.negotiate(cherrypy.request.headers, default)
+    cherrypy.response.headers["Content-Type"] = t
+    return compress(codec.encode(t, d))
+
+# Compresses an encoded response body in the encoding the client accepts, at the endpoint's level
+def compress(body):
+    endpoint = cherrypy.request.path_info.strip("/")
+    if endpoint not in COMPRESS_LEVELS:
+        return body
+
+    cherrypy.response.headers["Vary"] = "Accept-Encoding"
+    size = len(body) if type(body) is bytes else sum(len(chunk) for chunk in body)
+    (encoding, level) = compressor.choose(cherrypy.request.headers.get("Accept-Encoding"), endpoint, size)
+    if encoding is None:
+        return body
+    cherrypy.response.headers["Content-Encoding"] = encoding
+    return compressor.compress(encoding, body, level)
+
+# Like respond, but the blob d[key] is sent as its stored compressed copy, as returned by
+# stored(encoding), if the client accepts an encoding it has one in. The rest of the body is
+# compressed in front of it, as compressor.prepend() does
+def respondBlob(d, key, stored, default=codec.CBOR):
+    t = codec.negotiate(cherrypy.request.headers, default)
+    endpoint = cherrypy.request.path_info.strip("/")
+    (encoding, level) = compressor.choose(cherrypy.request.headers.get("Accept-Encoding"), endpoint, len(d[key]))
+    head = codec.encodeHead(t, d, key) if encoding is not None else None
+    if head is not None:
+        (succ, copy) = stored(encoding)
+        if succ:
+            cherrypy.response.headers["Content-Type"] = t
+            cherrypy.response.headers["Content-Encoding"] = encoding
+            cherrypy.response.headers["Vary"] = "Accept-Encoding"
+            return compressor.prepend(encoding, head, level, copy, d[key])
+    return respond(d, default)
 
 # Generic Responses
 def errormsg(m):
-    return(cbor.dumps({'success': False, 'error': m}))
+    metrics.failed()
+    return respond({'success': False, 'error': m})
 
 def success():
-    return(cbor.dumps({'success': True, 'error': ''}))
+    return respond({'success': True, 'error': ''})
+
+# Streamed bodies start with a small CBOR header, prefixed by its length as a 4 byte big-endian
+# integer. The raw blob follows the header
+def readStreamHeader(body):
+    (n,) = struct.unpack(">I", body.read(4))
+    if n > MAX_STREAM_HEADER:
+        raise ValueError("Stream header too long")
+    return (4 + n, cbor.loads(body.read(n)))
+
+def streamHeader(d):
+    h = cbor.dumps(d)
+    return struct.pack(">I", len(h)) + h
+
+def streamErrormsg(m):
+    metrics.failed()
+    return streamHeader({'success': False, 'error': m})
 
 
 class RootServer:
@@ -44,12 +126,19 @@ class RootServer:
     def ping(self):
         return success()
 
+    # Returns the request counts, errors and latencies of every endpoint, and gauges of the sessions,
+    # tasks, blobs and graphs of every project, in the Prometheus text format
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.render(database.getMetrics()).encode("utf-8")
+
 
     @cherrypy.expose
     def register(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -68,8 +157,17 @@ class RootServer:
         if accesslevel not in ["customer", "worker"]:
             accesslevel = "worker"
 
+        # A worker may prefer to save mobile data and battery, and be given only small tasks when it would use them
+        try:
+            prefwifidata = body.get("prefwifidata", True)
+            prefbattery = body.get("prefbattery", True)
+            if type(prefwifidata) is not bool or type(prefbattery) is not bool:
+                raise ValueError
+        except Exception:
+            return errormsg("Invalid preferences")
+
         # Registers a new user
-        if not database.register(username, password, accesslevel):
+        if not database.register(username, password, accesslevel, prefwifidata, prefbattery):
             return errormsg("Registration failed.")
 
         return success()
@@ -80,7 +178,7 @@ class RootServer:
     def login(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -101,18 +199,32 @@ class RootServer:
         if accesslevel not in ["customer", "worker"]:
             accesslevel = "worker"
 
-        (succ, token) = database.login(username, password, accesslevel)
+        # A worker may report what its device is capable of, which decides whether it is given large tasks
+        device = None
+        if "device" in body:
+            (succ, device) = parseDevice(body["device"])
+            if not succ:
+                return errormsg(device)
+
+        # The router picks the token, so that every shard gives out the same one
+        token = None
+        if fromRouter(body):
+            token = str(body["token"])
+
+        (succ, token) = database.login(username, password, accesslevel, token)
         if not succ:
             return errormsg("Login failed. Invalid username or password.")
+        if device is not None:
+            database.setDevice(token, device)
 
-        return cbor.dumps({'success': True, 'error': '', 'token': token})
+        return respond({'success': True, 'error': '', 'token': token})
         
     # token
     @cherrypy.expose
     def logout(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -123,12 +235,11 @@ class RootServer:
             return errormsg("Invalid token")
 
         # Check that the user has an active session
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
-        username = database.querySession(token, "username")[1]
-        
-        database.logoutGraphUpdate(username)
+        database.logoutGraphUpdate(session["username"])
         database.deleteSession(token, "token")
 
         return success()
@@ -140,7 +251,7 @@ class RootServer:
     def createNewProject(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -153,10 +264,11 @@ class RootServer:
             return errormsg("Invalid inputs")
 
 
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
-        if database.querySession(token, "accesslevel")[1] != "customer":
+        if session["accesslevel"] != "customer":
             return errormsg("Invalid access level")
         
         if not database.createNewProject(pname, pdescription):
@@ -169,7 +281,7 @@ class RootServer:
     def createNewBlob(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody(True)
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -182,18 +294,62 @@ class RootServer:
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not (type(blob) is bytes and type(metadata) is bytes):
+        if not (isBytes(blob) and isBytes(metadata)):
             return errormsg("Invalid blob or metadata type - should be bytes")
+        metadata = bytes(metadata)
 
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
         
-        if database.querySession(token, "accesslevel")[1] != "customer":
+        if session["accesslevel"] != "customer":
             return errormsg("Invalid access level.")
 
         (succ, blobID) = database.createNewBlob(pname, blob, metadata)
         if succ:
-            return(cbor.dumps({'success': True, 'error': '', 'blobID': blobID}))
+            return respond({'success': True, 'error': '', 'blobID': blobID})
+        else:
+            return errormsg("Database failure: " + str(blobID))
+
+    # Streaming variant of createNewBlob, which stores the blob without holding it in memory
+    # Stream header: token, pname, metadata
+    @cherrypy.expose
+    def createNewBlobStream(self):
+        body = cherrypy.request.body
+
+        # Get the stream header
+        try:
+            (headlen, head) = readStreamHeader(body)
+        except Exception:
+            return errormsg("Incorrectly encoded stream header")
+
+        # Sanity check inputs, check access level
+        try:
+            token = str(head["token"])
+            pname = str(head["pname"])
+            metadata = head["metadata"]
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        if not type(metadata) is bytes:
+            return errormsg("Invalid metadata type - should be bytes")
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level.")
+
+        # The blob is the rest of the body, or everything up to end of file if it is sent chunked
+        try:
+            size = int(cherrypy.request.headers["Content-Length"]) - headlen
+        except Exception:
+            size = None
+
+        (succ, blobID) = database.createNewBlobStream(pname, body.read, size, metadata)
+        if succ:
+            return respond({'success': True, 'error': '', 'blobID': blobID})
         else:
             return errormsg("Database failure: " + str(blobID))
 
@@ -202,7 +358,7 @@ class RootServer:
     def blobToTask(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -214,25 +370,112 @@ class RootServer:
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
         
-        if database.querySession(token, "accesslevel")[1] != "customer":
+        if session["accesslevel"] != "customer":
             return errormsg("Invalid access level.")
 
         (succ, msg) = database.blobToTask(pname, blobID)
         if not succ:
             return errormsg("Database failure: " + msg)
 
-        return(cbor.dumps({'success': True, 'error': ''}))
+        return respond({'success': True, 'error': ''})
         return success()
 
+    ## Batch methods ##
+    # Each item of a batch has its own result, but the batch shares one session check and one
+    # database call
+
+    # Creates a blob for each of blobs, with the corresponding metadata. If tasks is true, each blob is
+    # also checked and converted into a task
+    # token, pname, blobs, metadatas, tasks
+    @cherrypy.expose
+    def createNewBlobs(self):
+        # Get request body
+        try:
+            body = readBody(True)
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs, check access level
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            blobs = list(body["blobs"])
+            metadatas = list(body["metadatas"])
+            totask = bool(body.get("tasks", False))
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        if len(blobs) != len(metadatas):
+            return errormsg("Every blob must have metadata")
+
+        if len(blobs) > MAX_BATCH:
+            return errormsg("Too many blobs in batch. The limit is " + str(MAX_BATCH))
+
+        for b in blobs + metadatas:
+            if not isBytes(b):
+                return errormsg("Invalid blob or metadata type - should be bytes")
+        metadatas = [bytes(m) for m in metadatas]
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level.")
+
+        (succ, results) = database.createNewBlobs(pname, blobs, metadatas, totask)
+        if not succ:
+            return errormsg("Database failure: " + results)
+
+        results = [{'success': True, 'error': '', 'blobID': r} if succ else {'success': False, 'error': r}
+                for (succ, r) in results]
+        return respond({'success': True, 'error': '', 'results': results})
+
+    # Converts each of blobIDs into a task
+    # token, pname, blobIDs
+    @cherrypy.expose
+    def blobsToTasks(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs, check access level
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            blobIDs = [str(b) for b in body["blobIDs"]]
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        if len(blobIDs) > MAX_BATCH:
+            return errormsg("Too many blobs in batch. The limit is " + str(MAX_BATCH))
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level.")
+
+        (succ, results) = database.blobsToTasks(pname, blobIDs)
+        if not succ:
+            return errormsg("Database failure: " + results)
+
+        results = [{'success': succ, 'error': msg} for (succ, msg) in results]
+        return respond({'success': True, 'error': '', 'results': results})
+
     # Token, pname, blobIDs
     @cherrypy.expose
     def getBlobMetadata(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -243,26 +486,98 @@ class RootServer:
             blobIDs = []
             for i, blob in enumerate(body["blobIDs"]):
                 blobIDs.append(str(blob))
+            after = int(body.get("after", -1))
+            limit = min(max(int(body.get("limit", PAGE_SIZE)), 1), PAGE_SIZE)
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not checkSessionActive(token):
+        if len(blobIDs) > MAX_BATCH:
+            return errormsg("Too many blob IDs. At most " + str(MAX_BATCH) + " per request.")
+
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
         
-        if database.querySession(token, "accesslevel")[1] != "customer":
+        if session["accesslevel"] != "customer":
             return errormsg("Invalid access level.")
 
-        (succ, metas) = database.getBlobMetadata(pname, blobIDs)
+        (succ, metas, after) = database.getBlobMetadata(pname, blobIDs, after, limit)
         if not succ:
             return errormsg("Database failure: " + metas)
-        return(cbor.dumps({'success': True, 'error': '', 'metadata': metas}))
-    
+        return respond({'success': True, 'error': '', 'metadata': metas, 'next': after})
+
+    # Customer only
+    # token, pname, seq, limit (optional)
+    # Returns the changes to the project's blobs after sequence number seq, oldest first
+    @cherrypy.expose
+    def getChanges(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs, check access level
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            seq = int(body["seq"])
+            limit = min(max(int(body.get("limit", PAGE_SIZE)), 1), PAGE_SIZE)
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level.")
+
+        (succ, changes, latest) = database.getChanges(pname, seq, limit)
+        if not succ:
+            return errormsg("Database failure: " + changes)
+        return respond({'success': True, 'error': '', 'changes': changes, 'latest': latest})
+
+    # Customer only
+    # token, pname, cursor, timeout (optional), limit (optional)
+    # Blocks until result blobs newer than cursor exist, or timeout milliseconds pass, then returns
+    # the metadata of up to limit of them and the cursor to pass next
+    @cherrypy.expose
+    def waitForResults(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs, check access level
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            cursor = int(body["cursor"])
+            timeout = min(max(int(body.get("timeout", RESULT_WAIT_MAX)), 0), RESULT_WAIT_MAX)
+            limit = min(max(int(body.get("limit", PAGE_SIZE)), 1), PAGE_SIZE)
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level.")
+
+        (succ, results, cursor) = database.waitForResults(pname, cursor, timeout, limit)
+        if not succ:
+            return errormsg("Database failure: " + results)
+        return respond({'success': True, 'error': '', 'metadata': dict(results), 'cursor': cursor})
+
     @cherrypy.expose
     # token, pname, name
     def getBlob(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -274,7 +589,7 @@ class RootServer:
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not checkSessionActive(token):
+        if activeSession(token) is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
         (succ, b, m) = database.getBlob(pname, name)
@@ -282,14 +597,86 @@ class RootServer:
         if not succ:
             return errormsg("Database error")
 
-        return cbor.dumps({'success': True, 'error': '', 'blob': b, 'metadata': m})
+        return respondBlob({'success': True, 'error': '', 'metadata': m, 'blob': b}, 'blob',
+            lambda encoding: database.getCompressedBlob(pname, name, encoding))
+
+    # Streaming variant of getBlob. Responds with a stream header holding success, error, size and
+    # metadata, followed by the raw blob, sent in chunks straight from the blob store
+    # token, pname, name
+    @cherrypy.expose
+    @cherrypy.config(**{'response.stream': True})
+    def getBlobStream(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return streamErrormsg("Incorrectly encoded body")
+
+        # Sanity check inputs, check access level
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            name = str(body["name"])
+        except Exception:
+            return streamErrormsg("Invalid inputs")
+
+        if activeSession(token) is None:
+            return streamErrormsg("Session expired or invalid token in logout. Please try again.")
+
+        (succ, size, chunks, m) = database.streamBlob(pname, name)
+        if not succ:
+            return streamErrormsg("Database error")
+
+        head = streamHeader({'success': True, 'error': '', 'size': size, 'metadata': m})
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        cherrypy.response.headers['Content-Length'] = str(len(head) + size)
+
+        def stream():
+            yield head
+            yield from chunks
+        return stream()
+
+    # hash
+    # Returns the raw contents of the blob with the given hash, as named in the programs of getTasks.
+    # The contents of a hash never change, so the response may be cached anywhere for as long as
+    # wanted, and a request whose If-None-Match holds the hash gets an empty 304 response. If the
+    # blob has a stored copy compressed in an encoding the client accepts, that is sent instead,
+    # tagged with the hash and the encoding
+    @cherrypy.expose
+    @cherrypy.config(**{'response.stream': True})
+    def getProgram(self, hash):
+        hash = str(hash)
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        # Every encoding of a hash holds the same contents, so any of their tags is still valid
+        tag = cherrypy.request.headers.get("If-None-Match")
+        if tag is not None and tag.strip('"').split("-")[0] == hash:
+            cherrypy.response.status = 304
+            cherrypy.response.headers['ETag'] = tag
+            return b''
+
+        etag = '"' + hash + '"'
+        encoding = compressor.negotiate(cherrypy.request.headers.get("Accept-Encoding"), BLOB_COMPRESS_LEVELS)
+        (succ, size, chunks) = database.streamCompressedHash(hash, encoding) if encoding is not None else (False, "", 0)
+        if succ:
+            etag = '"' + hash + "-" + encoding + '"'
+            cherrypy.response.headers['Content-Encoding'] = encoding
+        else:
+            (succ, size, chunks) = database.streamHash(hash)
+            if not succ:
+                raise cherrypy.HTTPError(404, size)
+
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        cherrypy.response.headers['Content-Length'] = str(size)
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return chunks
 
     # token, pname, blobID
     @cherrypy.expose
     def deleteBlob(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -301,13 +688,11 @@ class RootServer:
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
-        (succ, accesslevel) = database.querySession(token, "accesslevel")
-        if not succ:
-            return errormsg("Database could not identify accesslevel. Invalud session.")
-        if accesslevel != "customer":
+        if session["accesslevel"] != "customer":
             return errormsg("Invalid access level.")
 
         (succ, msg) = database.deleteBlob(pname, blobID)
@@ -320,29 +705,101 @@ class RootServer:
     def getTasks(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
         # Sanity check inputs, check access level
         try:
             token = str(body["token"])
-            username = database.querySession(token, "username")[1]
-            print("Session name: " + username)
-            pname = str(body["pname"])
-            maxtasks = int(body["maxtasks"])
+            pname = body.get("pname")
+            if pname is not None:
+                pname = str(pname)
+            maxtasks = body.get("maxtasks")
+            if maxtasks is not None:
+                maxtasks = int(maxtasks)
+            held = set(str(h) for h in body.get("programs", []))
+            budget = min(max(int(body.get("prefetch", 0)), 0), PREFETCH_MAX)
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
-        (succ, tasks, taskIDs) = database.getTasks(pname, username, maxtasks)
+        # Device hints sent with the request replace those sent at login
+        if "device" in body:
+            (succ, device) = parseDevice(body["device"])
+            if not succ:
+                return errormsg(device)
+            database.setDevice(token, device)
+
+        username = session["username"]
+        large = database.takesLargeTasks(username, session.get("device"))
+
+        # The worker is given as many tasks as it completes in about BATCH_INTERVAL, and no more than
+        # any maxtasks it asked for. Until its rate is measured, it is given maxtasks, or else one
+        suggested = database.suggestBatch(username)
+        if maxtasks is None:
+            maxtasks = suggested or 1
+        elif suggested is not None:
+            maxtasks = min(maxtasks, suggested)
+
+        # Without a project name, the scheduler picks the project
+        if pname is None:
+            (succ, pname, tasks, taskIDs) = database.scheduleTasks(username, maxtasks, large)
+            if not succ:
+                return errormsg("Database failed: " + pname)
+            if pname is None:
+                return respond({"success": True, "error": "", "pname": None, "tasks": [], "taskIDs": [], "programs": {},
+                    "blobs": {}, "deferred": [], "leaseTime": LEASE_TIME, "batchSize": suggested or maxtasks})
+        else:
+            (succ, tasks, taskIDs) = database.getTasks(pname, username, maxtasks, large)
+            if not succ:
+                return errormsg("Database failed: " + tasks)
+
+        # Name the programs of the tasks by hash, leaving out those the worker already holds
+        (succ, programs) = database.getPrograms(pname, tasks)
+        if not succ:
+            return errormsg("Database failed: " + programs)
+        programs = {pID: prog for (pID, prog) in programs.items() if prog["hash"] not in held}
+
+        # Send the input blobs of the tasks along with them, up to the worker's byte budget
+        (succ, inline, deferred) = database.getInputBlobs(pname, tasks, budget)
         if not succ:
-            return errormsg("Database failed: " + tasks)
+            return errormsg("Database failed: " + inline)
 
         # Returns a list of up to maxtasks tasks
-        return cbor.dumps({"success": True, "error": "", "tasks": tasks, "taskIDs": taskIDs})
+        return respond({"success": True, "error": "", "pname": pname, "tasks": tasks, "taskIDs": taskIDs, "programs": programs,
+            "blobs": inline, "deferred": deferred, "leaseTime": LEASE_TIME, "batchSize": suggested or maxtasks})
+
+    # Extends the leases on tasks that are taking a long time, so that they are not reissued
+    # token, pname, taskIDs
+    @cherrypy.expose
+    def renewLeases(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            taskIDs = [str(t) for t in body["taskIDs"]]
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        (succ, renewed) = database.renewLeases(pname, session["username"], taskIDs)
+        if not succ:
+            return errormsg("Database failed: " + renewed)
+
+        return respond({"success": True, "error": "", "taskIDs": renewed, "leaseTime": LEASE_TIME})
 
     # Takes the token, the customer name and project name being worked on, the task ID, and blobsandmetas, a list of
     # tuples mapping each blob to its metadata
@@ -351,21 +808,22 @@ class RootServer:
     def sendTasks(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody(True)
         except Exception:
             return errormsg("Incorrectly encoded body")
 
         # Sanity check inputs, check access level
         try:
             token = str(body["token"])
-            username = database.querySession(token, "username") [1]
             tasks = body["tasks"]
         except Exception:
             return errormsg("Invalid inputs")
 
-        if not checkSessionActive(token):
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
+        username = session["username"]
 
 
         for pname, project in tasks.items():
@@ -384,7 +842,7 @@ class RootServer:
                 else:
                     results = []
                 for b in results:
-                    if not type(b) is bytes:
+                    if not isBytes(b):
                         return errormsg("Tasks were not of type bytes")
 
                 (succ, msg) = database.sendTasks(pname, taskID, results, [meta]*len(results), username, task["status"])
@@ -396,22 +854,138 @@ class RootServer:
     @cherrypy.expose
     def reboot(self):
         if not PRODUCTION:
+            # A test server starts afresh, without the users and projects of earlier runs
+            database.wipe()
             cherrypy.engine.restart()
             return success()
 
     @cherrypy.expose
     def getProjectsList(self):
-        projects = {}
-        for pname, project in database.projects.items():
-            projects[pname] = {"description": project["description"]}
-        return(cbor.dumps({'success': True, 'error': '', "projects": projects}))
+        projects = database.getProjectsList()
+        return respond({'success': True, 'error': '', "projects": projects})
+
+    ## Router methods ##
+    # router.py moves projects between servers with these, and copies users to a new server. They
+    # carry the shard secret
+
+    # secret, pname
+    @cherrypy.expose
+    def exportProject(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        if not fromRouter(body):
+            return errormsg("Invalid access level.")
+
+        try:
+            pname = str(body["pname"])
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        (succ, dump) = database.exportProject(pname)
+        if not succ:
+            return errormsg("Database error: " + dump)
+
+        return respond({'success': True, 'error': '', 'project': dump})
+
+    # secret, pname, project
+    @cherrypy.expose
+    def importProject(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        if not fromRouter(body):
+            return errormsg("Invalid access level.")
+
+        try:
+            pname = str(body["pname"])
+            dump = body["project"]
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        (succ, msg) = database.importProject(pname, dump)
+        if not succ:
+            return errormsg("Database error: " + msg)
+
+        return success()
+
+    # secret, pname
+    @cherrypy.expose
+    def dropProject(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        if not fromRouter(body):
+            return errormsg("Invalid access level.")
+
+        try:
+            pname = str(body["pname"])
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        (succ, msg) = database.dropProject(pname)
+        if not succ:
+            return errormsg("Database error: " + msg)
+
+        return success()
+
+    # secret
+    @cherrypy.expose
+    def exportUsers(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        if not fromRouter(body):
+            return errormsg("Invalid access level.")
+
+        (succ, dump) = database.exportUsers()
+        return respond({'success': True, 'error': '', 'users': dump})
 
-    #pname, precision, kind (where kind in ["standardGraphs", "customGraphs"])
+    # secret, users
     @cherrypy.expose
-    def getGraphs(self, pname, prec, kind):
+    def importUsers(self):
         # Get request body
         try:
-            prec = int(prec)
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        if not fromRouter(body):
+            return errormsg("Invalid access level.")
+
+        try:
+            dump = body["users"]
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        (succ, msg) = database.importUsers(dump)
+        if not succ:
+            return errormsg("Database error: " + msg)
+
+        return success()
+
+    #pname, precision, kind (where kind in ["standardGraphs", "customGraphs"]), since
+    # The precision is in milliseconds, or one of the letters in PRECISIONS. If since is given, only
+    # the points from since onwards are returned. The ETag holds the version of the graphs; a
+    # request whose If-None-Match holds the current version gets an empty 304 response
+    @cherrypy.expose
+    def getGraphs(self, pname, prec, kind, since=0):
+        # Get request body
+        try:
+            prec = PRECISIONS[prec] if prec in PRECISIONS else int(prec)
+            since = int(since)
             pname = str(pname)
             kind = str(kind)
         except Exception:
@@ -420,33 +994,25 @@ class RootServer:
         if not kind in ["standardGraphs", "customGraphs"]:
             return errormsg("Invalid kind. Must be 'standardGraphs' or 'customgraphs'.")
 
-        try:
-            description = database.projects[pname]["description"]
-        except Exception:
+        (succ, version) = database.getGraphsVersion(pname, kind)
+        if not succ:
             return errormsg("Project does not exist.")
 
-        (succ, graphs) = database.getGraphs(pname, kind)
+        etag = '"%d-%s-%d-%d-%d"' % (boottime, kind, prec, since, version)
+        cherrypy.response.headers["ETag"] = etag
+        if cherrypy.request.headers.get("If-None-Match") == etag:
+            cherrypy.response.status = 304
+            return b''
+
+        (succ, description) = database.getDescription(pname)
         if not succ:
-            return errormsg("Database error: " + graphs)
+            return errormsg("Project does not exist.")
 
-        if prec > 1:
-            graphs2 = {}
-            for name, data in graphs.items():
-                newdata = []
-                prevtime = 0
-                for (timecode, datum) in data:
-                    t = timecode - (timecode % prec)
-                    if t == prevtime:
-                        newdata = newdata[:-1]
-                    newdata.append(tuple((t, datum)))
-                    prevtime = t
-
-                graphs2[name] = newdata
-        
-        else:
-            graphs2 = graphs
+        (succ, graphs) = database.getGraphs(pname, kind, prec, since)
+        if not succ:
+            return errormsg("Database error: " + graphs)
 
-        return json.dumps({'success': True, 'error': '', "graphs": graphs2, "description": description})
+        return respond({'success': True, 'error': '', "graphs": graphs, "description": description, "version": version}, codec.JSON)
 
     # Customer only
     # token, customGraphs
@@ -454,7 +1020,7 @@ class RootServer:
     def updateCustomGraphs(self):
         # Get request body
         try:
-            body = cbor.loads(cherrypy.request.body.read())
+            body = readBody()
         except Exception:
             return errormsg("Incorrectly encoded body")
 
@@ -466,23 +1032,103 @@ class RootServer:
         except Exception:
             return errormsg("Invalid inputs")
 
-        if database.querySession(token, "accesslevel")[1] != "customer":
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level")
+
+        (succ, err) = database.updateCustomGraphs(customGraphs, pname)
+        if not succ:
+            return errormsg("Database error: " + err)
+
+        return success()
+
+    # Sets the share of the workers asking for tasks from any project which a project is given
+    # token, pname, weight
+    @cherrypy.expose
+    def setProjectWeight(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            weight = float(body["weight"])
+            if not 0 < weight <= MAX_WEIGHT:
+                raise ValueError("Weight out of range")
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        session = activeSession(token)
+        if session is None:
+            return errormsg("Session expired or invalid token in logout. Please try again.")
+
+        if session["accesslevel"] != "customer":
             return errormsg("Invalid access level")
 
-        if not checkSessionActive(token):
+        (succ, err) = database.setProjectWeight(pname, weight)
+        if not succ:
+            return errormsg("Database error: " + err)
+
+        return success()
+
+    # Sets the share of the completed tasks of a project which are run again by another worker to check their results
+    # token, pname, rate
+    @cherrypy.expose
+    def setVerifyRate(self):
+        # Get request body
+        try:
+            body = readBody()
+        except Exception:
+            return errormsg("Incorrectly encoded body")
+
+        # Sanity check inputs
+        try:
+            token = str(body["token"])
+            pname = str(body["pname"])
+            rate = float(body["rate"])
+            if not 0 <= rate <= 1:
+                raise ValueError("Rate out of range")
+        except Exception:
+            return errormsg("Invalid inputs")
+
+        session = activeSession(token)
+        if session is None:
             return errormsg("Session expired or invalid token in logout. Please try again.")
 
-        (succ, err) = database.updateCustomGraphs(customGraphs, pname)
+        if session["accesslevel"] != "customer":
+            return errormsg("Invalid access level")
+
+        (succ, err) = database.setVerifyRate(pname, rate)
         if not succ:
             return errormsg("Database error: " + err)
 
         return success()
 
-        
+# Every endpoint is counted and timed for the metrics endpoint
+for (name, handler) in list(vars(RootServer).items()):
+    if getattr(handler, "exposed", False):
+        setattr(RootServer, name, metrics.instrument(name, handler))
+
 
 if __name__ == '__main__':
-    cherrypy.config.update({'server.socket_host': '0.0.0.0',
-                            'server.socket_port': 8081,
+    if shard is not None:
+        # Only the router talks to shards. It moves whole projects in one request
+        cherrypy.config.update({'server.socket_host': NODE_HOST,
+                                'server.socket_port': SERVER_PORT + 1 + shard,
+                                'server.max_request_body_size': 0,
+                                'engine.autoreload.on': False})
+    else:
+        cherrypy.config.update({'server.socket_host': '0.0.0.0',
+                                'server.socket_port': SERVER_PORT,
+                                'server.max_request_body_size': MAX_BODY_SIZE})
+    cherrypy.config.update({'server.thread_pool': SERVER_THREADS,
                             'tools.sessions.on' : True,
                             'tools.sessions.timeout': 10    # Sessions time out after 10 mins
                             })
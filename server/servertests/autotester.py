@@ -1,7 +1,8 @@
 ## Automated tests for the server
 import sys
 from tests import *
-import time
+import time, io, hashlib, zlib
+from header import MAX_BODY_SIZE
 
 VERBOSE = True  # Set to true if you want all data to be printed
 
@@ -19,6 +20,11 @@ def test(res, testname):
             print(data)
         sys.exit(str(data))
 
+# Returns a task descriptor blob with the given control data and input blob IDs, marked long if slow is true
+def makeTask(control, blobs=[], slow=False):
+    return cbor.dumps({"program": {"id": "0", "size": 0}, "control": control,
+        "blobs": [{"id": b, "size": 0} for b in blobs], "long": slow})
+
 # Start test
 print("Rebooting server...")
 reboot()
@@ -37,11 +43,11 @@ wtok = data["token"]
 
 # Test blob creation
 test(createNewProject(ctok, "Project", "Description"), "testCreateNewProject")
-data = test(createNewBlob(ctok, "Project", b'blob1', b'meta1'), "testCreateNewBlob")
+data = test(createNewBlob(ctok, "Project", makeTask(b'blob1'), cbor.dumps("meta1")), "testCreateNewBlob")
 b1 = data["blobID"]
-data = test(createNewBlob(ctok, "Project", b'blob2', b'meta2'), "testCreateNewBlob")
+data = test(createNewBlob(ctok, "Project", makeTask(b'blob2'), cbor.dumps("meta2")), "testCreateNewBlob")
 b2 = data["blobID"]
-data = test(createNewBlob(ctok, "Project", b'blob3', b'meta3'), "testCreateNewBlob")
+data = test(createNewBlob(ctok, "Project", makeTask(b'blob3'), cbor.dumps("meta3")), "testCreateNewBlob")
 b3 = data["blobID"]
 
 # Test blobs are correctly returned
@@ -49,34 +55,76 @@ data = test(blobToTask(ctok, "Project", b1), "testBlobToTask")
 data = test(blobToTask(ctok, "Project", b2), "testBlobToTask")
 data = test(blobToTask(ctok, "Project", b3), "testBlobToTask")
 
+# Test batches
+data = test(createNewBlobs(ctok, "Project", [makeTask(b'batch1'), b'notatask'], [cbor.dumps("meta5"), cbor.dumps("meta6")], True), "testCreateNewBlobs")
+test((data["results"][0]["success"] and not data["results"][1]["success"], data["results"]), "testCreateNewBlobsResults")
+data = test(createNewBlobs(ctok, "Project", [makeTask(b'batch2')], [cbor.dumps("meta7")]), "testCreateNewBlobs")
+data = test(blobsToTasks(ctok, "Project", [data["results"][0]["blobID"], "999"]), "testBlobsToTasks")
+test((data["results"][0]["success"] and not data["results"][1]["success"], data["results"]), "testBlobsToTasksResults")
+
 data = test(getBlobMetadata(ctok, "Project", []), "testGetBlobMetadata")
+test((len(data["metadata"]) == 5 and data["next"] is None, data), "testGetBlobMetadataAll")
+data = test(getBlobMetadata(ctok, "Project", [b2, b2, "999"]), "testGetBlobMetadata")
+test((list(data["metadata"].keys()) == [b2], data), "testGetBlobMetadataIDs")
+
+# Page through the metadata two blobs at a time
+pages = []
+after = -1
+while after is not None:
+    data = test(getBlobMetadata(ctok, "Project", [], after, 2), "testGetBlobMetadataPage")
+    pages.append(list(data["metadata"].keys()))
+    after = data["next"]
+test((pages == [["0", "1"], ["2", "3"], ["4"]], pages), "testGetBlobMetadataPages")
+
+# Test the changefeed
+data = test(getChanges(ctok, "Project", 0), "testGetChanges")
+test(([c["seq"] for c in data["changes"]] == [1, 2, 3, 4, 5] and data["latest"] == 5, data), "testGetChangesCreated")
+data = test(getChanges(ctok, "Project", 3, 1), "testGetChanges")
+test(([c["blobID"] for c in data["changes"]] == ["3"], data), "testGetChangesPage")
 
 data = test(getBlob(ctok, "Project", b1), "testGetBlob")
 
 data = test(getBlob(ctok, "Project", b2), "testGetBlob")
 data = test(getBlob(ctok, "Project", b3), "testGetBlob")
 
+# Test streaming blobs
+streamed = b'streamed' * 100000
+data = test(createNewBlobStream(ctok, "Project", io.BytesIO(streamed), cbor.dumps("meta4")), "testCreateNewBlobStream")
+b4 = data["blobID"]
+out = io.BytesIO()
+data = test(getBlobStream(ctok, "Project", b4, out), "testGetBlobStream")
+test((out.getvalue() == streamed, len(out.getvalue())), "testGetBlobStreamContents")
+
 # Worker tests
 data = test(getTasks(wtok, "Project", 2), "testGetTasks")
-data = test(getTasks(wtok, "Project", 2), "testGetTasks")
+programs = data["programs"]
+test((list(programs.keys()) == ["0"], programs), "testGetTasksPrograms")
+program = test(getProgram(programs["0"]["hash"]), "testGetProgram")
+test((program["program"] == makeTask(b'blob1') and "immutable" in program["cacheControl"], program), "testGetProgramContents")
+unchanged = test(getProgram(programs["0"]["hash"], program["etag"]), "testGetProgramUnchanged")
+test((unchanged.get("unchanged", False), unchanged), "testGetProgramNotModified")
+test((not getProgram("0" * 64)[0], "Missing program"), "testGetProgramMissing")
+data = test(renewLeases(wtok, "Project", data["taskIDs"]), "testRenewLeases")
+data = test(getTasks(wtok, "Project", 2, [programs["0"]["hash"]]), "testGetTasks")
+test((data["programs"] == {}, data["programs"]), "testGetTasksProgramsHeld")
 data = test(getTasks(wtok, "Project", 2), "testGetTasks")
 
 tasksreturned = {
     "Project": {
         str(b1): {
-            "results": ["resblob1", "resblob2"],
+            "results": [b'resblob1', b'resblob2'],
             "metadatas": [],
             "status": "ok"
         },
 
         str(b2): {
-            "results": ["resblob3", "resblob4"],
+            "results": [b'resblob3', b'resblob4'],
             "metadatas": [],
             "status": "ok"
         },
 
         str(b3): {
-            "results": ["resblob5", "resblob6"],
+            "results": [b'resblob5', b'resblob6'],
             "metadatas": [],
             "status": "ok"
         }
@@ -85,5 +133,209 @@ tasksreturned = {
 
 data = test(sendTasks(wtok, tasksreturned), "testSendTasks")
 
-test(getGraphs("Project", "m"), "testGetGraphs")
-test(getProjectsList(), "testGetProjectsList")
+# Customers are told of the results
+data = test(waitForResults(ctok, "Project", -1, 0), "testWaitForResults")
+test((len(data["metadata"]) == 6, data["metadata"]), "testWaitForResultsCount")
+start = time.time()
+data = test(waitForResults(ctok, "Project", data["cursor"], 500), "testWaitForResultsTimeout")
+test((data["metadata"] == {} and time.time() - start >= 0.5, data), "testWaitForResultsEmpty")
+
+data = test(getGraphs("Project", "s"), "testGetGraphs")
+test((data["graphs"]["tasksCompleted"][-1]["y"] == 3, data["graphs"]["tasksCompleted"]), "testGetGraphsCompleted")
+data = test(getGraphs("Project", "m"), "testGetGraphs")
+test((len(data["graphs"]["tasksCompleted"]) <= 2, data["graphs"]["tasksCompleted"]), "testGetGraphsRollup")
+test(getGraphs("Project", "1", "customGraphs"), "testGetCustomGraphs")
+
+# Incremental graph fetches
+data = test(getGraphs("Project", "s"), "testGetGraphs")
+latest = data["graphs"]["tasksCompleted"][-1]
+# The ETag of a response only matches a request for the same graphs, precision and since
+test((not getGraphs("Project", "s", since=latest["x"], etag=data["etag"])[1].get("unchanged", False), data), "testGetGraphsSinceMoved")
+data = test(getGraphs("Project", "s", since=latest["x"]), "testGetGraphsSince")
+test((data["graphs"]["tasksCompleted"] == [latest], data["graphs"]["tasksCompleted"]), "testGetGraphsSinceLatest")
+unchanged = test(getGraphs("Project", "s", since=latest["x"], etag=data["etag"]), "testGetGraphsUnchanged")
+test((unchanged.get("unchanged", False), unchanged), "testGetGraphsNotModified")
+test((not getGraphs("Project", "m", since=latest["x"], etag=data["etag"])[1].get("unchanged", False), data), "testGetGraphsPrecisionChanged")
+# Input blobs are sent with their tasks, up to the prefetch budget
+test(createNewProject(ctok, "Prefetch", "Description"), "testCreateNewProject")
+small = test(createNewBlob(ctok, "Prefetch", b'small', b''), "testCreateNewBlob")["blobID"]
+large = test(createNewBlob(ctok, "Prefetch", b'large' * 100, b''), "testCreateNewBlob")["blobID"]
+data = test(createNewBlobs(ctok, "Prefetch", [makeTask(b'', [small, large]), makeTask(b'', [small])], [b'', b''], True), "testCreateNewBlobs")
+data = test(getTasks(wtok, "Prefetch", 2, [], 100), "testGetTasksPrefetch")
+test((data["blobs"] == {small: b'small'} and data["deferred"] == [large], data), "testGetTasksPrefetchBudget")
+
+# Workers asking for tasks from any project are shared between projects by weight
+test(createNewProject(ctok, "FairA", "Description"), "testCreateNewProject")
+test(createNewProject(ctok, "FairB", "Description"), "testCreateNewProject")
+test(setProjectWeight(ctok, "FairA", 3), "testSetProjectWeight")
+test((not setProjectWeight(ctok, "FairB", 0)[0], "Zero weight"), "testSetProjectWeightInvalid")
+test(createNewBlobs(ctok, "FairA", [makeTask(b'a')] * 8, [b''] * 8, True), "testCreateNewBlobs")
+test(createNewBlobs(ctok, "FairB", [makeTask(b'b')] * 8, [b''] * 8, True), "testCreateNewBlobs")
+issued = {"FairA": 0, "FairB": 0}
+for i in range(8):
+    data = test(getTasks(wtok, None, 1), "testGetTasksAnyProject")
+    issued[data["pname"]] += len(data["taskIDs"])
+test((issued["FairA"] > issued["FairB"] > 0 and sum(issued.values()) == 8, issued), "testGetTasksFairShare")
+data = test(getTasks(wtok, None, 100), "testGetTasksAnyProject")
+test((len(data["taskIDs"]) > 0 and data["pname"] in issued, data), "testGetTasksAnyProjectBatch")
+
+data = test(getProjectsList(), "testGetProjectsList")
+test((data["projects"]["FairA"]["weight"] == 3, data["projects"]), "testGetProjectsListWeight")
+
+# Large tasks go only to capable workers, and to them first
+test(registerWorker("Mobile", "hunter3"), "testRegisterWorker")
+mtok = test(login("Mobile", "hunter3", "worker", {"charging": False, "wifi": True}), "testLoginWorkerDevice")["token"]
+test(createNewProject(ctok, "Devices", "Description"), "testCreateNewProject")
+data = test(createNewBlobs(ctok, "Devices", [makeTask(b'long1', [], True), makeTask(b'small'), makeTask(b'long2', [], True)],
+    [b''] * 3, True), "testCreateNewBlobs")
+(long1, small, long2) = [r["blobID"] for r in data["results"]]
+data = test(getTasks(mtok, "Devices", 3), "testGetTasksConstrained")
+test((data["taskIDs"] == [small], data["taskIDs"]), "testGetTasksConstrainedSmallOnly")
+data = test(getTasks(mtok, "Devices", 3, device={"charging": True, "cpu": 1}), "testGetTasksConstrained")
+test((data["taskIDs"] == [], data["taskIDs"]), "testGetTasksConstrainedSlowCPU")
+data = test(getTasks(wtok, "Devices", 1), "testGetTasksCapable")
+test((data["taskIDs"] == [long1], data["taskIDs"]), "testGetTasksCapableLargeFirst")
+data = test(getTasks(mtok, "Devices", 3, device={"charging": True, "wifi": True}), "testGetTasksCapable")
+test((data["taskIDs"] == [long2], data["taskIDs"]), "testGetTasksDeviceUpdated")
+test((not getTasks(wtok, "Devices", 1, device={"cpu": "fast"})[0], "Invalid hint"), "testGetTasksDeviceInvalid")
+
+# Without maxtasks a worker starts with one task, and is then given as many as it completes in BATCH_INTERVAL
+test(registerWorker("Batcher", "hunter4"), "testRegisterWorker")
+btok = test(login("Batcher", "hunter4", "worker"), "testLoginWorker")["token"]
+test(createNewProject(ctok, "Batches", "Description"), "testCreateNewProject")
+test(createNewBlobs(ctok, "Batches", [makeTask(b'batch')] * 50, [b''] * 50, True), "testCreateNewBlobs")
+data = test(getTasks(btok, "Batches", None), "testGetTasksAdaptive")
+test((len(data["taskIDs"]) == 1 and data["batchSize"] == 1, data), "testGetTasksAdaptiveFirst")
+test(sendTasks(btok, {"Batches": {data["taskIDs"][0]: {"results": [], "metadatas": [], "status": "ok"}}}), "testSendTasks")
+data = test(getTasks(btok, "Batches", None), "testGetTasksAdaptive")
+test((len(data["taskIDs"]) > 1 and data["batchSize"] > 1, data["batchSize"]), "testGetTasksAdaptiveGrown")
+
+# Once no task is waiting, a fast worker is given spare copies of tasks held well past the median
+# task time, at least 10s. The first result wins and the other is dropped
+test(registerWorker("Fast", "hunter5"), "testRegisterWorker")
+ftok = test(login("Fast", "hunter5", "worker"), "testLoginWorker")["token"]
+test(registerWorker("Slow", "hunter6"), "testRegisterWorker")
+stok = test(login("Slow", "hunter6", "worker"), "testLoginWorker")["token"]
+test(createNewProject(ctok, "Stragglers", "Description"), "testCreateNewProject")
+test(createNewBlobs(ctok, "Stragglers", [makeTask(b'straggler')] * 7, [b''] * 7, True), "testCreateNewBlobs")
+for i in range(5):
+    data = test(getTasks(ftok, "Stragglers", 1), "testGetTasks")
+    test(sendTasks(ftok, {"Stragglers": {data["taskIDs"][0]: {"results": [], "status": "ok"}}}), "testSendTasks")
+(slow1, slow2) = test(getTasks(stok, "Stragglers", 2), "testGetTasks")["taskIDs"]
+data = test(getTasks(ftok, "Stragglers", 2), "testGetTasks")
+test((data["taskIDs"] == [], data["taskIDs"]), "testGetTasksNoStragglersYet")
+time.sleep(11)
+data = test(getTasks(ftok, "Stragglers", 2), "testGetTasksStragglers")
+test((sorted(data["taskIDs"]) == sorted([slow1, slow2]), data["taskIDs"]), "testGetTasksStragglersCopied")
+data = test(getMetrics(), "testGetMetrics")
+test((data['dphone_tasks_issued{project="Stragglers"}'] == 2 and data['dphone_tasks_spare{project="Stragglers"}'] == 2, data), "testMetricsSpares")
+test(sendTasks(ftok, {"Stragglers": {slow1: {"results": [b'fast'], "status": "ok"}}}), "testSendTasksSpareWins")
+test(sendTasks(stok, {"Stragglers": {slow1: {"results": [b'slow'], "status": "ok"}}}), "testSendTasksSuperseded")
+test(sendTasks(stok, {"Stragglers": {slow2: {"results": [b'slow'], "status": "ok"}}}), "testSendTasksOriginalWins")
+test(sendTasks(ftok, {"Stragglers": {slow2: {"results": [b'fast'], "status": "ok"}}}), "testSendTasksSuperseded")
+data = test(waitForResults(ctok, "Stragglers", -1, 0), "testWaitForResults")
+test((len(data["metadata"]) == 2, data["metadata"]), "testStragglerResultsOnce")
+
+# Results of checked tasks are held until a different worker's run agrees with them. A task whose
+# runs disagree is run a third time, and the run agreeing with it wins
+test(createNewProject(ctok, "Verify", "Description"), "testCreateNewProject")
+test(setVerifyRate(ctok, "Verify", 1), "testSetVerifyRate")
+test((not setVerifyRate(ctok, "Verify", 2)[0], "Rate above 1"), "testSetVerifyRateInvalid")
+test(createNewBlobs(ctok, "Verify", [makeTask(b'check')], [b''], True), "testCreateNewBlobs")
+(check,) = test(getTasks(ftok, "Verify", 1), "testGetTasks")["taskIDs"]
+test(sendTasks(ftok, {"Verify": {check: {"results": [b'right'], "status": "ok"}}}), "testSendTasksChecked")
+data = test(waitForResults(ctok, "Verify", -1, 0), "testWaitForResults")
+test((len(data["metadata"]) == 0, data["metadata"]), "testCheckedResultsHeld")
+data = test(getTasks(ftok, "Verify", 1), "testGetTasks")
+test((data["taskIDs"] == [], data["taskIDs"]), "testGetTasksNotRecheckedBySameWorker")
+data = test(getTasks(stok, "Verify", 1), "testGetTasksRecheck")
+test((data["taskIDs"] == [check], data["taskIDs"]), "testGetTasksRecheckOtherWorker")
+test(sendTasks(stok, {"Verify": {check: {"results": [b'right'], "status": "ok"}}}), "testSendTasksAgreed")
+data = test(waitForResults(ctok, "Verify", -1, 0), "testWaitForResults")
+test((len(data["metadata"]) == 1, data["metadata"]), "testCheckedResultsOnce")
+
+test(createNewBlobs(ctok, "Verify", [makeTask(b'disagree')], [b''], True), "testCreateNewBlobs")
+(check,) = test(getTasks(ftok, "Verify", 1), "testGetTasks")["taskIDs"]
+test(sendTasks(ftok, {"Verify": {check: {"results": [b'right'], "status": "ok"}}}), "testSendTasksChecked")
+test(getTasks(stok, "Verify", 1), "testGetTasksRecheck")
+test(sendTasks(stok, {"Verify": {check: {"results": [b'wrong'], "status": "ok"}}}), "testSendTasksDisagreed")
+data = test(getTasks(btok, "Verify", 1), "testGetTasksRecheck")
+test((data["taskIDs"] == [check], data["taskIDs"]), "testGetTasksThirdRun")
+test(sendTasks(btok, {"Verify": {check: {"results": [b'right'], "status": "ok"}}}), "testSendTasksAgreed")
+data = test(waitForResults(ctok, "Verify", -1, 0), "testWaitForResults")
+test((len(data["metadata"]) == 2, data["metadata"]), "testCheckedResultsOnce")
+data = test(getBlob(ctok, "Verify", str(data["cursor"])), "testGetBlob")
+test((data["blob"] == b'right', data["blob"]), "testCheckedResultAgreed")
+
+# Bodies may be sent as JSON or framed as well as CBOR, and responses are sent in the codec asked for
+test(createNewProject(ctok, "Codecs", "Description"), "testCreateNewProject")
+blob = bytes(range(256)) * 16
+data = test(callEncoded("createNewBlob", {"token": ctok, "pname": "Codecs", "blob": blob, "metadata": b'meta'}, codec.JSON), "testCreateNewBlobJSON")
+test((data["contentType"] == codec.JSON, data["contentType"]), "testRespondInRequestCodec")
+data = test(callEncoded("getBlob", {"token": ctok, "pname": "Codecs", "name": data["blobID"]}, codec.CBOR, codec.JSON), "testGetBlobJSON")
+test((data["blob"] == blob and data["contentType"] == codec.JSON, data["contentType"]), "testGetBlobJSONRoundTrip")
+data = test(callEncoded("createNewBlobs", {"token": ctok, "pname": "Codecs", "blobs": [makeTask(b'framed'), blob],
+    "metadatas": [b'', b'meta'], "tasks": False}, codec.FRAMED), "testCreateNewBlobsFramed")
+(framedTask, framedBlob) = [r["blobID"] for r in data["results"]]
+data = test(callEncoded("getBlob", {"token": ctok, "pname": "Codecs", "name": framedBlob}, codec.CBOR, codec.FRAMED), "testGetBlobFramed")
+test((bytes(data["blob"]) == blob and data["contentType"] == codec.FRAMED, data["contentType"]), "testGetBlobFramedRoundTrip")
+test(blobsToTasks(ctok, "Codecs", [framedTask]), "testBlobsToTasks")
+(taskID,) = test(getTasks(wtok, "Codecs", 1), "testGetTasks")["taskIDs"]
+test(callEncoded("sendTasks", {"token": wtok, "tasks": {"Codecs": {taskID: {"results": [blob], "status": "ok"}}}}, codec.FRAMED), "testSendTasksFramed")
+(resultID,) = test(waitForResults(ctok, "Codecs", -1, 0), "testWaitForResults")["metadata"]
+data = test(getBlob(ctok, "Codecs", resultID), "testGetBlob")
+test((data["blob"] == blob, len(data["blob"])), "testSendTasksFramedResult")
+r = requests.post("http://" + SERVER_IP + "/ping")
+test((codec.mediaType(r.headers.get("Content-Type")) == codec.CBOR, r.headers.get("Content-Type")), "testRespondCBORByDefault")
+
+# Bodies may be sent compressed, and responses are compressed in the encoding asked for. Blobs are
+# sent from compressed copies made once when they are stored
+test(createNewProject(ctok, "Compression", "Description"), "testCreateNewProject")
+text = b"".join(b"%d " % i for i in range(2000))
+data = test(callCompressed("createNewBlob", {"token": ctok, "pname": "Compression", "blob": text, "metadata": b'meta'}, "gzip"), "testCreateNewBlobCompressed")
+textID = data["blobID"]
+data = test(callCompressed("getBlob", {"token": ctok, "pname": "Compression", "name": textID}), "testGetBlobCompressed")
+test((data["blob"] == text and data["encoding"] == "gzip" and data["wireSize"] < len(text) / 2, data["wireSize"]), "testGetBlobCompressedContents")
+data = test(callCompressed("getBlob", {"token": ctok, "pname": "Compression", "name": textID}, accept="gzip;q=0, identity"), "testGetBlobUncompressed")
+test((data["blob"] == text and data["encoding"] is None, data["encoding"]), "testGetBlobUncompressedContents")
+data = test(callCompressed("getBlob", {"token": ctok, "pname": "Codecs", "name": framedBlob}, accept="gzip"), "testGetBlobCompressed")
+test((data["blob"] == blob and data["encoding"] == "gzip", data["encoding"]), "testGetBlobCompressedRepetitive")
+# The compressed copy is made in the background, so the program is sent as it is until then
+for attempt in range(20):
+    program = test(getProgram(hashlib.sha256(text).hexdigest()), "testGetProgram")
+    if program["encoding"] is not None:
+        break
+    time.sleep(0.1)
+test((program["program"] == text and program["encoding"] == "gzip" and program["etag"].endswith('-gzip"'), program["etag"]), "testGetProgramCompressed")
+unchanged = test(getProgram(hashlib.sha256(text).hexdigest(), program["etag"]), "testGetProgramUnchanged")
+test((unchanged.get("unchanged", False), unchanged), "testGetProgramCompressedNotModified")
+data = test(callCompressed("getBlob", {"token": ctok, "pname": "Compression", "name": textID}), "testGetBlobCompressed")
+test((data["blob"] == text and data["wireSize"] < len(text) / 2, data["wireSize"]), "testGetBlobStoredCopy")
+# It is sent as a single gzip member, as some decoders stop after the first
+r = requests.post("http://" + SERVER_IP + "/getBlob", data = cbor.dumps({"token": ctok, "pname": "Compression", "name": textID}),
+    headers = {"Accept-Encoding": "gzip"}, stream = True)
+d = zlib.decompressobj(31)
+data = cbor.loads(d.decompress(r.raw.read(decode_content = False)))
+test((data["blob"] == text and d.eof and not d.unused_data, d.unused_data), "testGetBlobStoredCopyOneMember")
+data = test(callCompressed("getBlob", {"token": ctok, "pname": "Compression", "name": textID}, accept="br"), "testGetBlobUnknownEncoding")
+test((data["encoding"] is None, data["encoding"]), "testGetBlobUnknownEncodingUncompressed")
+r = requests.post("http://" + SERVER_IP + "/getBlob", data = b'not gzip', headers = {"Content-Encoding": "gzip"})
+test((not cbor.loads(r.content)["success"], r.content), "testBadlyCompressedBody")
+
+# Every endpoint's requests, errors and latencies are counted, along with gauges of each project
+data = test(getMetrics(), "testGetMetrics")
+test((data['dphone_requests_total{endpoint="getTasks"}'] >= 1, data), "testMetricsRequests")
+test((data['dphone_request_errors_total{endpoint="getProgram"}'] >= 1, data), "testMetricsErrors")
+test((data['dphone_request_seconds_count{endpoint="getBlob"}'] == data['dphone_requests_total{endpoint="getBlob"}']
+    == data['dphone_request_seconds_bucket{endpoint="getBlob",le="+Inf"}'], data), "testMetricsHistogram")
+test((data['dphone_blob_bytes{project="Compression"}'] == len(text), data), "testMetricsBlobBytes")
+test((data['dphone_sessions'] >= 1 and data['dphone_graph_points{project="Project"}'] > 0, data), "testMetricsGauges")
+test((data['dphone_tasks_waiting{project="Codecs"}'] == 0 and data['dphone_tasks_issued{project="Codecs"}'] == 0, data), "testMetricsTasks")
+
+# A body longer than MAX_BODY_SIZE is refused before it is sent
+status = sendLength("createNewBlob", MAX_BODY_SIZE + 1)
+test((status == 413, status), "testBodyTooLarge")
+
+# So is a compressed body which expands to more than that
+(succ, data) = sendExpanding("login", MAX_BODY_SIZE + 1)
+test((not succ, data), "testCompressedBodyTooLarge")
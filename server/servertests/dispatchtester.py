@@ -0,0 +1,47 @@
+## Automated tests for the task queue of dispatch.py, without a server
+# Usage: python3 dispatchtester.py
+# Drives a TaskQueue through issuing, spare copies of stragglers and their promotion, with times
+# given explicitly so that nothing waits
+import sys, os
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+from header import STRAGGLER_MIN_SAMPLES
+from dispatch import TaskQueue
+
+def test(res, testname):
+    (succ, data) = res
+    if succ:
+        print(testname + " AOK")
+        return data
+    else:
+        print(testname + " FAILED")
+        print(data)
+        sys.exit(str(data))
+
+# Enough tasks complete in 1s each for the queue to tell stragglers
+q = TaskQueue()
+for i in range(STRAGGLER_MIN_SAMPLES):
+    q.push("done" + str(i))
+for taskID in q.pop("fast", STRAGGLER_MIN_SAMPLES, 0):
+    q.complete(taskID, "fast", 1000)
+limit = q.stragglerTime()
+test((limit is not None, limit), "testStragglerTime")
+
+# A task held past the straggler time gets a spare copy, and a task issued after the copy does not
+q.push("a")
+test((q.pop("slow", 1, 0) == ["a"], q.started), "testPop")
+data = q.pop("spare", 1, limit, speculate=True)
+test((data == ["a"], data), "testPopSpare")
+q.push("b")
+test((q.pop("other", 1, limit + 1) == ["b"], q.started), "testPop")
+
+# Once the first copy is given up the spare takes its place, in the order it was issued
+test((q.release("a", "slow"), q.started), "testReleasePromotes")
+test((list(q.started) == ["a", "b"], q.started), "testPromotedInOrder")
+data = q.stragglers("third", 2 * limit, 2, True)
+test((data == ["a"], data), "testPromotedStraggler")
+data = q.nextWake(limit + 2)
+test((data == 2 * limit, data), "testPromotedNextWake")
+
+print("All dispatch tests passed")
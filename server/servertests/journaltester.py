@@ -0,0 +1,114 @@
+## Automated tests for the journal of the dict database
+# Usage: python3 journaltester.py
+# Starts server.py in a scratch directory and fills a project, then kills the server without warning
+# and starts it again. Everything done before the kill must be recovered from the journal, including
+# the sessions and the tasks issued at the time
+import sys, os, time, subprocess, tempfile, atexit, requests
+import tests
+from tests import *
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+from header import SERVER_PORT
+
+def test(res, testname):
+    (succ, data) = res
+    if succ:
+        print(testname + " AOK")
+        return data
+    else:
+        print(testname + " FAILED")
+        print(data)
+        sys.exit(str(data))
+
+def makeTask(control):
+    return cbor.dumps({"program": {"id": "0", "size": 0}, "control": control, "blobs": []})
+
+cwd = tempfile.mkdtemp()
+procs = []
+
+def start():
+    procs.append(subprocess.Popen([sys.executable, os.path.join(here, "..", "server.py")], cwd=cwd))
+    for attempt in range(100):
+        try:
+            requests.post("http://localhost:" + str(SERVER_PORT) + "/ping")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    sys.exit("Server did not start")
+
+# Kills the server as a crash would, without letting it flush anything
+def crash():
+    p = procs.pop()
+    p.kill()
+    p.wait()
+
+def stop():
+    for p in procs:
+        p.terminate()
+        p.wait()
+atexit.register(stop)
+
+tests.SERVER_IP = "localhost:" + str(SERVER_PORT)
+start()
+
+test(registerCustomer("journalcustomer", "password"), "testRegisterCustomer")
+test(registerWorker("journalworker", "password"), "testRegisterWorker")
+ctok = test(login("journalcustomer", "password", "customer"), "testLoginCustomer")["token"]
+wtok = test(login("journalworker", "password", "worker"), "testLoginWorker")["token"]
+test(createNewProject(ctok, "Journal", "Description"), "testCreateNewProject")
+pname = "Journal"
+
+tasks = [makeTask(c) for c in [b'a', b'b', b'c']]
+test(createNewBlobs(ctok, pname, tasks, [cbor.dumps(str(i)) for i in range(3)], True), "testCreateNewBlobs")
+deleted = test(createNewBlob(ctok, pname, b'deleted', cbor.dumps("deleted")), "testCreateNewBlob")["blobID"]
+test(deleteBlob(ctok, pname, deleted), "testDeleteBlob")
+
+# One task is finished, one is issued and one waits
+data = test(getTasks(wtok, pname, 2), "testGetTasks")
+(finished, issued) = data["taskIDs"]
+test(sendTasks(wtok, {pname: {finished: {"results": [b'result'], "metadatas": [cbor.dumps("result")], "status": "ok"}}}), "testSendTasks")
+test(updateGraphs(ctok, {"custom": {"description": "A graph"}}, pname), "testUpdateGraphs")
+
+metadata = test(getBlobMetadata(ctok, pname, []), "testGetBlobMetadata")["metadata"]
+latest = test(getChanges(ctok, pname, 0), "testGetChanges")["latest"]
+graphs = test(getGraphs(pname, "s"), "testGetGraphs")["graphs"]
+
+for restart in range(2):
+    crash()
+    start()
+
+    # Sessions are kept, so the old tokens still work
+    data = test(getBlobMetadata(ctok, pname, []), "testMetadataRecovered")
+    test((data["metadata"] == metadata, data), "testMetadataKept")
+    data = test(getChanges(ctok, pname, 0), "testChangesRecovered")
+    test((data["latest"] == latest, data), "testChangesKept")
+    data = test(waitForResults(ctok, pname, -1, 0), "testResultsRecovered")
+    test((len(data["metadata"]) == 1, data), "testResultsKept")
+    result = list(data["metadata"])[0]
+    data = test(getBlob(ctok, pname, result), "testGetBlobRecovered")
+    test((data["blob"] == b'result', data), "testBlobKept")
+    data = test(getGraphs(pname, "s"), "testGraphsRecovered")
+    test((data["graphs"] == graphs, data), "testGraphsKept")
+    data = test(getGraphs(pname, "s", "customGraphs"), "testCustomGraphsRecovered")
+    test(("custom" in data["graphs"], data), "testCustomGraphsKept")
+
+    # The task issued before the crash is still issued to the same worker
+    data = test(renewLeases(wtok, pname, [issued]), "testRenewLeasesRecovered")
+    test((data["taskIDs"] == [issued], data), "testLeaseKept")
+
+    if restart == 0:
+        # The waiting task is the only one left to issue
+        data = test(getTasks(wtok, pname, 3), "testGetTasksRecovered")
+        test((len(data["taskIDs"]) == 1 and data["taskIDs"][0] not in [finished, issued], data), "testQueueKept")
+
+        # New blobs are numbered after those made before the crash, and survive the next one
+        data = test(createNewBlob(ctok, pname, b'late', cbor.dumps("late")), "testCreateNewBlob")
+        test((int(data["blobID"]) > int(deleted), data), "testBlobIDsKept")
+        metadata = test(getBlobMetadata(ctok, pname, []), "testGetBlobMetadata")["metadata"]
+        latest = test(getChanges(ctok, pname, 0), "testGetChanges")["latest"]
+    else:
+        data = test(getTasks(wtok, pname, 3), "testGetTasksRecovered")
+        test((data["taskIDs"] == [], data), "testQueueKept")
+
+print("All journal tests passed")
@@ -28,5 +28,5 @@ test(registerWorker(username, "hunter2"), "testRegisterWorker")
 wtok = test(login(username, "hunter2", "worker"), "testLogin")["token"]
 
 # Worker tests
-data = test(getTasks(wtok, "Project", 2), "testGetTasks")
+data = test(getTasks(wtok, "Project", None), "testGetTasks")
 
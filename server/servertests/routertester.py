@@ -0,0 +1,136 @@
+## Automated tests for router.py, against several server processes on this machine
+# Usage: python3 routertester.py
+# Starts router.py with SHARDS local nodes and fills projects through it, then starts one more node
+# and adds it. Every project must still be served whole afterwards, and some must have moved
+import sys, os, time, subprocess, tempfile, atexit, requests
+import tests
+from tests import *
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+from header import SERVER_PORT, SHARDS, NODE_HOST
+
+PROJECTS = 16
+SECRET = "routertester"
+
+def test(res, testname):
+    (succ, data) = res
+    if succ:
+        print(testname + " AOK")
+        return data
+    else:
+        print(testname + " FAILED")
+        print(data)
+        sys.exit(str(data))
+
+def makeTask(control):
+    return cbor.dumps({"program": {"id": "0", "size": 0}, "control": control, "blobs": []})
+
+def waitForServer(address):
+    for attempt in range(100):
+        try:
+            requests.post("http://" + address + "/ping")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    sys.exit("Server at " + address + " did not start")
+
+# Run everything in a scratch directory, so the nodes' blob stores are kept apart from any real ones
+env = dict(os.environ, SHARD_SECRET=SECRET)
+cwd = tempfile.mkdtemp()
+procs = []
+
+def stop():
+    for p in procs:
+        p.terminate()
+        p.wait()
+atexit.register(stop)
+
+tests.SERVER_IP = "localhost:" + str(SERVER_PORT)
+procs.append(subprocess.Popen([sys.executable, os.path.join(here, "..", "router.py")], cwd=cwd, env=env))
+for n in range(SHARDS):
+    waitForServer(NODE_HOST + ":" + str(SERVER_PORT + 1 + n))
+waitForServer(tests.SERVER_IP)
+
+test(registerCustomer("Edd", "password1"), "testRegisterCustomer")
+test(registerWorker("Hristo", "hunter2"), "testRegisterWorker")
+ctok = test(login("Edd", "password1", "customer"), "testCustomerLogin")["token"]
+wtok = test(login("Hristo", "hunter2", "worker"), "testLoginWorker")["token"]
+
+# Each project gets two tasks, one of which is completed
+pnames = ["Project" + str(i) for i in range(PROJECTS)]
+returned = {}
+for pname in pnames:
+    test(createNewProject(ctok, pname, "Description"), "testCreateNewProject")
+    test(createNewBlobs(ctok, pname, [makeTask(b'a'), makeTask(b'b')], [cbor.dumps("a"), cbor.dumps("b")], True), "testCreateNewBlobs")
+    taskID = test(getTasks(wtok, pname, 1), "testGetTasks")["taskIDs"][0]
+    returned[pname] = {taskID: {"results": [pname.encode()], "metadatas": [cbor.dumps(pname)], "status": "ok"}}
+
+# One sendTasks request spans every project
+test(sendTasks(wtok, returned), "testSendTasksSplit")
+
+before = {}
+for pname in pnames:
+    before[pname] = (test(getBlobMetadata(ctok, pname, []), "testGetBlobMetadata")["metadata"],
+        test(getChanges(ctok, pname, 0), "testGetChanges")["latest"])
+
+# Add a node
+node = NODE_HOST + ":" + str(SERVER_PORT + 1 + SHARDS)
+procs.append(subprocess.Popen([sys.executable, os.path.join(here, "..", "server.py"), "--shard", str(SHARDS)], cwd=cwd, env=env))
+waitForServer(node)
+test(addNode(SECRET, node), "testAddNode")
+test((not addNode("wrong", node)[0], "Wrong secret"), "testAddNodeSecret")
+
+# Some projects are now held by the new node
+r = requests.post("http://" + node + "/getProjectsList")
+moved = list(cbor.loads(r.content)["projects"])
+test((0 < len(moved) < PROJECTS, moved), "testProjectsMoved")
+data = test(getProjectsList(), "testGetProjectsList")
+test((sorted(data["projects"]) == sorted(pnames), data["projects"]), "testGetProjectsListAll")
+
+# Every project is served whole, wherever it is, to the sessions made before the move
+left = {}
+for pname in pnames:
+    data = test(getBlobMetadata(ctok, pname, []), "testGetBlobMetadataMoved")
+    test((data["metadata"] == before[pname][0], data), "testMetadataKept")
+    data = test(getChanges(ctok, pname, 0), "testGetChangesMoved")
+    test((data["latest"] == before[pname][1], data), "testChangesKept")
+    data = test(waitForResults(ctok, pname, -1, 0), "testWaitForResultsMoved")
+    test((len(data["metadata"]) == 1, data), "testResultsKept")
+    data = test(getTasks(wtok, pname, 2), "testGetTasksMoved")
+    test((len(data["taskIDs"]) == 1, data), "testTasksKept")
+    left[pname] = {data["taskIDs"][0]: {"results": [bytes(4096)], "status": "ok"}}
+
+# New projects go to their place on the new ring
+test(createNewProject(ctok, "Late", "Description"), "testCreateNewProject")
+test(createNewBlob(ctok, "Late", b'late', cbor.dumps("late")), "testCreateNewBlob")
+
+# Requests in other codecs are passed on as they are, and answered in the codec asked for
+test(callEncoded("sendTasks", {"token": wtok, "tasks": left}, codec.FRAMED), "testSendTasksSplitFramed")
+for pname in pnames:
+    data = test(callEncoded("waitForResults", {"token": ctok, "pname": pname, "cursor": -1, "timeout": 0}, codec.JSON), "testWaitForResultsJSON")
+    test((len(data["metadata"]) == 2 and data["contentType"] == codec.JSON, data), "testResultsFramed")
+
+# Compressed requests and responses are passed on as they are
+for pname in pnames:
+    data = test(callCompressed("waitForResults", {"token": ctok, "pname": pname, "cursor": -1, "timeout": 0}, "gzip"), "testWaitForResultsCompressed")
+    data = test(callCompressed("getBlob", {"token": ctok, "pname": pname, "name": str(data["cursor"])}, "gzip"), "testGetBlobCompressed")
+    test((data["blob"] == bytes(4096) and data["encoding"] == "gzip" and data["wireSize"] < 1024, data["wireSize"]), "testGetBlobCompressedRouted")
+
+# The metrics of every node are gathered, labelled by node
+data = test(getMetrics(), "testGetMetrics")
+test((len([k for k in data if k.startswith("dphone_sessions{node=")]) == SHARDS + 1, data), "testMetricsEveryNode")
+
+# A login refused by every node is answered as the nodes answered it
+(succ, data) = login("Edd", "wrong", "customer")
+test((not succ and not "Failed on nodes" in data["error"], data), "testLoginRefused")
+
+# With a node down, users can no longer be registered or logged in, and the node is named
+procs[-1].terminate()
+procs[-1].wait()
+(succ, data) = registerCustomer("Stefan", "password2")
+test((not succ and node in data["error"], data), "testRegisterNodeDown")
+(succ, data) = login("Edd", "password1", "customer")
+test((not succ and node in data["error"], data), "testLoginNodeDown")
+
+print("All router tests passed")
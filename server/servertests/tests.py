@@ -1,7 +1,11 @@
 ## Automated tests for the server
-import requests, cbor
+import requests, cbor, struct, json, sys, os, socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import codec, compressor
 
 SERVER_IP = "35.178.90.246/api"
+STREAM_CHUNK = 64*1024     # Bytes sent or received at a time when streaming blobs
 def reboot():
     r = requests.post("http://" + SERVER_IP + "/reboot")
 
@@ -37,11 +41,13 @@ def registerCustomer(username, password):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
 
-def registerWorker(username, password):
+def registerWorker(username, password, prefwifidata=True, prefbattery=True):
     r = requests.post("http://" + SERVER_IP + "/register", data = cbor.dumps(
         {   "username": username,
             "password": password,
-            "accesslevel": "worker"
+            "accesslevel": "worker",
+            "prefwifidata": prefwifidata,
+            "prefbattery": prefbattery
         }))
 
     if r.status_code != 200:
@@ -50,12 +56,12 @@ def registerWorker(username, password):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
 
-def login(username, password, accesslevel):
-    r = requests.post("http://" + SERVER_IP + "/login", data = cbor.dumps(
-        {   "username": username,
-            "password": password,
-            "accesslevel": accesslevel
-        }))
+# Pass device to report the worker's device hints
+def login(username, password, accesslevel, device=None):
+    body = {"username": username, "password": password, "accesslevel": accesslevel}
+    if device is not None:
+        body["device"] = device
+    r = requests.post("http://" + SERVER_IP + "/login", data = cbor.dumps(body))
 
     if r.status_code != 200:
         return (False, r.text)
@@ -100,6 +106,30 @@ def createNewBlob(token, pname, blob, metadata):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
 
+# Uploads the blob read from file object f in chunks, without holding it all in memory
+def createNewBlobStream(token, pname, f, metadata):
+    head = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "metadata": metadata
+        })
+
+    def body():
+        yield struct.pack(">I", len(head)) + head
+        while True:
+            chunk = f.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+
+    r = requests.post("http://" + SERVER_IP + "/createNewBlobStream", data = body())
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
 def blobToTask(token, pname, blobID):
     r = requests.post("http://" + SERVER_IP + "/blobToTask", data = cbor.dumps(
         {   "token": token,
@@ -113,11 +143,43 @@ def blobToTask(token, pname, blobID):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
     
-def getBlobMetadata(token, pname, blobIDs):
+def createNewBlobs(token, pname, blobs, metadatas, tasks = False):
+    r = requests.post("http://" + SERVER_IP + "/createNewBlobs", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "blobs": blobs,
+            "metadatas": metadatas,
+            "tasks": tasks
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+def blobsToTasks(token, pname, blobIDs):
+    r = requests.post("http://" + SERVER_IP + "/blobsToTasks", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "blobIDs": blobIDs,
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+# With no blobIDs, returns a page of up to limit blobs after blob ID after. Its "next" is the after
+# of the next page, or None
+def getBlobMetadata(token, pname, blobIDs, after=-1, limit=1000):
     r = requests.post("http://" + SERVER_IP + "/getBlobMetadata", data = cbor.dumps(
         {   "token": token,
             "pname": pname,
             "blobIDs": blobIDs,
+            "after": after,
+            "limit": limit
         }))
 
     if r.status_code != 200:
@@ -127,6 +189,39 @@ def getBlobMetadata(token, pname, blobIDs):
 
     return (data["success"] and data["error"] == "", data)
     
+# Returns up to limit changes to the blobs of a project after sequence number seq
+def getChanges(token, pname, seq, limit=1000):
+    r = requests.post("http://" + SERVER_IP + "/getChanges", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "seq": seq,
+            "limit": limit
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+
+    return (data["success"] and data["error"] == "", data)
+
+# Waits up to timeout milliseconds for result blobs newer than cursor
+def waitForResults(token, pname, cursor, timeout, limit=1000):
+    r = requests.post("http://" + SERVER_IP + "/waitForResults", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "cursor": cursor,
+            "timeout": timeout,
+            "limit": limit
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+
+    return (data["success"] and data["error"] == "", data)
+
 def getBlob(token, pname, name):
     r = requests.post("http://" + SERVER_IP + "/getBlob", data = cbor.dumps(
         {   "token": token,
@@ -142,11 +237,60 @@ def getBlob(token, pname, name):
     data["metadata"] = cbor.loads(data["metadata"])
     return (data["success"] and data["error"] == "", data)
     
-def getTasks(token, pname, maxtasks):
-    r = requests.post("http://" + SERVER_IP + "/getTasks", data = cbor.dumps(
+# Downloads a blob in chunks into file object out, without holding it all in memory
+def getBlobStream(token, pname, name, out):
+    r = requests.post("http://" + SERVER_IP + "/getBlobStream", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "name": name,
+        }), stream = True)
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    (n,) = struct.unpack(">I", r.raw.read(4))
+    data = cbor.loads(r.raw.read(n))
+    if data["success"]:
+        for chunk in r.iter_content(STREAM_CHUNK):
+            out.write(chunk)
+        data["metadata"] = cbor.loads(data["metadata"])
+    return (data["success"] and data["error"] == "", data)
+
+# programs lists the hashes of the programs already held, which are left out of the response.
+# Input blobs of the tasks are sent inline, up to prefetch bytes of them. A maxtasks of None asks for
+# the worker's suggested batch size
+def getTasks(token, pname, maxtasks, programs=[], prefetch=0, device=None):
+    body = {"token": token, "pname": pname, "programs": programs, "prefetch": prefetch}
+    if maxtasks is not None:
+        body["maxtasks"] = maxtasks
+    if device is not None:
+        body["device"] = device
+    r = requests.post("http://" + SERVER_IP + "/getTasks", data = cbor.dumps(body))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+# Fetches a program by its hash. Pass the etag of an earlier response to be told it is unchanged
+def getProgram(h, etag=None):
+    r = requests.get("http://" + SERVER_IP + "/getProgram", params = {"hash": h},
+        headers = {"If-None-Match": etag} if etag else {})
+
+    if r.status_code == 304:
+        return (True, {"unchanged": True, "etag": etag})
+    if r.status_code != 200:
+        return (False, r.text)
+
+    return (True, {"program": r.content, "etag": r.headers.get("ETag"), "cacheControl": r.headers.get("Cache-Control"),
+        "encoding": r.headers.get("Content-Encoding")})
+
+def renewLeases(token, pname, taskIDs):
+    r = requests.post("http://" + SERVER_IP + "/renewLeases", data = cbor.dumps(
         {   "token": token,
             "pname": pname,
-            "maxtasks": maxtasks,
+            "taskIDs": taskIDs,
         }))
 
     if r.status_code != 200:
@@ -180,15 +324,22 @@ def deleteBlob(token, pname, blobID):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
 
-def getGraphs(pname):
-    r = requests.post("http://" + SERVER_IP + "/getGraphs", data = cbor.dumps(
-        {   "pname": pname
-        }))
-
+# Pass the etag of an earlier response to be told if nothing has changed since
+def getGraphs(pname, prec, kind="standardGraphs", since=0, etag=None):
+    r = requests.post("http://" + SERVER_IP + "/getGraphs", params =
+        {   "pname": pname,
+            "prec": prec,
+            "kind": kind,
+            "since": since
+        }, headers = {"If-None-Match": etag} if etag else {})
+
+    if r.status_code == 304:
+        return (True, {"success": True, "error": "", "unchanged": True, "etag": etag})
     if r.status_code != 200:
         return (False, r.text)
 
-    data = cbor.loads(r.content)
+    data = json.loads(r.text)
+    data["etag"] = r.headers.get("ETag")
     return (data["success"] and data["error"] == "", data)
 
 
@@ -213,3 +364,115 @@ def updateGraphs(token, graphsCBOR, pname):
 
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
+
+# Asks the router to add the server node at address, moving projects to it
+def setProjectWeight(token, pname, weight):
+    r = requests.post("http://" + SERVER_IP + "/setProjectWeight", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "weight": weight
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+def setVerifyRate(token, pname, rate):
+    r = requests.post("http://" + SERVER_IP + "/setVerifyRate", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "rate": rate
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+def addNode(secret, address):
+    r = requests.post("http://" + SERVER_IP + "/addNode", data = cbor.dumps(
+    {   "secret": secret,
+        "address": address
+    }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+# Sends body to endpoint encoded as media type t, asking for a response encoded as accept. Returns
+# the decoded response, with the media type it was sent in as "contentType"
+def callEncoded(endpoint, body, t, accept=None):
+    data = codec.encode(t, body)
+    headers = {"Content-Type": t}
+    if accept is not None:
+        headers["Accept"] = accept
+    r = requests.post("http://" + SERVER_IP + "/" + endpoint, data = data if type(data) is bytes else b"".join(data), headers = headers)
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = codec.decode(r.headers.get("Content-Type"), r.content)
+    data["contentType"] = codec.mediaType(r.headers.get("Content-Type"))
+    return (data["success"] and data["error"] == "", data)
+
+# Sends body to endpoint as CBOR, compressed in encoding if it is given, asking for a response
+# compressed in one of accept. Returns the decoded response, with the encoding it was sent in as
+# "encoding" and its compressed size as "wireSize"
+def callCompressed(endpoint, body, encoding=None, accept="gzip"):
+    data = cbor.dumps(body)
+    headers = {"Accept-Encoding": accept}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        data = compressor.compress(encoding, data, 6)
+    r = requests.post("http://" + SERVER_IP + "/" + endpoint, data = data, headers = headers, stream = True)
+    raw = r.raw.read(decode_content = False)
+
+    if r.status_code != 200:
+        return (False, raw)
+
+    data = cbor.loads(compressor.decompress(r.headers.get("Content-Encoding"), raw))
+    data["encoding"] = r.headers.get("Content-Encoding")
+    data["wireSize"] = len(raw)
+    return (data["success"] and data["error"] == "", data)
+
+# Fetches the metrics endpoint. Returns its samples as a dict mapping each sample's name and labels,
+# as written, to its value
+def getMetrics():
+    r = requests.get("http://" + SERVER_IP + "/metrics")
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    samples = {}
+    for line in r.text.splitlines():
+        if line and not line.startswith("#"):
+            (sample, sep, value) = line.rpartition(" ")
+            samples[sample] = float(value)
+    return (True, samples)
+
+# Sends the head of a request to endpoint whose body is claimed to be size bytes long, without the
+# body. Returns the status code of the response
+def sendLength(endpoint, size):
+    (host, sep, port) = SERVER_IP.split("/")[0].partition(":")
+    with socket.create_connection((host, int(port or 80))) as conn:
+        conn.sendall(("POST /%s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n" % (endpoint, host, size)).encode("latin-1"))
+        line = conn.makefile("rb").readline()
+    return int(line.split()[1])
+
+# Sends endpoint a gzip body which expands to size zero bytes, compressing it a megabyte at a time
+def sendExpanding(endpoint, size):
+    c = compressor.compressor("gzip", 9)
+    chunks = [c.compress(bytes(min(1024*1024, size - n))) for n in range(0, size, 1024*1024)]
+    r = requests.post("http://" + SERVER_IP + "/" + endpoint, data = b"".join(chunks + [c.flush()]),
+        headers = {"Content-Encoding": "gzip"})
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
@@ -0,0 +1,95 @@
+# Session storage for the database
+from Crypto.Random import random
+import heapq, string, threading
+
+from header import *
+
+# Maps session tokens to sessions, with an index from each username to its tokens so that a user's
+# sessions are found without scanning. Sessions are evicted in expiry order by reap(). Each
+# session is a dict holding token, username, accesslevel and starttime, and the device hints its
+# worker reported, if any. Times are in milliseconds.
+class SessionStore:
+    def __init__(self):
+        self.sessions = {}      # Maps a token to its session
+        self.tokens = {}        # Maps a username to the set of its tokens
+        self.expiries = []      # Heap of (expiry time, token). May hold deleted tokens
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, token):
+        return token in self.sessions
+
+    def generateToken(self):
+        done = False
+        while not done:
+            tok = ''.join(random.choice(string.ascii_letters) for m in range(TOKENSIZE))
+            done = tok not in self.sessions
+
+        return tok
+
+    # Creates a new session for username, starting at now. Returns its token, which is newly
+    # generated unless given
+    def create(self, username, accesslevel, now, token=None):
+        with self.lock:
+            if token is None:
+                token = self.generateToken()
+            else:
+                self.remove(token)
+            self.sessions[token] = {"token": token, "username": username, "accesslevel": accesslevel, "starttime": now}
+            self.tokens.setdefault(username, set()).add(token)
+            heapq.heappush(self.expiries, (now + SESSION_EXPIRE, token))
+
+            # Rebuild the heap once it is mostly deleted tokens, so that memory stays bounded
+            if len(self.expiries) > 2*len(self.sessions) + 1024:
+                self.expiries = [(s["starttime"] + SESSION_EXPIRE, t) for (t, s) in self.sessions.items()]
+                heapq.heapify(self.expiries)
+
+            return token
+
+    # Returns the session of token, or None if there is none or it expired before now
+    def get(self, token, now):
+        s = self.sessions.get(token)
+        if s is None or s["starttime"] + SESSION_EXPIRE < now:
+            return None
+        return s
+
+    # Returns a list of every (token, session)
+    def items(self):
+        with self.lock:
+            return [(token, dict(s)) for (token, s) in self.sessions.items()]
+
+    # Deletes the session of token. Returns it, or None if there was none
+    def delete(self, token):
+        with self.lock:
+            return self.remove(token)
+
+    # Deletes every session of username. Returns the list of sessions deleted
+    def deleteUser(self, username):
+        with self.lock:
+            return [self.remove(token) for token in list(self.tokens.get(username, ()))]
+
+    # Deletes every session which expired before now, oldest first. Returns the list of sessions deleted
+    def reap(self, now):
+        expired = []
+        with self.lock:
+            while self.expiries and self.expiries[0][0] < now:
+                (expiry, token) = heapq.heappop(self.expiries)
+                s = self.sessions.get(token)
+                if s is not None and s["starttime"] + SESSION_EXPIRE == expiry:
+                    expired.append(self.remove(token))
+
+        return expired
+
+    # Must be called with lock held
+    def remove(self, token):
+        s = self.sessions.pop(token, None)
+        if s is None:
+            return None
+
+        tokens = self.tokens[s["username"]]
+        tokens.discard(token)
+        if not tokens:
+            del self.tokens[s["username"]]
+        return s
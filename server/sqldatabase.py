@@ -0,0 +1,1204 @@
+# SQLite storage backend, with the same interface as database.py
+# Users, projects, blobs and task state are stored on disk following database_1.sql, so the server
+# can hold more than fits in RAM and survives a restart. Blob contents live in a BlobStore next
+# to the database file, and Data_blob holds their hashes. Sessions, graphs, task leases and results
+# held for checking are runtime state, and are kept in memory as in database.py.
+# NB: INPUTS ARE NOT GUARANTEED SAFE OR SANITISED. PLEASE SANITISE YOUR INPUTS FOR THE DATABASE
+
+from datetime import datetime
+from time import mktime
+import threading, atexit, time, functools
+import sqlite3
+import cbor
+
+from header import *
+from dispatch import TaskQueue, ResultFeed, parseTask, isLarge, isConstrained
+from blobstore import BlobStore
+from sessions import SessionStore
+from timeseries import TimeSeries
+from scheduler import FairScheduler
+from batching import BatchSizer
+from verify import Verifier, agreement, judge
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Customer (
+    customerID   INTEGER PRIMARY KEY,
+    customername TEXT NOT NULL UNIQUE,
+    password     TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Worker (
+    workerID     INTEGER PRIMARY KEY,
+    username     TEXT NOT NULL UNIQUE,
+    password     TEXT NOT NULL,
+    prefwifidata INTEGER DEFAULT 1,
+    prefbattery  INTEGER DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS Project (
+    pID          INTEGER PRIMARY KEY,
+    pname        TEXT NOT NULL UNIQUE,
+    pdescription TEXT,
+    customerID   INTEGER REFERENCES Customer(customerID) ON DELETE CASCADE,
+    blobids      INTEGER NOT NULL DEFAULT 0,
+    customGraphs BLOB,
+    weight       REAL NOT NULL DEFAULT 1,
+    verify       REAL
+);
+
+CREATE TABLE IF NOT EXISTS Data_blob (
+    pID      INTEGER NOT NULL REFERENCES Project(pID) ON DELETE CASCADE,
+    blobID   INTEGER NOT NULL,
+    hash     TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    metadata BLOB NOT NULL,
+    PRIMARY KEY(pID, blobID)
+);
+
+-- Every creation and deletion of a blob, numbered by seq within its project
+CREATE TABLE IF NOT EXISTS Blob_change (
+    pID      INTEGER NOT NULL REFERENCES Project(pID) ON DELETE CASCADE,
+    seq      INTEGER NOT NULL,
+    blobID   INTEGER NOT NULL,
+    deleted  INTEGER NOT NULL,
+    PRIMARY KEY(pID, seq)
+);
+
+CREATE TABLE IF NOT EXISTS Project_task (
+    pID      INTEGER NOT NULL REFERENCES Project(pID) ON DELETE CASCADE,
+    taskID   INTEGER NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0,
+    large    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(pID, taskID)
+);
+
+-- Unfinished tasks are loaded into the ready queue on start up
+CREATE INDEX IF NOT EXISTS Project_task_unfinished ON Project_task(pID, taskID) WHERE finished = 0;
+
+CREATE TABLE IF NOT EXISTS Completed_task (
+    pID      INTEGER NOT NULL REFERENCES Project(pID) ON DELETE CASCADE,
+    taskID   INTEGER NOT NULL,
+    workerID INTEGER REFERENCES Worker(workerID) ON DELETE CASCADE,
+    time     INTEGER NOT NULL,
+    PRIMARY KEY(pID, taskID)
+);
+"""
+
+def changeGraph(pID, graphname, diff):
+    graphing = projects[pID]["graphing"]
+    graphing["standardGraphs"][graphname].add(getTime(), diff)
+    # Bumped after the change, so that a client never holds a version newer than its data
+    graphing["versions"]["standardGraphs"] += 1
+
+# True iff metadata marks its blob as the result of a task, as sendTasks does
+def isResult(metadata):
+    try:
+        return cbor.loads(metadata)["result"] == True
+    except Exception:
+        return False
+
+def getTime():
+    return int(mktime(datetime.now().timetuple()))*1000
+
+def salthash(passwd, salt):
+    return passwd
+
+def newGraphing():
+    return {
+        "standardGraphs": {
+            "activeWorkers":    TimeSeries(getTime()),
+            "totalWorkers":     TimeSeries(getTime()),
+            "tasksCompleted":   TimeSeries(getTime()),
+            "tasksFailed":      TimeSeries(getTime()),
+            "tasksRefused":     TimeSeries(getTime()),
+            "cpuTime":          TimeSeries(getTime())
+        },
+        "customGraphs": {},
+        "versions": {"standardGraphs": 0, "customGraphs": 0}   # Bumped whenever a graph changes
+    }
+
+conn = None         # The SQLite connection, shared by all threads under lock
+store = None        # Holds the contents of every blob, keyed by hash
+lock = threading.RLock()
+pending = 0         # Mutations made since the last commit
+batch = 0           # Number of the open transaction, counting up with each commit
+local = threading.local()   # Per thread, the batch holding its latest mutation, and the depth of durable calls
+
+issuedTasks = {}    # Maps a username to a dict mapping project names to its set of issued tasks
+sessions = SessionStore()   # Maps tokens to sessions, and usernames to their tokens
+projects = {}       # Maps project names to their runtime state: pID, task queue, result feed, latest change seq, graphs, verify rate and held results
+scheduler = FairScheduler()     # Picks the project a worker asking for any tasks is given
+smallScheduler = FairScheduler()    # Likewise for workers only given small tasks, among projects with small tasks waiting
+batches = BatchSizer()  # Measures how fast each worker completes tasks
+verifier = Verifier()   # Picks the completed tasks whose results are checked
+
+# Opens (creating if necessary) the database at path, and loads the task queues of its projects
+def openDatabase(path):
+    global conn, store
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SCHEMA)
+    # Databases made before projects had weights gain the column
+    if "weight" not in [col[1] for col in conn.execute("PRAGMA table_info(Project)")]:
+        conn.execute("ALTER TABLE Project ADD COLUMN weight REAL NOT NULL DEFAULT 1")
+    # Likewise for tasks made before large tasks were told apart
+    if "large" not in [col[1] for col in conn.execute("PRAGMA table_info(Project_task)")]:
+        conn.execute("ALTER TABLE Project_task ADD COLUMN large INTEGER NOT NULL DEFAULT 0")
+    # Likewise for projects made before results were checked. NULL is the default rate
+    if "verify" not in [col[1] for col in conn.execute("PRAGMA table_info(Project)")]:
+        conn.execute("ALTER TABLE Project ADD COLUMN verify REAL")
+
+    # Count the references to each stored blob, and delete any which were never committed, or were
+    # results held for checking. Their tasks are run again
+    store = BlobStore(path + ".blobs", BLOB_COMPRESS_LEVELS)
+    for (h, n) in conn.execute("SELECT hash, COUNT(*) FROM Data_blob GROUP BY hash"):
+        store.restore(h, n)
+    store.sweep()
+
+    projects.clear()
+    for (pID, pname, customGraphs, weight, verify) in conn.execute("SELECT pID, pname, customGraphs, weight, verify FROM Project"):
+        p = projects[pname] = newProject(pID, verify)
+        if customGraphs is not None:
+            p["graphing"]["customGraphs"] = cbor.loads(customGraphs)
+
+        for (taskID, large) in conn.execute("SELECT taskID, large FROM Project_task WHERE pID = ? AND finished = 0 ORDER BY taskID", (pID,)):
+            p["tasks"].push(str(taskID), bool(large))
+        scheduler.setWeight(pname, weight)
+        smallScheduler.setWeight(pname, weight)
+        wake(pname, False)
+        (p["seq"],) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM Blob_change WHERE pID = ?", (pID,)).fetchone()
+
+        # Result blobs are only marked in their metadata, so find them once here
+        p["results"].append(bID for (bID, metadata) in conn.execute("SELECT blobID, metadata FROM Data_blob WHERE pID = ? ORDER BY blobID", (pID,))
+                if isResult(metadata))
+
+    threading.Thread(target=commitLoop, daemon=True).start()
+    threading.Thread(target=sessionReaper, daemon=True).start()
+    atexit.register(flush)
+
+# Returns the runtime state of the project with ID pID, whose results are checked at rate verify,
+# or at VERIFY_RATE if it is None
+def newProject(pID, verify=None):
+    return {"pID": pID, "tasks": TaskQueue(), "results": ResultFeed(), "seq": 0, "graphing": newGraphing(),
+        "verify": VERIFY_RATE if verify is None else verify, "checks": {}}
+
+# Marks project pname as having a task waiting, for workers given small tasks too unless it is large
+def wake(pname, large):
+    scheduler.wake(pname)
+    if not large:
+        smallScheduler.wake(pname)
+
+# Group commit: mutations accumulate in one transaction, which is committed once GROUP_COMMIT_SIZE
+# mutations are pending, or once a durable() function which made one returns. Whichever caller
+# finds its batch still open commits it, along with the mutations of every caller which made one
+# meanwhile, so that one commit serves them all and nothing is acknowledged before it is committed.
+# Must be called with lock held
+def begin():
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+
+def mutated():
+    global pending
+    pending += 1
+    local.batch = batch
+    if pending >= GROUP_COMMIT_SIZE:
+        commit()
+
+def commit():
+    global pending, batch
+    if conn.in_transaction:
+        conn.execute("COMMIT")
+    pending = 0
+    batch += 1
+
+    # Deleted blobs are only removed from disk once their rows are gone for good
+    store.collect()
+
+# Commits any pending mutations now
+def flush():
+    with lock:
+        commit()
+
+# Deletes every row, so that the database starts empty when the server next starts. Blobs left in
+# the store are swept then. Only for rebooting a test server
+def wipe():
+    with lock:
+        commit()
+        conn.execute("PRAGMA foreign_keys=OFF")
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall():
+            conn.execute("DELETE FROM " + table)
+        conn.execute("PRAGMA foreign_keys=ON")
+
+# Wraps a function which mutates the database, so that it only returns once its mutations are
+# committed. A durable function called by another waits for its caller's commit instead
+def durable(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            local.depth = depth
+            ticket = getattr(local, "batch", None)
+            if depth == 0 and ticket is not None:
+                local.batch = None
+                with lock:
+                    if batch == ticket:
+                        commit()
+    return wrapper
+
+# Commits mutations made outside durable functions
+def commitLoop():
+    while True:
+        time.sleep(GROUP_COMMIT_INTERVAL / 1000)
+        with lock:
+            if pending:
+                commit()
+
+## AUTHENTICATION ##
+# Registers a new user in the database. A worker's preferences say whether it would rather save
+# mobile data and battery than be given large tasks. Returns true iff successful
+@durable
+def register(username, password, accesslevel, prefwifidata=True, prefbattery=True):
+    with lock:
+        if queryUser(username) is not None:
+            return False
+
+        begin()
+        if accesslevel == "customer":
+            conn.execute("INSERT INTO Customer (customername, password) VALUES (?, ?)", (username, salthash(password, username)))
+        else:
+            conn.execute("INSERT INTO Worker (username, password, prefwifidata, prefbattery) VALUES (?, ?, ?, ?)",
+                    (username, salthash(password, username), int(prefwifidata), int(prefbattery)))
+        mutated()
+        return True
+
+# Returns (hashpass, accesslevel) of a user, or None if there is no such user
+def queryUser(username):
+    row = conn.execute("SELECT password FROM Customer WHERE customername = ?", (username,)).fetchone()
+    if row is not None:
+        return (row[0], "customer")
+
+    row = conn.execute("SELECT password FROM Worker WHERE username = ?", (username,)).fetchone()
+    if row is not None:
+        return (row[0], "worker")
+
+    return None
+
+# Returns whether the username corresponds to the password of a user, of level accesslevel. The
+# new session is given token if one is passed
+def login(username, password, accesslevel, token=None):
+    with lock:
+        user = queryUser(username)
+        # Test for correct credentials
+        if user is not None and user == (salthash(password, username), accesslevel):
+            # Create a new session
+            token = sessions.create(username, accesslevel, getTime(), token)
+
+            # Graphing
+            for pname in issuedTasks.get(username, {}):
+                changeGraph(pname, "activeWorkers", 1)
+
+            return (True, token)
+        return (False, 0)
+
+def logoutGraphUpdate(username):
+    with lock:
+        # Graphing
+        for pname in issuedTasks.get(username, {}):
+            # Remove active user for each project
+            changeGraph(pname, "activeWorkers", -1)
+
+
+## Allows extraction of the user from currently active sessions. This should be cached in front of the database
+def querySession(token, query):
+    if query not in ["username", "starttime", "accesslevel"]:
+        return (False, 0)
+
+    if token not in sessions:
+        return (False, 0)
+
+    return (True, sessions.sessions[token][query])
+
+# Returns the session of token if it is active. The session is a dict holding username, accesslevel
+# and starttime
+def getSession(token):
+    s = sessions.get(token, getTime())
+    if s is None:
+        return (False, "Session expired or invalid token")
+
+    return (True, s)
+
+# Records the device hints reported by the worker holding session token. They last as long as the session
+def setDevice(token, device):
+    s = sessions.get(token, getTime())
+    if s is not None:
+        s["device"] = device
+
+# True iff username may be given large tasks, given the device hints it reported and its preferences
+def takesLargeTasks(username, device):
+    with lock:
+        row = conn.execute("SELECT prefwifidata, prefbattery FROM Worker WHERE username = ?", (username,)).fetchone()
+    if row is None:
+        return True
+    return not isConstrained(device, bool(row[0]), bool(row[1]))
+
+# Deletes the session
+def deleteSession(data, kind):
+    if kind == "token":
+        return sessions.delete(data) is not None
+    elif kind == "username":
+        # If the user curently has an active session, destroy the session
+        if not sessions.deleteUser(data):
+            return False
+
+        # Update graphs that this user is no longer active
+        logoutGraphUpdate(data)
+        return True
+    else:
+        return False
+
+# Deletes expired sessions, oldest first, and updates graphs that their users are no longer active
+def reapSessions():
+    for s in sessions.reap(getTime()):
+        logoutGraphUpdate(s["username"])
+
+def sessionReaper():
+    while True:
+        time.sleep(SESSION_REAP_INTERVAL / 1000)
+        reapSessions()
+
+## CUSTOMER METHODS ##
+# Creates a new project called pname, with description pdescription. Returns whether the
+# operation was successful
+@durable
+def createNewProject(pname, pdescription):
+    with lock:
+        if pname in projects:
+            return False
+
+        begin()
+        cur = conn.execute("INSERT INTO Project (pname, pdescription) VALUES (?, ?)", (pname, pdescription))
+        mutated()
+
+        projects[pname] = newProject(cur.lastrowid)
+        return True
+
+# Creates a new blob, and stores it along with its metadata
+@durable
+def createNewBlob(pID, blob, metadata):
+    # Check that the project exists
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, 0)
+
+    # Writing the blob to disk is not made under the lock
+    h = store.put(blob)
+    with lock:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            store.release(h)
+            return (False, 0)
+
+        bID = addBlob(p, h, len(blob), metadata)
+        mutated()
+        return (True, bID)
+
+# Creates a new blob from size bytes read in chunks from read(n), without holding it all in memory
+@durable
+def createNewBlobStream(pID, read, size, metadata):
+    # Check that the project exists
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Failed to find project")
+
+    # The upload may be slow, so it is not made under the lock
+    try:
+        (h, size) = store.putStream(read, size)
+    except Exception as e:
+        return (False, "Failed to store blob: " + str(e))
+
+    with lock:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            store.release(h)
+            return (False, "Failed to find project")
+
+        bID = addBlob(p, h, size, metadata)
+        mutated()
+        return (True, bID)
+
+# Gives the blob with hash h and its metadata a new blob ID in project p, which is returned.
+# Must be called with lock held, and followed by mutated() or commit()
+def addBlob(p, h, size, metadata):
+    begin()
+    (bID,) = conn.execute("SELECT blobids FROM Project WHERE pID = ?", (p["pID"],)).fetchone()
+    conn.execute("UPDATE Project SET blobids = ? WHERE pID = ?", (bID+1, p["pID"]))
+    conn.execute("INSERT INTO Data_blob (pID, blobID, hash, size, metadata) VALUES (?, ?, ?, ?, ?)", (p["pID"], bID, h, size, metadata))
+    recordChange(p, bID, False)
+
+    return str(bID)
+
+# Records that blob bID of project p was created, or deleted if deleted is true. Must be called
+# with lock held, inside a transaction
+def recordChange(p, bID, deleted):
+    p["seq"] += 1
+    conn.execute("INSERT INTO Blob_change (pID, seq, blobID, deleted) VALUES (?, ?, ?, ?)", (p["pID"], p["seq"], bID, int(deleted)))
+
+# Returns the (hash, metadata) of blob blobID of project p, or None if it does not exist
+def queryBlob(p, blobID):
+    try:
+        bID = int(blobID)
+    except ValueError:
+        return None
+
+    return conn.execute("SELECT hash, metadata FROM Data_blob WHERE pID = ? AND blobID = ?", (p["pID"], bID)).fetchone()
+
+# Convert blob blobID in project pID into a task, which is stored in the list of unfinished tasks
+@durable
+def blobToTask(pID, blobID):
+    with lock:
+        if pID not in projects:
+            return (False, "Failed to find blob")
+
+        (succ, msg) = makeTask(pID, blobID)
+        if succ:
+            mutated()
+        return (succ, msg)
+
+# Checks blob blobID of project pID is a task, records it, and pushes it onto the queue of "to-do"
+# tasks. Must be called with lock held
+def makeTask(pID, blobID):
+    p = projects[pID]
+    try:
+        (h, metadata) = queryBlob(p, blobID)
+    except Exception:
+        return (False, "Failed to find blob")
+
+    # Test whether the blob actually is a task
+    (succ, task) = parseTask(store.read(h))
+    if not succ:
+        return (False, task)
+
+    large = isLarge(task)
+    begin()
+    conn.execute("INSERT OR IGNORE INTO Project_task (pID, taskID, large) VALUES (?, ?, ?)", (p["pID"], int(blobID), int(large)))
+    p["tasks"].push(blobID, large)
+    wake(pID, large)
+
+    return (True, "")
+
+## BATCH METHODS ##
+# Creates a blob for each of blobs, with the corresponding metadata. If totask is true, each blob
+# is also checked and converted into a task. Returns a list holding (True, blobID) or
+# (False, error message) for each blob. The whole batch is made in one transaction
+def createNewBlobs(pID, blobs, metadatas, totask):
+    try:
+        p = projects[pID]
+    except Exception:
+        return (False, "Failed to find project")
+
+    # Check and store the contents first, outside the lock
+    stored = []
+    for (blob, metadata) in zip(blobs, metadatas):
+        large = False
+        if totask:
+            (succ, task) = parseTask(blob)
+            if not succ:
+                stored.append((False, task, False))
+                continue
+            large = isLarge(task)
+        stored.append((True, (store.put(blob), len(blob), metadata), large))
+
+    with lock:
+        if projects.get(pID) is not p:
+            # Dropped meanwhile
+            for (succ, b, large) in stored:
+                if succ:
+                    store.release(b[0])
+            return (False, "Failed to find project")
+
+        results = []
+        for (succ, b, large) in stored:
+            if not succ:
+                results.append((False, b))
+                continue
+
+            bID = addBlob(p, *b)
+            if totask:
+                conn.execute("INSERT OR IGNORE INTO Project_task (pID, taskID, large) VALUES (?, ?, ?)", (p["pID"], int(bID), int(large)))
+                p["tasks"].push(bID, large)
+            results.append((True, bID))
+
+        if totask and any(succ for (succ, b, large) in stored):
+            wake(pID, all(large for (succ, b, large) in stored if succ))
+        commit()
+        return (True, results)
+
+# Converts each of blobIDs into a task. Returns a list of (success, error message) for each blob.
+# The whole batch is made in one transaction
+def blobsToTasks(pID, blobIDs):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Failed to find project")
+
+        results = [makeTask(pID, blobID) for blobID in blobIDs]
+        commit()
+        return (True, results)
+
+# Return a dict mapping blobs IDs to their metadata. Can optionally specity a list of blobs
+# whose metadata we'd like. Otherwise returns a page of up to limit blobs after blob ID after, and
+# the blob ID to pass as after for the next page, or None if this is the last
+def getBlobMetadata(pID, blobIDs, after=-1, limit=PAGE_SIZE):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Failed to find project", None)
+
+        metas = {}
+        if blobIDs != []:
+            for blobID in set(blobIDs):
+                row = queryBlob(p, blobID)
+                if row is not None:
+                    metas[blobID] = row[1]
+            return (True, metas, None)
+
+        last = None
+        for (bID, metadata) in conn.execute("SELECT blobID, metadata FROM Data_blob WHERE pID = ? AND blobID > ? ORDER BY blobID LIMIT ?",
+                (p["pID"], after, limit)):
+            metas[str(bID)] = metadata
+            last = bID
+
+        return (True, metas, last if len(metas) == limit else None)
+
+# Returns up to limit changes to the blobs of project pID after sequence number seq, and the latest
+# sequence number. Each change is a dict holding seq, blobID, deleted, and the metadata of blobs
+# which still exist
+def getChanges(pID, seq, limit):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Failed to find project", 0)
+
+        changes = []
+        for (s, bID, deleted, metadata) in conn.execute("""SELECT c.seq, c.blobID, c.deleted, b.metadata FROM Blob_change c
+                LEFT JOIN Data_blob b ON b.pID = c.pID AND b.blobID = c.blobID
+                WHERE c.pID = ? AND c.seq > ? ORDER BY c.seq LIMIT ?""", (p["pID"], seq, limit)):
+            changes.append({"seq": s, "blobID": str(bID), "deleted": bool(deleted), "metadata": metadata})
+
+        return (True, changes, p["seq"])
+
+# Waits up to timeout milliseconds for result blobs created after blob ID cursor. Returns a list of
+# up to limit (blob ID, metadata) pairs, oldest first, which is empty if none arrived in time, and
+# the cursor to pass next
+def waitForResults(pID, cursor, timeout, limit):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Failed to find project", cursor)
+
+    # Wait without holding the lock, so that sendTasks can add the results
+    blobIDs = p["results"].wait(cursor, limit, timeout)
+
+    with lock:
+        results = []
+        for blobID in blobIDs:
+            cursor = int(blobID)
+            # Skip results the customer has already deleted
+            row = queryBlob(p, blobID)
+            if row is not None:
+                results.append((blobID, row[1]))
+
+        return (True, results, cursor)
+
+# Return blob blobID from project pID, along with its metadata
+def getBlob(pID, blobID):
+    with lock:
+        try:
+            (h, metadata) = queryBlob(projects[pID], blobID)
+        except Exception:
+            return (False, "Failed to find blob", 0)
+
+        return (True, store.read(h), metadata)
+
+# Return the size of blob blobID from project pID, an iterator over its contents in chunks, and its metadata
+def streamBlob(pID, blobID):
+    with lock:
+        try:
+            p = projects[pID]
+            bID = int(blobID)
+        except Exception:
+            return (False, "Failed to find blob", 0, 0)
+
+        row = conn.execute("SELECT hash, size, metadata FROM Data_blob WHERE pID = ? AND blobID = ?", (p["pID"], bID)).fetchone()
+        if row is None:
+            return (False, "Failed to find blob", 0, 0)
+
+        (h, size, metadata) = row
+        return (True, size, store.stream(h), metadata)
+
+# Returns the size of the stored blob with hash h, and an iterator over its contents in chunks.
+# Whichever blob it belongs to, the contents named by a hash never change
+def streamHash(h):
+    if h not in store:
+        return (False, "Failed to find blob", 0)
+
+    try:
+        return (True, store.size(h), store.stream(h))
+    except OSError:
+        # Deleted since it was checked
+        return (False, "Failed to find blob", 0)
+
+# Returns the size of the stored copy of the blob with hash h compressed in encoding, and an
+# iterator over it in chunks, if the blob has one
+def streamCompressedHash(h, encoding):
+    copy = store.streamCompressed(h, encoding) if h in store else None
+    if copy is None:
+        return (False, "No compressed copy", 0)
+    return (True, copy[0], copy[1])
+
+# Returns the stored copy of blob blobID from project pID compressed in encoding, if it has one
+def getCompressedBlob(pID, blobID, encoding):
+    with lock:
+        try:
+            (h, metadata) = queryBlob(projects[pID], blobID)
+        except Exception:
+            return (False, "Failed to find blob")
+
+    copy = store.streamCompressed(h, encoding)
+    if copy is None:
+        return (False, "No compressed copy")
+    return (True, b"".join(copy[1]))
+
+# Returns a dict mapping the program blob ID of each of the task blobs tasks to its hash and size
+def getPrograms(pID, tasks):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Failed to find project")
+
+        programs = {}
+        for t in tasks:
+            (succ, task) = parseTask(t)
+            if not succ:
+                continue
+            programID = task["program"]["id"]
+            try:
+                bID = int(programID)
+            except ValueError:
+                continue
+            row = conn.execute("SELECT hash, size FROM Data_blob WHERE pID = ? AND blobID = ?", (p["pID"], bID)).fetchone()
+            if row is not None:
+                programs[programID] = {"hash": row[0], "size": row[1]}
+
+        return (True, programs)
+
+# Returns the contents of the input blobs of the task blobs tasks, each blob once, for as long as
+# their total size fits within budget bytes, and a list of the IDs of the input blobs left over
+def getInputBlobs(pID, tasks, budget):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Failed to find project", [])
+
+        inline = {}
+        deferred = []
+        for t in tasks:
+            (succ, task) = parseTask(t)
+            if not succ:
+                continue
+            for ref in task["blobs"]:
+                blobID = str(ref["id"])
+                if blobID in inline or blobID in deferred:
+                    continue
+                try:
+                    bID = int(blobID)
+                except ValueError:
+                    continue
+                row = conn.execute("SELECT hash, size FROM Data_blob WHERE pID = ? AND blobID = ?", (p["pID"], bID)).fetchone()
+                if row is None:
+                    continue
+                if row[1] <= budget:
+                    inline[blobID] = store.read(row[0])
+                    budget -= row[1]
+                else:
+                    deferred.append(blobID)
+
+        return (True, inline, deferred)
+
+# Deletes blob blobID from project pID, returns if successful
+@durable
+def deleteBlob(pID, blobID):
+    with lock:
+        try:
+            p = projects[pID]
+            bID = int(blobID)
+        except Exception:
+            return (False, "Could not fetch blobs")
+
+        row = queryBlob(p, blobID)
+        if row is None:
+            return (False, "Could not fetch blobs")
+
+        begin()
+        conn.execute("DELETE FROM Data_blob WHERE pID = ? AND blobID = ?", (p["pID"], bID))
+        conn.execute("DELETE FROM Project_task WHERE pID = ? AND taskID = ?", (p["pID"], bID))
+        recordChange(p, bID, True)
+        store.release(row[0])
+        for run in p["checks"].pop(blobID, []):
+            for h in run[1]:
+                store.release(h)
+        mutated()
+
+        p["tasks"].discard(blobID)
+        return (True, "")
+
+
+## WORKER METHODS ##
+
+# Returns a unique identifier for a task from the tasklist for the worker to get on with. Large
+# tasks are given first if large is true, and not at all otherwise
+def getTasks(pID, username, maxtasks, large=True):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Project does not exist", 0)
+
+        queue = p["tasks"]
+
+        # Test if the issued tasks set has been constructed
+        mine = issuedTasks.setdefault(username, {})
+        if pID not in mine:
+            # This is a first-time active user
+            changeGraph(pID, "totalWorkers", 1)
+            changeGraph(pID, "activeWorkers", 1)
+            mine[pID] = queue.workerTasks(username)
+
+        # Reissue tasks whose leases have run out, then take new tasks off the front of the ready
+        # queue. A worker faster than the straggler time may be given spare copies of stragglers
+        now = getTime()
+        queue.reap(now)
+        taskIDs = queue.pop(username, maxtasks, now, large, batches.isFaster(username, queue.stragglerTime()))
+        scheduler.charge(pID, len(taskIDs))
+        smallScheduler.charge(pID, len(taskIDs))
+        batches.issue(username, len(taskIDs))
+
+        # Find the associated blob with each task ID
+        tasks = []
+        for t in taskIDs:
+            (succ, b, m) = getBlob(pID, t)
+            if not succ:
+                return (False, "Task collection error: " + str(b), 0)
+            tasks.append(b)
+
+        return (True, tasks, taskIDs)
+
+# Issues up to maxtasks tasks to username from whichever project the scheduler picks, taking large
+# tasks only if large is true. Returns the name of the project, or None if no project has tasks
+# waiting, along with the tasks and their IDs
+def scheduleTasks(username, maxtasks, large=True):
+    chooser = scheduler if large else smallScheduler
+    passed = set()
+    with lock:
+        while maxtasks > 0:
+            pID = chooser.next(getTime())
+            if pID is None:
+                break
+
+            if pID not in projects:
+                chooser.remove(pID)
+                continue
+            (succ, tasks, taskIDs) = getTasks(pID, username, maxtasks, large)
+            if not succ:
+                return (False, tasks, None, 0)
+            if taskIDs:
+                return (True, pID, tasks, taskIDs)
+
+            # Nothing is waiting, so look again once a lease it issued may have run out
+            queue = projects[pID]["tasks"]
+            if queue.waiting(True) == 0:
+                scheduler.sleep(pID, queue.nextWake(getTime()))
+            if queue.waiting(False) == 0:
+                smallScheduler.sleep(pID, queue.nextWake(getTime()))
+
+            # Only tasks username already ran are waiting, for other workers to check, so count a
+            # task against the project and look at the others
+            if queue.waiting(large) > 0:
+                if pID in passed:
+                    break
+                passed.add(pID)
+                chooser.charge(pID, 1)
+
+        return (True, None, [], [])
+
+# Returns how many tasks username should ask for at once to poll about every BATCH_INTERVAL, or None
+# if it has not yet completed a batch
+def suggestBatch(username):
+    return batches.suggest(username)
+
+# Stores the list of blobs in the database, along with the metadata. A sample of completed tasks
+# is run again by another worker, and their results are only stored once two runs agree
+@durable
+def sendTasks(pID, taskID, results, metadatas, username, status):
+    with lock:
+        try:
+            p = projects[pID]
+        except Exception:
+            return (False, "Task does not exist")
+
+        # Another copy of the task completed first, so this result is not needed
+        queue = p["tasks"]
+        if queue.isSuperseded(taskID, username) and status in ["ok", "error", "refused"]:
+            batches.report(username, status == "ok")
+            return (True, "")
+
+        # Test that this phone completed tasks it was supposed to
+        if not queue.isIssued(taskID, username):
+            return (False, "Task was not scheduled: " + str(taskID))
+
+        # Results of tasks being checked are held until they can be compared
+        if status == "ok" and (taskID in p["checks"] or verifier.sample(username, p["verify"])):
+            if checkResults(pID, taskID, username, results, metadatas):
+                changeGraph(pID, "tasksCompleted", 1)
+
+        # If status is ok, count the task as completed
+        elif status == "ok":
+            # Take the old task off the task list
+            queue.complete(taskID, username, getTime())
+            begin()
+            conn.execute("UPDATE Project_task SET finished = 1 WHERE pID = ? AND taskID = ?", (p["pID"], int(taskID)))
+            conn.execute("INSERT OR REPLACE INTO Completed_task (pID, taskID, workerID, time) SELECT ?, ?, workerID, ? FROM Worker WHERE username = ?",
+                    (p["pID"], int(taskID), getTime(), username))
+            mutated()
+
+            # Create all the new blobs, and wake customers waiting for them
+            blobIDs = [createNewBlob(pID, blob, meta)[1] for (blob, meta) in zip(results, metadatas)]
+            p["results"].append(blobIDs)
+
+            # Update graphing info
+            changeGraph(pID, "tasksCompleted", 1)
+
+        # If status is error, we can give the task back later
+        elif status == "error":
+            queue.release(taskID, username)
+            wake(pID, taskID in queue.large)
+            changeGraph(pID, "tasksFailed", 1)
+
+        # If status is refused, give the task to someone else
+        elif status == "refused":
+            queue.release(taskID, username)
+            wake(pID, taskID in queue.large)
+            changeGraph(pID, "tasksRefused", 1)
+        else:
+            return (False, "Invalid error code")
+
+        batches.report(username, status == "ok")
+        return (True, "")
+
+# Holds the results username gave for task taskID of project pID, which is being checked. Once two
+# runs agree, or there have been VERIFY_RUNS, the task is finished and the results of the run which
+# won are stored. Otherwise the task is given to another worker. Returns true iff the task was
+# finished. Must be called with lock held
+def checkResults(pID, taskID, username, results, metadatas):
+    p = projects[pID]
+    queue = p["tasks"]
+    now = getTime()
+    runs = p["checks"].setdefault(taskID, [])
+    runs.append([username, [store.put(blob) for blob in results], [len(blob) for blob in results], metadatas])
+    agreed = agreement(runs)
+    if agreed is None and len(runs) < VERIFY_RUNS:
+        queue.recheck(taskID, username, now)
+        wake(pID, taskID in queue.large)
+        return False
+
+    # Without agreement the first run wins, and is recorded as completing the task
+    winner = 0 if agreed is None else agreed
+    del p["checks"][taskID]
+    queue.complete(taskID, username, now)
+    begin()
+    conn.execute("UPDATE Project_task SET finished = 1 WHERE pID = ? AND taskID = ?", (p["pID"], int(taskID)))
+    conn.execute("INSERT OR REPLACE INTO Completed_task (pID, taskID, workerID, time) SELECT ?, ?, workerID, ? FROM Worker WHERE username = ?",
+            (p["pID"], int(taskID), now, runs[winner][0]))
+    blobIDs = [addBlob(p, h, size, metadata) for (h, size, metadata) in zip(*runs[winner][1:])]
+    mutated()
+    p["results"].append(blobIDs)
+
+    for (i, run) in enumerate(runs):
+        if i != winner:
+            for h in run[1]:
+                store.release(h)
+    judge(verifier, runs, agreed)
+    return True
+
+# Extends the leases username holds on each of taskIDs. Returns the list of task IDs renewed
+def renewLeases(pID, username, taskIDs):
+    with lock:
+        try:
+            queue = projects[pID]["tasks"]
+        except Exception:
+            return (False, "Project does not exist")
+
+        now = getTime()
+        queue.reap(now)
+        renewed = [t for t in taskIDs if queue.renew(t, username, now)]
+
+        return (True, renewed)
+
+## PROJECT METHODS
+# Returns a dict mapping each project name to its public details: its description, its share of
+# workers asking for any project, the share of its tasks checked, and the number of its tasks waiting
+def getProjectsList():
+    with lock:
+        return {pname: {"description": desc, "weight": weight, "verify": projects[pname]["verify"], "waiting": len(projects[pname]["tasks"])}
+            for (pname, desc, weight) in conn.execute("SELECT pname, pdescription, weight FROM Project")}
+
+# Returns the gauges of the metrics endpoint: the number of live sessions, and for each project the
+# tasks waiting and issued, the total size of its blobs and the points held in its graphs
+def getMetrics():
+    with lock:
+        sizes = dict(conn.execute("SELECT pID, SUM(size) FROM Data_blob GROUP BY pID"))
+        gauges = {pname: {"waiting": len(p["tasks"]), "issued": len(p["tasks"].owners),
+            "spares": len(p["tasks"].spares), "blobBytes": sizes.get(p["pID"], 0),
+            "graphPoints": sum(series.size() for series in p["graphing"]["standardGraphs"].values())} for (pname, p) in projects.items()}
+        return {"sessions": len(sessions), "projects": gauges}
+
+def getDescription(pname):
+    with lock:
+        row = conn.execute("SELECT pdescription FROM Project WHERE pname = ?", (pname,)).fetchone()
+        if row is None:
+            return (False, "Invalid project name")
+
+        return (True, row[0])
+
+# Sets the weight of project pname, which is its share of the workers asking for tasks from any
+# project relative to other projects
+@durable
+def setProjectWeight(pname, weight):
+    with lock:
+        try:
+            p = projects[pname]
+        except Exception:
+            return (False, "Invalid project name")
+
+        begin()
+        conn.execute("UPDATE Project SET weight = ? WHERE pID = ?", (weight, p["pID"]))
+        mutated()
+        scheduler.setWeight(pname, weight)
+        smallScheduler.setWeight(pname, weight)
+        return (True, "")
+
+# Sets the share of the completed tasks of project pname which are run again by another worker to
+# check their results. Workers whose results have disagreed have more of their tasks checked
+@durable
+def setVerifyRate(pname, rate):
+    with lock:
+        try:
+            p = projects[pname]
+        except Exception:
+            return (False, "Invalid project name")
+
+        begin()
+        conn.execute("UPDATE Project SET verify = ? WHERE pID = ?", (rate, p["pID"]))
+        mutated()
+        p["verify"] = rate
+        return (True, "")
+
+## MIGRATION METHODS
+# Used by router.py to move projects and users between servers
+
+# Returns everything in project pname as plain values: its blobs, the contents of each distinct
+# blob once, its task queue, results, changes and graphs, and the workers who have worked on it.
+# Results held for checking are not moved. The tasks are run and checked again instead
+def exportProject(pname):
+    with lock:
+        try:
+            p = projects[pname]
+        except Exception:
+            return (False, "Invalid project name")
+
+        blobs = [[str(bID), h, size, metadata, bool(task), bool(finished)] for (bID, h, size, metadata, task, finished) in conn.execute(
+                """SELECT b.blobID, b.hash, b.size, b.metadata, t.taskID IS NOT NULL, COALESCE(t.finished, 0) FROM Data_blob b
+                LEFT JOIN Project_task t ON t.pID = b.pID AND t.taskID = b.blobID
+                WHERE b.pID = ? ORDER BY b.blobID""", (p["pID"],))]
+        (description, blobids, weight) = conn.execute("SELECT pdescription, blobids, weight FROM Project WHERE pID = ?", (p["pID"],)).fetchone()
+
+        try:
+            contents = {b[1]: store.read(b[1]) for b in blobs}
+        except OSError as e:
+            return (False, "Failed to read blob: " + str(e))
+
+        return (True, {"description": description, "weight": weight, "verify": p["verify"], "blobids": blobids, "blobs": blobs, "contents": contents,
+            "queue": p["tasks"].dump(),
+            "results": p["results"].after(-1, blobids),
+            "changes": [[str(bID), bool(deleted)] for (bID, deleted) in
+                conn.execute("SELECT blobID, deleted FROM Blob_change WHERE pID = ? ORDER BY seq", (p["pID"],))],
+            "graphs": {name: series.dump() for (name, series) in p["graphing"]["standardGraphs"].items()},
+            "customGraphs": p["graphing"]["customGraphs"],
+            "workers": [u for (u, mine) in issuedTasks.items() if pname in mine]})
+
+# Creates project pname from an exportProject() dump. The whole project is made in one transaction
+def importProject(pname, dump):
+    if pname in projects:
+        return (False, "Project already exists")
+
+    try:
+        blobs = [(int(bID), h, size, metadata, task, finished) for (bID, h, size, metadata, task, finished) in dump["blobs"]]
+        contents = dump["contents"]
+        for b in blobs:
+            test = contents[b[1]]
+    except Exception:
+        return (False, "Invalid project dump")
+
+    # Store each distinct blob once outside the lock, with a reference for every blob ID
+    stored = set()
+    for (bID, h, size, metadata, task, finished) in blobs:
+        if h in stored:
+            store.restore(h, 1)
+        else:
+            store.put(contents[h])
+            stored.add(h)
+
+    with lock:
+        if pname in projects:
+            # Created meanwhile
+            for b in blobs:
+                store.release(b[1])
+            commit()
+            return (False, "Project already exists")
+
+        begin()
+        pID = conn.execute("INSERT INTO Project (pname, pdescription, blobids, customGraphs, weight, verify) VALUES (?, ?, ?, ?, ?, ?)",
+                (pname, dump["description"], dump["blobids"], cbor.dumps(dump["customGraphs"]), dump.get("weight", 1), dump.get("verify"))).lastrowid
+        conn.executemany("INSERT INTO Data_blob (pID, blobID, hash, size, metadata) VALUES (?, ?, ?, ?, ?)",
+                ((pID, bID, h, size, metadata) for (bID, h, size, metadata, task, finished) in blobs))
+        large = set(dump["queue"].get("large", []))
+        conn.executemany("INSERT INTO Project_task (pID, taskID, finished, large) VALUES (?, ?, ?, ?)",
+                ((pID, bID, int(finished), int(str(bID) in large)) for (bID, h, size, metadata, task, finished) in blobs if task))
+        conn.executemany("INSERT INTO Blob_change (pID, seq, blobID, deleted) VALUES (?, ?, ?, ?)",
+                ((pID, seq+1, int(bID), int(deleted)) for (seq, (bID, deleted)) in enumerate(dump["changes"])))
+        commit()
+
+        p = newProject(pID, dump.get("verify"))
+        p["seq"] = len(dump["changes"])
+        p["tasks"].load(dump["queue"])
+        scheduler.setWeight(pname, dump.get("weight", 1))
+        smallScheduler.setWeight(pname, dump.get("weight", 1))
+        wake(pname, False)
+        p["results"].append(dump["results"])
+        for (name, series) in p["graphing"]["standardGraphs"].items():
+            if name in dump["graphs"]:
+                series.load(dump["graphs"][name])
+        p["graphing"]["customGraphs"] = dump["customGraphs"]
+
+        # Workers already counted in the graphs are not counted again
+        for username in dump["workers"]:
+            issuedTasks.setdefault(username, {})[pname] = p["tasks"].workerTasks(username)
+
+        projects[pname] = p
+        return (True, "")
+
+# Deletes project pname, and every blob in it
+def dropProject(pname):
+    with lock:
+        p = projects.pop(pname, None)
+        if p is None:
+            return (False, "Invalid project name")
+        scheduler.remove(pname)
+        smallScheduler.remove(pname)
+
+        hashes = [h for (h,) in conn.execute("SELECT hash FROM Data_blob WHERE pID = ?", (p["pID"],))]
+        begin()
+        conn.execute("DELETE FROM Project WHERE pID = ?", (p["pID"],))
+        for h in hashes:
+            store.release(h)
+        for runs in p["checks"].values():
+            for run in runs:
+                for h in run[1]:
+                    store.release(h)
+        commit()
+
+        for mine in issuedTasks.values():
+            mine.pop(pname, None)
+        return (True, "")
+
+# Returns every user and session as plain values
+def exportUsers():
+    with lock:
+        users = [[u, hashpass, "customer", True, True] for (u, hashpass) in conn.execute("SELECT customername, password FROM Customer")]
+        users += [[u, hashpass, "worker", bool(wifi), bool(battery)] for (u, hashpass, wifi, battery) in
+            conn.execute("SELECT username, password, prefwifidata, prefbattery FROM Worker")]
+
+    return (True, {"users": users, "sessions": [[token, s["username"], s["accesslevel"], s["starttime"]] for (token, s) in sessions.items()]})
+
+# Adds the users and sessions of an exportUsers() dump which are not already held
+def importUsers(dump):
+    try:
+        with lock:
+            begin()
+            for (username, hashpass, accesslevel, *prefs) in dump["users"]:
+                if queryUser(username) is not None:
+                    continue
+                if accesslevel == "customer":
+                    conn.execute("INSERT INTO Customer (customername, password) VALUES (?, ?)", (username, hashpass))
+                else:
+                    (prefwifidata, prefbattery) = prefs or (True, True)
+                    conn.execute("INSERT INTO Worker (username, password, prefwifidata, prefbattery) VALUES (?, ?, ?, ?)",
+                            (username, hashpass, int(prefwifidata), int(prefbattery)))
+            commit()
+        for (token, username, accesslevel, starttime) in dump["sessions"]:
+            if token not in sessions:
+                sessions.create(username, accesslevel, starttime, token)
+    except Exception as e:
+        return (False, "Invalid users dump: " + str(e))
+
+    return (True, "")
+
+## GRAPHING METHODS
+# Returns the graphs of kind. Standard graphs are read at a precision of prec milliseconds, from
+# the interval holding time since onwards
+def getGraphs(pname, kind, prec, since=0):
+    if not pname in projects:
+        return (False, "Invalid project name")
+
+    graphs = projects[pname]["graphing"][kind]
+    if kind == "standardGraphs":
+        graphs = {name: series.points(prec, since) for (name, series) in graphs.items()}
+    return (True, graphs)
+
+# Returns the version of the graphs of kind, which changes whenever they do. Read it before the
+# graphs themselves
+def getGraphsVersion(pname, kind):
+    if not pname in projects:
+        return (False, "Invalid project name")
+
+    return (True, projects[pname]["graphing"]["versions"][kind])
+
+# GraphsData is of the graphsCBOR type, as documented in api.txt
+@durable
+def updateCustomGraphs(graphsData, pname):
+    with lock:
+        # Check the project exists
+        if not pname in projects:
+            return (False, "Invalid project name")
+
+        # Save the new custom graph
+        begin()
+        conn.execute("UPDATE Project SET customGraphs = ? WHERE pID = ?", (cbor.dumps(graphsData), projects[pname]["pID"]))
+        mutated()
+        projects[pname]["graphing"]["customGraphs"] = graphsData
+        projects[pname]["graphing"]["versions"]["customGraphs"] += 1
+
+        return (True, "")
@@ -0,0 +1,89 @@
+# Time series storage for the standard graphs
+from array import array
+from bisect import bisect_left
+import threading
+
+from header import *
+
+# A value changing over time, such as the number of active workers. Rather than every change, it
+# keeps the last value in each interval at each of GRAPH_RESOLUTIONS, in typed arrays, so that a
+# graph at any precision is read from the nearest rollup. Each rollup keeps roughly the latest
+# GRAPH_RETENTION points. Times are in milliseconds.
+class TimeSeries:
+    def __init__(self, now, value=0):
+        self.value = value
+        # (resolution, times of intervals, last value in each interval), finest first
+        self.rollups = [(res, array('q'), array('q')) for res in GRAPH_RESOLUTIONS]
+        self.lock = threading.Lock()
+        self.add(now, 0)
+
+    def __len__(self):
+        return len(self.rollups[0][1])
+
+    # Number of points held in all the rollups
+    def size(self):
+        return sum(len(times) for (res, times, values) in self.rollups)
+
+    # Returns the value and rollups as a dict of plain values, for moving the series to another server
+    def dump(self):
+        with self.lock:
+            return {"value": self.value, "rollups": [[res, times.tobytes(), values.tobytes()] for (res, times, values) in self.rollups]}
+
+    # Replaces the value and rollups with those of a dump()
+    def load(self, d):
+        rollups = {res: (times, values) for (res, times, values) in d["rollups"]}
+        with self.lock:
+            self.value = d["value"]
+            for (res, times, values) in self.rollups:
+                if res in rollups:
+                    times[:] = array('q', rollups[res][0])
+                    values[:] = array('q', rollups[res][1])
+
+    # Changes the value by diff at time now
+    def add(self, now, diff):
+        with self.lock:
+            self.value += diff
+            for (res, times, values) in self.rollups:
+                t = now - now % res
+                if times and times[-1] >= t:
+                    values[-1] = self.value
+                    continue
+
+                times.append(t)
+                values.append(self.value)
+                # Trim in bulk so that appending stays amortised constant time
+                if len(times) > 2*GRAPH_RETENTION:
+                    del times[:-GRAPH_RETENTION]
+                    del values[:-GRAPH_RETENTION]
+
+    # Returns the last value in each interval of prec milliseconds, as a list of datapoints. Only
+    # intervals from the one holding since onwards are returned, so that a client holding points up
+    # to time since replaces its points from since onwards with these
+    def points(self, prec, since=0):
+        # Read from the coarsest rollup which is no coarser than prec
+        (res, times, values) = self.rollups[0]
+        for rollup in self.rollups:
+            if rollup[0] <= prec:
+                (res, times, values) = rollup
+
+        step = max(prec, res)
+        with self.lock:
+            start = bisect_left(times, since - since % step)
+            times = times[start:]
+            values = values[start:]
+
+        if prec <= res:
+            return [{"x": t, "y": v} for (t, v) in zip(times, values)]
+
+        # Downsample, keeping the last point in each interval
+        data = []
+        prev = None
+        for (t, v) in zip(times, values):
+            t -= t % prec
+            if t == prev:
+                data[-1]["y"] = v
+            else:
+                data.append({"x": t, "y": v})
+                prev = t
+
+        return data
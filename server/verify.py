@@ -0,0 +1,51 @@
+# Checking the results of tasks by running some of them again
+import random, threading
+
+from header import *
+
+# Decides which completed tasks are run again by another worker, so that their results can be
+# compared. A task is checked with its project's sampling rate, multiplied by a factor for the
+# worker which completed it. The factor starts at 1, is multiplied by VERIFY_RAISE each time the
+# worker's result disagrees with the others for a task, and is divided by it again each time its
+# result agrees, so that only workers which have given wrong results are checked more often.
+class Verifier:
+    def __init__(self):
+        self.factors = {}   # Maps a username to its factor, if not 1
+        self.lock = threading.Lock()
+
+    # True iff the task username just completed, in a project with sampling rate rate, should be checked
+    def sample(self, username, rate):
+        return random.random() < rate * self.factors.get(username, 1)
+
+    def agreed(self, username):
+        with self.lock:
+            factor = self.factors.get(username, 1) / VERIFY_RAISE
+            if factor > 1:
+                self.factors[username] = factor
+            else:
+                self.factors.pop(username, None)
+
+    def disagreed(self, username):
+        with self.lock:
+            self.factors[username] = min(self.factors.get(username, 1) * VERIFY_RAISE, VERIFY_MAX_FACTOR)
+
+# Each run of a checked task is [username, result hashes, result sizes, result metadatas]. Returns
+# the index of the first run whose results are the same as those of a later run, or None if every
+# run's results differ
+def agreement(runs):
+    seen = {}
+    for (i, run) in enumerate(runs):
+        key = tuple(run[1])
+        if key in seen:
+            return seen[key]
+        seen[key] = i
+    return None
+
+# Tells verifier which of the runs of a checked task agreed with each other, by index agreed as
+# returned by agreement(), and which did not. If none agreed, none is trusted
+def judge(verifier, runs, agreed):
+    for run in runs:
+        if agreed is not None and run[1] == runs[agreed][1]:
+            verifier.agreed(run[0])
+        else:
+            verifier.disagreed(run[0])
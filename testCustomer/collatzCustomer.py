@@ -13,11 +13,11 @@ except:
     print("Please enter correct username, password and project ID")
     sys.exit()
 
-#ollatzf = open("collatzClient", 'rb')
-with open("collatzClient", "rb") as f:
-    collatz_wa = f.read()
 collatz_fs = os.path.getsize("collatzClient")
 
+BATCH_SIZE = 1000   # Tasks created per request
+RESULT_WAIT = 30000 # Milliseconds each request waits for new results
+
 class TaskDistributor:
 
     # For now we just have a fixed range.
@@ -40,7 +40,8 @@ class TaskDistributor:
         self.thr_mon.join()
 
     def makeTaskBlob(self):
-        (success, data) = createNewBlob(self.token, project_name, collatz_wa, cbor.dumps({}))
+        with open("collatzClient", "rb") as f:
+            (success, data) = createNewBlobStream(self.token, project_name, f, cbor.dumps({}))
         if not success:
             print("Error when making blob task")
             print(data["error"])
@@ -62,6 +63,7 @@ class TaskDistributor:
         print("Blob creation succeeded")
         print ("Taskifying " + str(number_tasks) + " times...")
 
+        taskBlobs = []
         for taskNo in range (0, number_tasks):
 
             # Calculate interval
@@ -75,20 +77,25 @@ class TaskDistributor:
 
             taskInfo = { "program": {"id": taskBlobID, "size": collatz_fs},
                          "control": intervalb, "blobs": []}
+            taskBlobs.append(cbor.dumps(taskInfo))
+
+            self.search_start += self.fixed_range
 
-            (success, dataBlob) = createNewBlob(token, project_name, cbor.dumps(taskInfo), cbor.dumps({}))
-            if (not success):
-                print("Error when creating blob (pre-taskify)")
-                print(dataBlob["error"])
-                sys.exit()
+            # Create and taskify the blobs a batch at a time
+            if len(taskBlobs) == BATCH_SIZE or taskNo == number_tasks - 1:
+                (success, dataBlobs) = createNewBlobs(token, project_name, taskBlobs, [cbor.dumps({})]*len(taskBlobs), True)
+                if (not success):
+                    print("Error when creating task blobs")
+                    print(dataBlobs["error"])
+                    sys.exit()
 
-            (success, dataTask) = blobToTask(token, project_name, dataBlob["blobID"])
-            if (not success):
-                print ("Error when taskifying")
-                print (dataTask["error"])
-                sys.exit()
+                for result in dataBlobs["results"]:
+                    if (not result["success"]):
+                        print ("Error when taskifying")
+                        print (result["error"])
+                        sys.exit()
 
-            self.search_start += self.fixed_range
+                taskBlobs = []
 
         print ("Taskifying succeeded")
 
@@ -140,44 +147,37 @@ class TaskDistributor:
         self.highestSeqs.append ( {"x": time.time()*1000, "y": highestSeqLen} )
         self.plot(self.highestSeqs)
 
-    # When a worker finished a computation, it places a blob in the database along with metadata
-    # indicating whether the task is finished. The customer will routinely scan (will it?) the database for
-    # finished blobs and will acquire their results before deleting them.
+    # When a worker finishes a computation, it places a blob in the database along with metadata
+    # indicating that it is a result. The customer waits on the server for new results, and
+    # acquires them before deleting them.
 
     def monitorBlobs(self):
         dataRecieved = 0
+        cursor = -1
         print("Monitoring blobs...")
         while True:
-            time.sleep(5)
             try:
-
-                # Get meta-data on all blobs (for now)
-                (success, allData) = getBlobMetadata(self.token, project_name, [])
+                # Wait for results newer than those already seen
+                (success, allData) = waitForResults(self.token, project_name, cursor, RESULT_WAIT)
                 if (not success):
-                    print ("Error when retrieving metadata")
+                    print ("Error when waiting for results")
                     print(allData)
+                    time.sleep(5)
                     continue
 
-                metaDict = allData["metadata"]
-
-                # Convert all metadata out of CBOR form
-                for bID, meta in metaDict.items():
-                    metaDict[bID] = cbor.loads(meta)
-
-                for blobid, metadata  in metaDict.items():
-                    if (bool(metadata)):
-                        if (metadata["result"] == True):
-                            # So blobID points to a result
-                            (success, data) = getBlob(self.token, project_name, blobid)
-                            if (not success):
-                                print ("Failure to retrieve result blob")
-                                sys.exit()
-                            blobval = data["blob"]
-                            self.processResults(blobval)
-                            dataRecieved += 1
-                            deleteBlob(self.token, project_name, blobid)
+                cursor = allData["cursor"]
+                for blobid in allData["metadata"]:
+                    (success, data) = getBlob(self.token, project_name, blobid)
+                    if (not success):
+                        print ("Failure to retrieve result blob")
+                        sys.exit()
+                    blobval = data["blob"]
+                    self.processResults(blobval)
+                    dataRecieved += 1
+                    deleteBlob(self.token, project_name, blobid)
             except:
                 traceback.print_exc()
+                time.sleep(5)
 
 ############### START HERE ################
 if __name__ == '__main__':
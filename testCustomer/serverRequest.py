@@ -1,7 +1,8 @@
 ## Automated tests for the server
-import requests, cbor
+import requests, cbor, struct, json
 
 SERVER_IP = "35.178.90.246/api"
+STREAM_CHUNK = 64*1024     # Bytes sent or received at a time when streaming blobs
 
 def reboot():
     r = requests.post("http://" + SERVER_IP + "/reboot")
@@ -101,6 +102,30 @@ def createNewBlob(token, pname, blob, metadata):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
 
+# Uploads the blob read from file object f in chunks, without holding it all in memory
+def createNewBlobStream(token, pname, f, metadata):
+    head = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "metadata": metadata
+        })
+
+    def body():
+        yield struct.pack(">I", len(head)) + head
+        while True:
+            chunk = f.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+
+    r = requests.post("http://" + SERVER_IP + "/createNewBlobStream", data = body())
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
 def blobToTask(token, pname, blobID):
     r = requests.post("http://" + SERVER_IP + "/blobToTask", data = cbor.dumps(
         {   "token": token,
@@ -114,11 +139,43 @@ def blobToTask(token, pname, blobID):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
     
-def getBlobMetadata(token, pname, blobIDs):
+def createNewBlobs(token, pname, blobs, metadatas, tasks = False):
+    r = requests.post("http://" + SERVER_IP + "/createNewBlobs", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "blobs": blobs,
+            "metadatas": metadatas,
+            "tasks": tasks
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+def blobsToTasks(token, pname, blobIDs):
+    r = requests.post("http://" + SERVER_IP + "/blobsToTasks", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "blobIDs": blobIDs,
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+# With no blobIDs, returns a page of up to limit blobs after blob ID after. Its "next" is the after
+# of the next page, or None
+def getBlobMetadata(token, pname, blobIDs, after=-1, limit=1000):
     r = requests.post("http://" + SERVER_IP + "/getBlobMetadata", data = cbor.dumps(
         {   "token": token,
             "pname": pname,
             "blobIDs": blobIDs,
+            "after": after,
+            "limit": limit
         }))
 
     if r.status_code != 200:
@@ -128,6 +185,39 @@ def getBlobMetadata(token, pname, blobIDs):
 
     return (data["success"] and data["error"] == "", data)
     
+# Returns up to limit changes to the blobs of a project after sequence number seq
+def getChanges(token, pname, seq, limit=1000):
+    r = requests.post("http://" + SERVER_IP + "/getChanges", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "seq": seq,
+            "limit": limit
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+
+    return (data["success"] and data["error"] == "", data)
+
+# Waits up to timeout milliseconds for result blobs newer than cursor
+def waitForResults(token, pname, cursor, timeout, limit=1000):
+    r = requests.post("http://" + SERVER_IP + "/waitForResults", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "cursor": cursor,
+            "timeout": timeout,
+            "limit": limit
+        }))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+
+    return (data["success"] and data["error"] == "", data)
+
 def getBlob(token, pname, name):
     r = requests.post("http://" + SERVER_IP + "/getBlob", data = cbor.dumps(
         {   "token": token,
@@ -143,11 +233,57 @@ def getBlob(token, pname, name):
     data["metadata"] = cbor.loads(data["metadata"])
     return (data["success"] and data["error"] == "", data)
     
-def getTasks(token, pname, maxtasks):
-    r = requests.post("http://" + SERVER_IP + "/getTasks", data = cbor.dumps(
+# Downloads a blob in chunks into file object out, without holding it all in memory
+def getBlobStream(token, pname, name, out):
+    r = requests.post("http://" + SERVER_IP + "/getBlobStream", data = cbor.dumps(
+        {   "token": token,
+            "pname": pname,
+            "name": name,
+        }), stream = True)
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    (n,) = struct.unpack(">I", r.raw.read(4))
+    data = cbor.loads(r.raw.read(n))
+    if data["success"]:
+        for chunk in r.iter_content(STREAM_CHUNK):
+            out.write(chunk)
+        data["metadata"] = cbor.loads(data["metadata"])
+    return (data["success"] and data["error"] == "", data)
+
+# programs lists the hashes of the programs already held, which are left out of the response.
+# Input blobs of the tasks are sent inline, up to prefetch bytes of them. A maxtasks of None asks for
+# the worker's suggested batch size
+def getTasks(token, pname, maxtasks, programs=[], prefetch=0):
+    body = {"token": token, "pname": pname, "programs": programs, "prefetch": prefetch}
+    if maxtasks is not None:
+        body["maxtasks"] = maxtasks
+    r = requests.post("http://" + SERVER_IP + "/getTasks", data = cbor.dumps(body))
+
+    if r.status_code != 200:
+        return (False, r.text)
+
+    data = cbor.loads(r.content)
+    return (data["success"] and data["error"] == "", data)
+
+# Fetches a program by its hash. Pass the etag of an earlier response to be told it is unchanged
+def getProgram(h, etag=None):
+    r = requests.get("http://" + SERVER_IP + "/getProgram", params = {"hash": h},
+        headers = {"If-None-Match": etag} if etag else {})
+
+    if r.status_code == 304:
+        return (True, {"unchanged": True, "etag": etag})
+    if r.status_code != 200:
+        return (False, r.text)
+
+    return (True, {"program": r.content, "etag": r.headers.get("ETag"), "cacheControl": r.headers.get("Cache-Control")})
+
+def renewLeases(token, pname, taskIDs):
+    r = requests.post("http://" + SERVER_IP + "/renewLeases", data = cbor.dumps(
         {   "token": token,
             "pname": pname,
-            "maxtasks": maxtasks,
+            "taskIDs": taskIDs,
         }))
 
     if r.status_code != 200:
@@ -181,15 +317,22 @@ def deleteBlob(token, pname, blobID):
     data = cbor.loads(r.content)
     return (data["success"] and data["error"] == "", data)
 
-def getGraphs(pname):
-    r = requests.post("http://" + SERVER_IP + "/getGraphs", data = cbor.dumps(
-        {   "pname": pname
-        }))
-
+# Pass the etag of an earlier response to be told if nothing has changed since
+def getGraphs(pname, prec, kind="standardGraphs", since=0, etag=None):
+    r = requests.post("http://" + SERVER_IP + "/getGraphs", params =
+        {   "pname": pname,
+            "prec": prec,
+            "kind": kind,
+            "since": since
+        }, headers = {"If-None-Match": etag} if etag else {})
+
+    if r.status_code == 304:
+        return (True, {"success": True, "error": "", "unchanged": True, "etag": etag})
     if r.status_code != 200:
         return (False, r.text)
 
-    data = cbor.loads(r.content)
+    data = json.loads(r.text)
+    data["etag"] = r.headers.get("ETag")
     return (data["success"] and data["error"] == "", data)
 
 